@@ -1,16 +1,39 @@
 import streamlit as st
 import pandas as pd
-from datetime import datetime, timedelta, date
+import numpy as np
+from datetime import datetime, timedelta, date, timezone
 import firebase_admin
 from firebase_admin import credentials, firestore
 from firebase_admin.firestore import Increment
-from google.api_core.exceptions import FailedPrecondition
-import google.generativeai as genai 
+from google.api_core.exceptions import FailedPrecondition, ResourceExhausted, TooManyRequests, ServiceUnavailable, DeadlineExceeded
+from google.cloud.firestore_v1.base_query import FieldFilter, Or
 import plotly.express as px
 import time
 import urllib.parse
 import base64
 import math
+import html
+import hashlib
+import io
+import json
+import re
+import unicodedata
+import os
+import sys
+import threading
+import uuid
+import sqlite3
+import random
+import functools
+import itertools
+import copy
+import contextlib
+import contextvars
+import http.server
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+import storage
 
 # --- 1. CONFIGURACIÓN Y ESTILOS ---
 APP_CONFIG = {
@@ -18,7 +41,17 @@ APP_CONFIG = {
     "MASTER_KEY": "ADMIN123",
     "VERSION": "10.5.0 Itero Master AI", 
     "LOGO_URL": "Gemini_Generated_Image_buyjdmbuyjdmbuyj.png", 
-    "BOSS_PHONE": "0999999999" 
+    "BOSS_PHONE": "0999999999",
+    "PHOTO_STORE": "firestore",   # firestore | local | bucket
+    "PHOTO_DIR": "photo_store",
+    "REALTIME": True,             # escuchas on_snapshot por flota (False = solo consultas)
+    "AI_CACHE_DIR": "ai_cache",
+    "LOG_SNAPSHOT_DIR": os.environ.get("ITERO_SNAPSHOT_DIR", "log_snapshots"),   # fotos Parquet de la bitácora (vacío = solo en memoria)
+    "AI_MODEL": None,             # fija el modelo de Gemini (None = descubrirlo y guardarlo en AI_CACHE_DIR)
+    "STORAGE": os.environ.get("ITERO_STORAGE", "firestore"),   # firestore | memory | sqlite (ver storage.py)
+    "STORAGE_PATH": os.environ.get("ITERO_STORAGE_PATH", "itero.sqlite3"),
+    "METRICS_PORT": int(os.environ.get("ITERO_METRICS_PORT", 0)),  # /metrics en formato Prometheus (0 = apagado)
+    "METRICS_HOST": os.environ.get("ITERO_METRICS_HOST", "127.0.0.1")   # fuera de localhost las flotas salen como hash
 }
 
 UI_COLORS = {
@@ -55,40 +88,389 @@ def format_phone(phone):
         return "593" + p 
     return p
 
+# --- 1.1 TRAZAS POR RERUN Y CONTADORES DEL BACKEND ---
+# Cada rerun abre una traza; `span()` y `@traced` miden las llamadas a la capa de datos y
+# las páginas, y el cliente de base de datos va envuelto en un proxy que cuenta lecturas,
+# escrituras y bytes. Todo se atribuye a la sesión y la flota de la traza activa: el
+# dueño lo ve en la barra lateral, el panel maestro por flota y Prometheus en /metrics.
+TRACE_SESSIONS_MAX = 500
+BACKEND_METRICS = ("reads", "writes", "read_bytes", "write_bytes")
+_current_trace = contextvars.ContextVar("itero_trace", default=None)
+
+@st.cache_resource
+def _telemetry():
+    """Contadores del proceso: por flota, por sesión (las más recientes) y tiempos por span."""
+    return {"lock": threading.Lock(), "fleets": {}, "sessions": OrderedDict(), "spans": {}}
+
+def begin_trace(session_id, fleet_id=None):
+    """Abre la traza del rerun actual; lo que se mida desde aquí se atribuye a esa sesión y flota."""
+    trace = {"session": session_id, "fleet": fleet_id or "-", "spans": [], "stack": []}
+    _current_trace.set(trace)
+    return trace
+
+@contextlib.contextmanager
+def span(name):
+    """Mide un bloque: duración y operaciones del backend hechas dentro (incluye los spans anidados)."""
+    trace = _current_trace.get()
+    rec = {"name": name, "depth": 0, "ms": 0.0} | dict.fromkeys(BACKEND_METRICS, 0)
+    if trace is not None:
+        rec["depth"] = len(trace["stack"])
+        trace["spans"].append(rec)
+        trace["stack"].append(rec)
+    started = time.perf_counter()
+    try:
+        yield rec
+    finally:
+        elapsed = time.perf_counter() - started
+        rec["ms"] = elapsed * 1000
+        if trace is not None:
+            trace["stack"].pop()
+        tel = _telemetry()
+        with tel["lock"]:
+            agg = tel["spans"].setdefault(name, {"count": 0, "seconds": 0.0, "max": 0.0})
+            agg["count"] += 1
+            agg["seconds"] += elapsed
+            agg["max"] = max(agg["max"], elapsed)
+
+def traced(fn):
+    """Decorador: cada llamada a `fn` es un span con su nombre."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with span(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+def count_backend(fleet_id=None, session_id=None, **deltas):
+    """Suma operaciones del backend a la traza activa, su sesión y su flota (o a las indicadas)."""
+    trace = _current_trace.get()
+    if trace is not None:
+        for rec in trace["stack"]:
+            for k, v in deltas.items(): rec[k] += v
+        fleet_id = fleet_id or trace["fleet"]
+        session_id = session_id or trace["session"]
+    tel = _telemetry()
+    with tel["lock"]:
+        fleet = tel["fleets"].setdefault(fleet_id or "-", dict.fromkeys(BACKEND_METRICS, 0))
+        for k, v in deltas.items(): fleet[k] += v
+        if session_id:
+            sess = tel["sessions"].pop(session_id, None) or {"fleet": fleet_id or "-"} | dict.fromkeys(BACKEND_METRICS, 0)
+            for k, v in deltas.items(): sess[k] += v
+            tel["sessions"][session_id] = sess
+            while len(tel["sessions"]) > TRACE_SESSIONS_MAX:
+                tel["sessions"].popitem(last=False)
+
+def _doc_bytes(snap):
+    data = getattr(snap, "_data", None)
+    return len(snap.id) + _value_bytes(data) if data else 0
+
+def _unwrap(value):
+    if isinstance(value, CountingProxy): return value._target
+    if isinstance(value, (list, tuple)): return type(value)(_unwrap(v) for v in value)
+    return value
+
+class CountingProxy:
+    """Envuelve el cliente de base de datos (y las referencias, consultas y lotes que devuelve)
+    para contar lecturas, escrituras y bytes sin tocar las llamadas de la app."""
+    WRAPPED = {"CollectionReference", "DocumentReference", "Query", "CollectionGroup", "AggregationQuery", "WriteBatch", "Transaction"}
+
+    def __init__(self, target):
+        self._target = target
+        self._pending = [0, 0]   # escrituras y bytes acumulados en un lote hasta el commit
+
+    def __bool__(self):
+        return bool(self._target)
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr): return attr
+        counter = getattr(self, f"_count_{name}", None)
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            args, kwargs = _unwrap(args), {k: _unwrap(v) for k, v in kwargs.items()}
+            if name == "on_snapshot":
+                args = (self._listener_callback(args[0]),) + args[1:]
+            result = attr(*args, **kwargs)
+            if counter: return counter(result, args, kwargs)
+            return CountingProxy(result) if type(result).__name__ in self.WRAPPED else result
+        return call
+
+    def _count_snapshots(self, snaps):
+        n = nbytes = 0
+        for snap in snaps:
+            n += 1
+            nbytes += _doc_bytes(snap)
+            yield snap
+        count_backend(reads=max(n, 1), read_bytes=nbytes)
+
+    def _count_stream(self, result, args, kwargs):
+        return self._count_snapshots(result)
+
+    def _count_get_all(self, result, args, kwargs):
+        return self._count_snapshots(result)
+
+    def _count_get(self, result, args, kwargs):
+        if isinstance(result, list):
+            if result and isinstance(result[0], list):   # agregación: una lectura por consulta
+                count_backend(reads=1)
+                return result
+            return list(self._count_snapshots(result))
+        count_backend(reads=1, read_bytes=_doc_bytes(result))
+        return result
+
+    def _count_write(self, result, args, kwargs):
+        batched = type(self._target).__name__ in ("WriteBatch", "Transaction")
+        data = args[1] if len(args) > 1 and batched else (args[0] if args else {})
+        nbytes = _value_bytes(data) if isinstance(data, dict) else 0
+        if batched:
+            self._pending[0] += 1
+            self._pending[1] += nbytes
+            return self
+        count_backend(writes=1, write_bytes=nbytes)
+        return result
+
+    _count_set = _count_update = _count_create = _count_delete = _count_write
+
+    def _count_add(self, result, args, kwargs):
+        count_backend(writes=1, write_bytes=_value_bytes(args[0]))
+        return result[0], CountingProxy(result[1])
+
+    def _count_commit(self, result, args, kwargs):
+        writes, nbytes = self._pending
+        self._pending = [0, 0]
+        count_backend(writes=writes, write_bytes=nbytes)
+        return result
+
+    def _listener_callback(self, callback):
+        # Las entregas llegan en otro hilo: se cobran a la flota de quien abrió la escucha
+        trace = _current_trace.get()
+        fleet_id = trace["fleet"] if trace else None
+        first = [True]
+
+        def wrapped(docs, changes, read_time):
+            n = len(changes) or int(first[0])
+            first[0] = False
+            count_backend(fleet_id, "(escuchas)", reads=n, read_bytes=sum(_doc_bytes(c.document) for c in changes))
+            return callback(docs, changes, read_time)
+        return wrapped
+
+def telemetry_snapshot():
+    tel = _telemetry()
+    with tel["lock"]:
+        return copy.deepcopy({k: v for k, v in tel.items() if k != "lock"})
+
+def _prom_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _metrics_fleet(fleet_id):
+    """Etiqueta de flota para /metrics: el id es el código de acceso, así que solo sale tal cual en localhost."""
+    if APP_CONFIG["METRICS_HOST"] in ("127.0.0.1", "localhost", "::1") or fleet_id == "-":
+        return fleet_id
+    return hashlib.sha256(fleet_id.encode("utf-8")).hexdigest()[:12]
+
+def render_openmetrics():
+    """Contadores del proceso en formato de texto de Prometheus/OpenMetrics."""
+    snap = telemetry_snapshot()
+    lines = []
+    for metric in BACKEND_METRICS:
+        name = f"itero_backend_{metric}_total"
+        lines += [f"# HELP {name} Operaciones del backend ({metric}) por flota.", f"# TYPE {name} counter"]
+        lines += [f'{name}{{fleet="{_prom_label(_metrics_fleet(f))}"}} {v[metric]}' for f, v in sorted(snap["fleets"].items())]
+    lines += ["# HELP itero_span_seconds Duración de las llamadas instrumentadas.", "# TYPE itero_span_seconds summary"]
+    for name, agg in sorted(snap["spans"].items()):
+        lines.append(f'itero_span_seconds_sum{{span="{_prom_label(name)}"}} {agg["seconds"]:.6f}')
+        lines.append(f'itero_span_seconds_count{{span="{_prom_label(name)}"}} {agg["count"]}')
+    lines += ["# HELP itero_sessions Sesiones con operaciones registradas.", "# TYPE itero_sessions gauge", f"itero_sessions {len(snap['sessions'])}", "# EOF"]
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404); return
+        body = render_openmetrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@st.cache_resource
+def start_metrics_server(port, host=None):
+    """Sirve /metrics en un hilo aparte (una vez por proceso); por defecto solo en localhost."""
+    server = http.server.ThreadingHTTPServer((host or APP_CONFIG["METRICS_HOST"], port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
 # --- 2. CONFIGURACIÓN DE IA ---
+# El SDK de Gemini se importa y configura la primera vez que se usa una función de IA, no
+# al arrancar: los arranques en frío no pagan la importación ni el listado de modelos.
+# El nombre del modelo descubierto se guarda en disco con un TTL para que los procesos
+# nuevos no vuelvan a llamar a `list_models()`; APP_CONFIG["AI_MODEL"] o
+# `GEMINI_KEY.model` en los secrets lo fijan sin consultar la API.
+AI_MODEL_TTL = timedelta(days=1)
+AI_MODEL_DEFAULT = "models/gemini-1.5-flash"
+
 try:
-    if "GEMINI_KEY" in st.secrets:
-        genai.configure(api_key=st.secrets["GEMINI_KEY"]["api_key"])
-        HAS_AI = True
-    else:
-        HAS_AI = False
+    HAS_AI = "GEMINI_KEY" in st.secrets
 except Exception:
     HAS_AI = False
 
+@st.cache_resource
+def _genai():
+    import google.generativeai as genai
+    genai.configure(api_key=st.secrets["GEMINI_KEY"]["api_key"])
+    return genai
+
+def _ai_model_file():
+    return os.path.join(APP_CONFIG["AI_CACHE_DIR"], "ai_model.json")
+
+def resolve_ai_model_name(genai):
+    """Nombre del modelo: override, luego el guardado en disco si no venció, luego `list_models()`."""
+    override = APP_CONFIG.get("AI_MODEL") or st.secrets["GEMINI_KEY"].get("model")
+    if override: return override
+    saved = {}
+    try:
+        with open(_ai_model_file(), encoding="utf-8") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if saved.get("model") and time.time() - saved.get("resolved_at", 0) < AI_MODEL_TTL.total_seconds():
+        return saved["model"]
+    try:
+        valid_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
+    except Exception:
+        return saved.get("model") or AI_MODEL_DEFAULT
+    model_name = next((m for m in valid_models if "1.5-flash" in m), valid_models[0] if valid_models else AI_MODEL_DEFAULT)
+    try:
+        os.makedirs(APP_CONFIG["AI_CACHE_DIR"], exist_ok=True)
+        tmp = f"{_ai_model_file()}.{uuid.uuid4().hex}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"model": model_name, "resolved_at": time.time()}, f)
+        os.replace(tmp, _ai_model_file())
+    except OSError:
+        pass
+    return model_name
+
 @st.cache_resource
 def get_ai_model():
     if not HAS_AI: return None
     try:
-        valid_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
-        model_name = next((m for m in valid_models if "1.5-flash" in m), valid_models[0] if valid_models else "models/gemini-1.5-flash")
-        return genai.GenerativeModel(model_name)
+        genai = _genai()
+        return genai.GenerativeModel(resolve_ai_model_name(genai))
     except Exception:
         return None
 
-def get_ai_analysis(df_bus, bus_id, fleet_id):
-    if not HAS_AI: return "⚠️ IA no disponible."
-    model = get_ai_model()
-    if not model: return "Error de conexión IA."
-    
+# --- 2.1 CACHÉ DE DIAGNÓSTICOS IA (EN DISCO) ---
+# La respuesta se guarda bajo el hash de (modelo, reglas, resumen del bus) en un SQLite
+# local: sobrevive reinicios y la comparten todas las sesiones y procesos del servidor.
+# Cada escritura de la bitácora borra las entradas de su bus.
+AI_CACHE_TTL = timedelta(days=7)
+AI_CACHE_MAX_ENTRIES = 500
+
+@st.cache_resource
+def _ai_cache_db():
+    os.makedirs(APP_CONFIG["AI_CACHE_DIR"], exist_ok=True)
+    conn = sqlite3.connect(os.path.join(APP_CONFIG["AI_CACHE_DIR"], "ai_cache.sqlite3"), check_same_thread=False, timeout=10)
+    conn.execute("CREATE TABLE IF NOT EXISTS ai_cache (key TEXT PRIMARY KEY, fleet TEXT, bus TEXT, response TEXT, created REAL, last_used REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ai_cache_bus ON ai_cache (fleet, bus)")
+    conn.commit()
+    return {"lock": threading.Lock(), "conn": conn}
+
+def ai_cache_key(*parts):
+    return hashlib.sha256("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+def ai_cache_get(key):
+    cache, now = _ai_cache_db(), time.time()
+    with cache["lock"]:
+        row = cache["conn"].execute("SELECT response FROM ai_cache WHERE key = ? AND created > ?", (key, now - AI_CACHE_TTL.total_seconds())).fetchone()
+        if row:
+            cache["conn"].execute("UPDATE ai_cache SET last_used = ? WHERE key = ?", (now, key))
+            cache["conn"].commit()
+    return row[0] if row else None
+
+def ai_cache_put(key, fleet_id, bus_id, response):
+    cache, now = _ai_cache_db(), time.time()
+    with cache["lock"]:
+        conn = cache["conn"]
+        conn.execute("INSERT OR REPLACE INTO ai_cache VALUES (?, ?, ?, ?, ?, ?)", (key, fleet_id, str(bus_id), response, now, now))
+        # Vencidas fuera y, si sobra, las menos usadas (LRU)
+        conn.execute("DELETE FROM ai_cache WHERE created <= ?", (now - AI_CACHE_TTL.total_seconds(),))
+        conn.execute("DELETE FROM ai_cache WHERE key IN (SELECT key FROM ai_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (AI_CACHE_MAX_ENTRIES,))
+        conn.commit()
+
+def invalidate_ai_cache(fleet_id, *buses):
+    """Descarta los diagnósticos guardados de esos buses (llegó un registro nuevo)."""
+    cache = _ai_cache_db()
+    with cache["lock"]:
+        cache["conn"].executemany("DELETE FROM ai_cache WHERE fleet = ? AND bus = ?", [(fleet_id, str(b)) for b in set(buses)])
+        cache["conn"].commit()
+
+# --- 2.2 RESPUESTAS EN STREAMING Y MÉTRICAS DE LATENCIA ---
+AI_METRICS_MAX = 500
+
+@st.cache_resource
+def _ai_metrics():
+    """Últimas mediciones de latencia de la IA en este proceso."""
+    return {"lock": threading.Lock(), "rows": deque(maxlen=AI_METRICS_MAX)}
+
+def record_ai_metric(row):
+    store = _ai_metrics()
+    with store["lock"]:
+        store["rows"].append(dict(row))
+
+def ai_metrics_summary():
+    """Resumen por origen: cantidad, p50/p95 de primer token y de latencia total, cortes."""
+    with _ai_metrics()["lock"]:
+        rows = list(_ai_metrics()["rows"])
+    if not rows: return pd.DataFrame()
+    df = pd.DataFrame(rows)
+    return df.groupby("source").agg(
+        Solicitudes=("total", "size"),
+        TTFT_p50=("ttft", "median"), TTFT_p95=("ttft", lambda x: x.quantile(0.95)),
+        Total_p50=("total", "median"), Total_p95=("total", lambda x: x.quantile(0.95)),
+        Cortadas=("ok", lambda x: int((~x).sum())),
+    ).round(2).reset_index()
+
+def stream_ai_text(model, prompt, metrics, source="chat"):
+    """Entrega la respuesta por fragmentos y mide primer token (TTFT) y latencia total.
+
+    Si la conexión se corta a mitad de camino se conserva lo recibido y se agrega un aviso;
+    si falla antes del primer fragmento el error se propaga.
+    """
+    t0 = time.perf_counter()
+    metrics.update(source=source, ttft=None, total=None, chunks=0, chars=0, ok=False, at=datetime.now())
     try:
-        fleet_doc = REFS["fleets"].document(fleet_id).get()
-        ai_rules = fleet_doc.to_dict().get("ai_rules", "") if fleet_doc.exists else ""
+        for chunk in model.generate_content(prompt, stream=True):
+            try:
+                text = chunk.text
+            except ValueError:  # fragmento sin texto (p. ej. bloqueado por seguridad)
+                continue
+            if not text: continue
+            if metrics["ttft"] is None:
+                metrics["ttft"] = time.perf_counter() - t0
+            metrics["chunks"] += 1
+            metrics["chars"] += len(text)
+            yield text
+        metrics["ok"] = True
+    except Exception as e:
+        metrics["error"] = str(e)
+        if not metrics["chunks"]: raise
+        yield "\n\n⚠️ *Respuesta incompleta: se perdió la conexión con la IA.*"
+    finally:
+        metrics["total"] = time.perf_counter() - t0
+        record_ai_metric(metrics)
 
-        cols = ['date', 'category', 'observations', 'km_current', 'gallons', 'mec_cost', 'com_cost']
-        available_cols = [c for c in cols if c in df_bus.columns]
-        summary = df_bus[available_cols].head(15).to_string()
-        
-        prompt = f"""
+def bus_history_summary(df_bus):
+    """Texto con los últimos 15 registros del bus que recibe la IA (y que forma la clave de caché)."""
+    cols = ['date', 'category', 'observations', 'km_current', 'gallons', 'mec_cost', 'com_cost']
+    available_cols = [c for c in cols if c in df_bus.columns]
+    return df_bus[available_cols].head(15).to_string()
+
+def build_bus_prompt(bus_id, summary, ai_rules):
+    return f"""
         Actúa como el Jefe de Taller Experto de ITERO. Analiza el historial del Bus {bus_id}:
         {summary}
         
@@ -97,14 +479,299 @@ def get_ai_analysis(df_bus, bus_id, fleet_id):
 
         Dame 3 puntos breves (Diagnóstico, Alerta de Costos/Fraudes, Recomendación). Usa emojis.
         """
-        response = model.generate_content(prompt)
-        return response.text
+
+def analyze_bus(model, fleet_id, bus_id, summary, ai_rules, before_call=None):
+    """Diagnóstico de un bus desde el caché en disco o, si no está, desde el modelo (lanza errores)."""
+    key = ai_cache_key(model.model_name, ai_rules, bus_id, summary)
+    cached = ai_cache_get(key)
+    if cached is not None:
+        return cached
+    if before_call: before_call()
+    text = model.generate_content(build_bus_prompt(bus_id, summary, ai_rules)).text
+    ai_cache_put(key, fleet_id, bus_id, text)
+    return text
+
+def get_ai_analysis(df_bus, bus_id, fleet_id):
+    if not HAS_AI: return "⚠️ IA no disponible."
+    model = get_ai_model()
+    if not model: return "Error de conexión IA."
+    
+    try:
+        return analyze_bus(model, fleet_id, bus_id, bus_history_summary(df_bus), fetch_ai_rules(fleet_id))
     except Exception as e:
         return f"Error en análisis IA: {str(e)}"
 
+# --- 2.3 AUDITORÍA IA DE TODA LA FLOTA ---
+# Un diagnóstico por bus repartido en un pool de hilos acotado. Un token bucket mantiene
+# el ritmo bajo la cuota del modelo y los errores de cuota se reintentan con espera
+# exponencial. Cada resultado queda en `ai_reports/{flota}__{bus}`: la página muestra el
+# avance y vuelve a abrir los informes sin repetirlos mientras el historial no cambie.
+AUDIT_WORKERS = 4
+AUDIT_RPM = 15          # solicitudes por minuto al modelo
+AUDIT_BURST = 3
+AUDIT_RETRIES = 4
+AUDIT_BACKOFF = 2.0     # segundos de la primera espera
+AI_RETRY_ERRORS = (ResourceExhausted, TooManyRequests, ServiceUnavailable, DeadlineExceeded)
+
+class TokenBucket:
+    """Limitador de ritmo: `rate` fichas por segundo con ráfagas de hasta `capacity`."""
+    def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate, self.capacity = rate, capacity
+        self.clock, self.sleep = clock, sleep
+        self.tokens, self.last = float(capacity), clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+def call_with_backoff(fn, retries=AUDIT_RETRIES, base=AUDIT_BACKOFF, sleep=time.sleep):
+    """Ejecuta `fn` reintentando los errores de cuota con espera exponencial y jitter."""
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except AI_RETRY_ERRORS:
+            if attempt == retries: raise
+            sleep(base * 2 ** attempt * (0.5 + random.random()))
+
+def _report_id(fleet_id, bus_id):
+    return "__".join(urllib.parse.quote(str(p), safe="") for p in (fleet_id, bus_id))
+
+def run_fleet_audit(fleet_id, summaries, model, ai_rules, bucket=None, workers=AUDIT_WORKERS, progress=None, sleep=time.sleep):
+    """Audita los buses de `summaries` ({bus: resumen}) y guarda cada informe en `ai_reports`.
+
+    Los buses cuyo informe ya está hecho para el mismo modelo, reglas e historial se saltan.
+    Devuelve {"total", "done", "errors", "skipped"}.
+    """
+    col = REFS["data"].collection("ai_reports")
+    previos = {s.id: s.to_dict() for s in col.where("fleetId", "==", fleet_id).stream()}
+    audit_id = datetime.now().strftime("%Y%m%d%H%M%S")
+    pendientes = {}
+    for bus, summary in summaries.items():
+        content_hash = ai_cache_key(model.model_name, ai_rules, bus, summary)
+        previo = previos.get(_report_id(fleet_id, bus)) or {}
+        if previo.get("status") == "done" and previo.get("content_hash") == content_hash:
+            continue
+        pendientes[bus] = (summary, content_hash)
+
+    buses = list(pendientes)
+    for i in range(0, len(buses), 500):
+        batch = db.batch()
+        for bus in buses[i:i + 500]:
+            batch.set(col.document(_report_id(fleet_id, bus)), {
+                "fleetId": fleet_id, "bus": str(bus), "audit_id": audit_id, "status": "pending",
+                "content_hash": pendientes[bus][1], "model": model.model_name, "updated_at": firestore.SERVER_TIMESTAMP,
+            })
+        batch.commit()
+    bump_fleet_cache(fleet_id, "ai_reports")
+
+    result = {"total": len(buses), "done": 0, "errors": 0, "skipped": len(summaries) - len(buses)}
+    if progress: progress(dict(result))
+    lock = threading.Lock()
+    bucket = bucket or TokenBucket(AUDIT_RPM / 60, AUDIT_BURST)
+
+    def work(bus):
+        summary, _ = pendientes[bus]
+        ref = col.document(_report_id(fleet_id, bus))
+        try:
+            report = call_with_backoff(lambda: analyze_bus(model, fleet_id, bus, summary, ai_rules, before_call=bucket.acquire), sleep=sleep)
+            ref.update({"status": "done", "report": report, "error": firestore.DELETE_FIELD, "updated_at": firestore.SERVER_TIMESTAMP})
+            key = "done"
+        except Exception as e:
+            ref.update({"status": "error", "error": str(e), "updated_at": firestore.SERVER_TIMESTAMP})
+            key = "errors"
+        bump_fleet_cache(fleet_id, "ai_reports")
+        with lock:
+            result[key] += 1
+            if progress: progress(dict(result))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(work, buses))
+    return result
+
+@st.cache_resource
+def _audit_registry():
+    """Auditorías en curso por flota (en este proceso) con su avance."""
+    return {"lock": threading.Lock(), "fleets": {}}
+
+def start_fleet_audit(fleet_id, summaries, model, ai_rules):
+    """Lanza la auditoría en segundo plano; False si esa flota ya tiene una en curso."""
+    registry = _audit_registry()
+    with registry["lock"]:
+        actual = registry["fleets"].get(fleet_id)
+        if actual and actual["thread"].is_alive():
+            return False
+        estado = {"total": len(summaries), "done": 0, "errors": 0, "skipped": 0, "running": True, "error": None}
+
+        def avance(parcial):
+            estado.update(parcial)
+
+        def ejecutar():
+            try:
+                estado.update(run_fleet_audit(fleet_id, summaries, model, ai_rules, progress=avance))
+            except Exception as e:
+                estado["error"] = str(e)
+            finally:
+                estado["running"] = False
+
+        estado["thread"] = threading.Thread(target=ejecutar, name=f"audit-{fleet_id}", daemon=True)
+        registry["fleets"][fleet_id] = estado
+        estado["thread"].start()
+    return True
+
+def audit_progress(fleet_id):
+    estado = _audit_registry()["fleets"].get(fleet_id)
+    return {k: v for k, v in estado.items() if k != "thread"} if estado else None
+
+# --- 2.4 ÍNDICE BM25 DE LA BITÁCORA (CONTEXTO DEL CHAT) ---
+# Índice invertido por flota sobre observaciones, categoría, proveedores y bus. Se arma
+# una vez por proceso y luego solo recibe los logs cambiados (delta por `updated_at` y
+# lápidas, o lo que empuja la escucha de 3.5). El chat manda al modelo los registros más
+# parecidos a la pregunta dentro de un presupuesto de tokens, no la bitácora entera.
+BM25_K1, BM25_B = 1.2, 0.75
+BM25_FIELDS = ('bus', 'date', 'category', 'observations', 'mec_name', 'com_name', 'km_current', 'mec_cost', 'com_cost', 'updated_at')
+BM25_STOPWORDS = frozenset("a al como con cual cuales cuando cuanto cuanta cuantos de del el en es esta este la las le lo los me mi mis para por que se su sus un una y o".split())
+CHAT_CONTEXT_TOP_K = 15
+CHAT_CONTEXT_TOKENS = 1200   # aproximado: 4 caracteres por token
+CHAT_STATUS_TOKENS = 800
+
+def bm25_tokens(text):
+    """Minúsculas, sin tildes ni palabras vacías; los números sin ceros a la izquierda ("05" = "5")."""
+    text = unicodedata.normalize("NFKD", str(text or "").lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return [t.lstrip("0") or "0" if t.isdigit() else t for t in re.findall(r"\w+", text) if t not in BM25_STOPWORDS]
+
+def _bm25_text(log):
+    return " ".join(str(log.get(f) or "") for f in ('category', 'observations', 'mec_name', 'com_name')) + f" bus {log.get('bus', '')}"
+
+class BM25Index:
+    """Índice BM25 en memoria que se actualiza documento a documento."""
+    def __init__(self):
+        self.postings, self.lengths, self.records = {}, {}, {}
+        self.total_len = 0
+
+    def remove(self, doc_id):
+        if doc_id not in self.lengths: return
+        for term in set(bm25_tokens(_bm25_text(self.records[doc_id]))):
+            docs = self.postings.get(term, {})
+            docs.pop(doc_id, None)
+            if not docs: self.postings.pop(term, None)
+        self.total_len -= self.lengths.pop(doc_id)
+        del self.records[doc_id]
+
+    def add(self, doc_id, log):
+        self.remove(doc_id)
+        terms = bm25_tokens(_bm25_text(log))
+        for term, tf in Counter(terms).items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        self.lengths[doc_id] = len(terms)
+        self.total_len += len(terms)
+        self.records[doc_id] = log
+
+    def search(self, query, k=CHAT_CONTEXT_TOP_K, bus=None):
+        """[(puntaje, registro)] de los `k` logs más relevantes (opcionalmente de un solo bus)."""
+        n = len(self.lengths)
+        if not n: return []
+        avg_len = self.total_len / n or 1
+        scores = {}
+        for term in set(bm25_tokens(query)):
+            docs = self.postings.get(term)
+            if not docs: continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_id, tf in docs.items():
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc_id] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0) + idf * tf * (BM25_K1 + 1) / norm
+        if bus is not None:
+            scores = {i: sc for i, sc in scores.items() if str(self.records[i].get('bus')) == str(bus)}
+        # A igual puntaje gana el registro más reciente
+        top = sorted(scores, key=lambda i: (scores[i], str(self.records[i].get('date', ''))), reverse=True)[:k]
+        return [(scores[i], self.records[i]) for i in top]
+
+    def latest(self, k=CHAT_CONTEXT_TOP_K, bus=None):
+        rows = [r for r in self.records.values() if bus is None or str(r.get('bus')) == str(bus)]
+        return sorted(rows, key=lambda r: str(r.get('date', '')), reverse=True)[:k]
+
+@st.cache_resource
+def _bm25_indexes():
+    """Índices por flota, compartidos por todas las sesiones del proceso."""
+    return {"lock": threading.Lock(), "fleets": {}}
+
+def bm25_push(fleet_id, upserts, removed):
+    """Aplica al índice de la flota (si existe) los logs que llegaron por la escucha."""
+    entry = _bm25_indexes()["fleets"].get(fleet_id)
+    if entry is None: return
+    with entry["lock"]:
+        if entry["index"] is None: return
+        for d in upserts:
+            entry["index"].add(d["id"], {f: d.get(f) for f in BM25_FIELDS} | {"id": d["id"]})
+        for log_id in removed:
+            entry["index"].remove(log_id)
+        entry["watermark"] = _max_updated(upserts, entry["watermark"])
+
+def fleet_log_index(fleet_id):
+    """Índice BM25 de toda la bitácora de la flota, al día con Firestore."""
+    store = _bm25_indexes()
+    with store["lock"]:
+        entry = store["fleets"].setdefault(fleet_id, {"lock": threading.Lock(), "index": None, "watermark": None, "listener": None})
+    with entry["lock"]:
+        token = fleet_listener_token(fleet_id)
+        if entry["index"] is None:
+            started = datetime.now(timezone.utc)
+            index = BM25Index()
+            for l in _log_query(fleet_id).select(list(BM25_FIELDS)).stream():
+                index.add(l.id, l.to_dict() | {"id": l.id})
+            entry["index"] = index
+            entry["watermark"] = _max_updated(index.records.values()) or started - timedelta(minutes=1)
+        elif token is None or entry["listener"] != token:
+            since = entry["watermark"] - LOG_SYNC_OVERLAP
+            changed = [l.to_dict() | {"id": l.id} for l in _log_query(fleet_id).where("updated_at", ">=", since).select(list(BM25_FIELDS)).stream()]
+            for d in changed:
+                entry["index"].add(d["id"], d)
+            tombstones = [t.to_dict() | {"id": t.id} for t in REFS["data"].collection("deleted_logs").where("fleetId", "==", fleet_id).where("updated_at", ">=", since).stream()]
+            for t in tombstones:
+                entry["index"].remove(t["id"])
+            entry["watermark"] = _max_updated(changed + tombstones, entry["watermark"])
+        entry["listener"] = token
+        return entry["index"]
+
+def _budget_lines(lines, tokens):
+    """Toma líneas en orden hasta agotar el presupuesto (aprox. 4 caracteres por token)."""
+    out, used = [], 0
+    for line in lines:
+        used += len(line) // 4 + 1
+        if used > tokens and out: break
+        out.append(line)
+    return out
+
+def chat_log_context(fleet_id, question, bus=None, k=CHAT_CONTEXT_TOP_K, tokens=CHAT_CONTEXT_TOKENS):
+    """Registros de la bitácora relevantes para la pregunta, listos para el prompt, y sus pares (bus, categoría)."""
+    index = fleet_log_index(fleet_id)
+    hits = [r for _, r in index.search(question, k, bus)] or index.latest(k, bus)
+    lines = []
+    for r in hits:
+        costo = float(r.get('mec_cost') or 0) + float(r.get('com_cost') or 0)
+        proveedores = " / ".join(p for p in (r.get('mec_name'), r.get('com_name')) if p)
+        obs = " ".join(str(r.get('observations') or '').split())[:300]
+        lines.append(f"- {str(r.get('date', ''))[:10]} | Bus {r.get('bus')} | {r.get('category')} | KM {float(r.get('km_current') or 0):,.0f} | Costo ${costo:,.2f}"
+                     + (f" | {proveedores}" if proveedores else "") + (f" | {obs}" if obs else ""))
+    lines = _budget_lines(lines, tokens)
+    return "\n".join(lines) or "No hay registros.", {(str(r.get('bus')), r.get('category')) for r in hits[:len(lines)]}
+
 # --- 3. CAPA DE DATOS ---
 @st.cache_resource
 def get_db_client():
+    kind = APP_CONFIG.get("STORAGE", "firestore")
+    # Backends locales con la misma interfaz que el cliente de Firestore (sin proyecto de Firebase)
+    if kind != "firestore":
+        return storage.open_client(kind, APP_CONFIG["STORAGE_PATH"])
     try:
         if not firebase_admin._apps:
             if "FIREBASE_JSON" in st.secrets:
@@ -118,7 +785,8 @@ def get_db_client():
         st.error(f"Error de conexión DB: {e}")
         return None
 
-db = get_db_client()
+_client = get_db_client()
+db = CountingProxy(_client) if _client else None
 
 def get_refs():
     if db:
@@ -130,35 +798,1703 @@ def get_refs():
 
 REFS = get_refs()
 
-@st.cache_data(ttl=300)
-def fetch_fleet_data(fleet_id: str, role: str, bus_id: str, start_d: date, end_d: date):
-    if not REFS: return [], pd.DataFrame()
+def run_transaction(fn):
+    """Ejecuta fn(transaction) de forma atómica; Firestore la reintenta si otro escritor tocó lo que leyó."""
+    proxy = db.transaction()
+    raw = _unwrap(proxy)
+
+    def attempt(_):
+        if isinstance(proxy, CountingProxy): proxy._pending = [0, 0]   # un reintento no cobra dos veces
+        return fn(proxy)
+    result = raw.run(attempt) if isinstance(raw, storage.Transaction) else firestore.transactional(attempt)(raw)
+    if isinstance(proxy, CountingProxy): proxy._count_commit(None, (), {})
+    return result
+
+# --- Caché por flota con generaciones ---
+# Cada escritura sube el contador de (flota, dataset) que modifica; las lecturas
+# guardadas con un contador viejo dejan de servirse. Así una carga de combustible
+# solo invalida la bitácora de esa flota, no la caché de todo el servidor.
+# Los DataFrame guardados se comparten entre sesiones: cada llamada recibe una vista
+# superficial con Copy-on-Write, así que una página que agrega o modifica columnas
+# copia solo esas columnas y la memoria crece con las flotas, no con las sesiones.
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)  # desde pandas 3 siempre está activo
+CACHE_DATASETS = ("logs", "providers", "notifications", "closures", "status", "ai_rules", "ai_reports")
+FLEET_CACHE_MAX_ENTRIES = 512
+
+@st.cache_resource
+def _fleet_cache():
+    return {"lock": threading.Lock(), "gens": {}, "entries": OrderedDict(), "stats": {}}
+
+def _shared_view(value):
+    """Lo que recibe quien llama: vistas Copy-on-Write de los DataFrame y copias del resto (listas y dicts chicos)."""
+    if isinstance(value, (pd.DataFrame, pd.Series)): return value.copy(deep=False)
+    if isinstance(value, tuple): return tuple(_shared_view(v) for v in value)
+    return copy.deepcopy(value)
+
+def _cache_stats_row(cache, fleet_id, dataset):
+    return cache["stats"].setdefault((fleet_id, dataset), {"hits": 0, "misses": 0, "invalidations": 0})
+
+def fleet_cached(dataset, ttl=300):
+    """Decorador: cachea el resultado por flota (primer argumento) y generación del dataset."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(fleet_id, *args, **kwargs):
+            cache = _fleet_cache()
+            key = (fn.__name__, fleet_id, args, tuple(sorted(kwargs.items())))
+            with cache["lock"]:
+                gen = cache["gens"].get((fleet_id, dataset), 0)
+                entry = cache["entries"].get(key)
+                stats = _cache_stats_row(cache, fleet_id, dataset)
+                if entry and entry[0] == gen and time.monotonic() - entry[1] < ttl:
+                    cache["entries"].move_to_end(key)
+                    stats["hits"] += 1
+                    return _shared_view(entry[2])
+                stats["misses"] += 1
+            value = fn(fleet_id, *args, **kwargs)
+            with cache["lock"]:
+                # Si alguien escribió mientras leíamos, no guardamos un resultado ya viejo
+                if cache["gens"].get((fleet_id, dataset), 0) == gen:
+                    cache["entries"][key] = (gen, time.monotonic(), value)
+                    cache["entries"].move_to_end(key)
+                    while len(cache["entries"]) > FLEET_CACHE_MAX_ENTRIES:
+                        cache["entries"].popitem(last=False)
+            return _shared_view(value)
+        return wrapper
+    return decorator
+
+def bump_fleet_cache(fleet_id, *datasets):
+    """Invalida solo los datasets indicados de una flota."""
+    cache = _fleet_cache()
+    with cache["lock"]:
+        for ds in datasets:
+            cache["gens"][(fleet_id, ds)] = cache["gens"].get((fleet_id, ds), 0) + 1
+            _cache_stats_row(cache, fleet_id, ds)["invalidations"] += 1
+
+def fleet_cache_stats():
+    cache = _fleet_cache()
+    with cache["lock"]:
+        rows = [{"Flota": f, "Dataset": ds, "Generación": cache["gens"].get((f, ds), 0)} | s for (f, ds), s in cache["stats"].items()]
+    for r in rows:
+        total = r["hits"] + r["misses"]
+        r["hit_rate"] = f"{r['hits'] / total:.0%}" if total else "-"
+    return rows
+
+# Columnas de los logs y su valor por defecto cuando el documento no trae el campo
+LOG_DEFAULTS = {'bus': '0', 'category': '', 'observations': '', 'km_current': 0, 'km_next': 0, 'mec_cost': 0, 'com_cost': 0, 'mec_paid': 0, 'com_paid': 0, 'gallons': 0, 'status': 'completed', 'driver_feedback': ''}
+
+# Esquema de los DataFrame de la bitácora: las columnas con pocos valores distintos van
+# como category, los kilómetros en int32 y los galones en float32. Los montos quedan en
+# float64: vuelven a Firestore como topes y abonos y no deben perder centavos. `date` se guarda en
+# Firestore como Timestamp con la hora local de la flota (sin zona; Firestore la toma
+# como UTC) y se convierte a datetime una sola vez, al entrar a la foto local.
+LOG_SCHEMA = {
+    'bus': 'category', 'category': 'category', 'mec_name': 'category', 'com_name': 'category', 'status': 'category',
+    'km_current': 'int32', 'km_next': 'int32',
+    'mec_cost': 'float64', 'com_cost': 'float64', 'mec_paid': 'float64', 'com_paid': 'float64', 'gallons': 'float32',
+}
+
+def _log_datetime(value):
+    """Fecha de un log como datetime local sin zona; acepta Timestamp de Firestore o el texto ISO de los logs viejos."""
+    if isinstance(value, datetime): return value.replace(tzinfo=None)
+    if isinstance(value, date): return datetime.combine(value, datetime.min.time())
     try:
-        p_docs = REFS["data"].collection("providers").where("fleetId", "==", fleet_id).stream()
-        provs = [p.to_dict() | {"id": p.id} for p in p_docs]
-        
-        dt_start, dt_end = datetime.combine(start_d, datetime.min.time()), datetime.combine(end_d, datetime.max.time())
-        base_query = REFS["data"].collection("logs").where("fleetId", "==", fleet_id)
-        if role == 'driver': base_query = base_query.where("bus", "==", bus_id)
-            
-        query = base_query.where("date", ">=", dt_start.isoformat()).where("date", "<=", dt_end.isoformat())
-        logs = [l.to_dict() | {"id": l.id} for l in query.stream()]
+        return datetime.fromisoformat(str(value)).replace(tzinfo=None)
+    except ValueError:
+        return None
 
-        # --- MEJORA: Añadimos 'status' y 'driver_feedback' a las columnas permitidas ---
-        cols_config = {'bus': '0', 'category': '', 'observations': '', 'km_current': 0, 'km_next': 0, 'mec_cost': 0, 'com_cost': 0, 'mec_paid': 0, 'com_paid': 0, 'gallons': 0, 'status': 'completed', 'driver_feedback': ''}
-        
-        if not logs: return provs, pd.DataFrame(columns=list(cols_config.keys()) + ['date'])
-        
-        df = pd.DataFrame(logs)
-        for col, val in cols_config.items():
-            if col not in df.columns: df[col] = val
-            if isinstance(val, (int, float)): df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-                
-        df['date'] = pd.to_datetime(df['date'], errors='coerce')
-        return provs, df
+def _normalize_log(d):
+    if 'date' in d: d['date'] = _log_datetime(d['date'])
+    return d
+
+# Proyecciones: cada pantalla pide solo los campos que usa. Los campos pesados
+# (texto largo, fotos heredadas) se cargan aparte y solo para las filas visibles.
+LOG_CORE_FIELDS = ('bus', 'date', 'category', 'km_current', 'km_next', 'mec_cost', 'com_cost', 'mec_paid', 'com_paid', 'gallons', 'status')
+LOG_LIST_FIELDS = LOG_CORE_FIELDS + ('mec_name', 'com_name', 'photo_ref', 'photo_thumb')
+LOG_HEAVY_FIELDS = ('observations', 'driver_feedback', 'photo_b64')
+
+@traced
+@fleet_cached("ai_rules", ttl=600)
+def fetch_ai_rules(fleet_id: str):
+    fleet_doc = REFS["fleets"].document(fleet_id).get(field_paths=["ai_rules"])
+    return fleet_doc.to_dict().get("ai_rules", "") if fleet_doc.exists else ""
+
+@traced
+@fleet_cached("ai_reports", ttl=600)
+def fetch_ai_reports(fleet_id: str):
+    return [s.to_dict() for s in REFS["data"].collection("ai_reports").where("fleetId", "==", fleet_id).stream()]
+
+@traced
+@fleet_cached("providers")
+def fetch_providers(fleet_id: str):
+    p_docs = REFS["data"].collection("providers").where("fleetId", "==", fleet_id).stream()
+    return [p.to_dict() | {"id": p.id} for p in p_docs]
+
+@traced
+@fleet_cached("logs")
+def fetch_fleet_logs(fleet_id: str, role: str, bus_id: str, start_d: date, end_d: date, fields: tuple):
+    # Pantallas que no usan la bitácora (directorio, mensajes...) no la descargan
+    if not fields: return pd.DataFrame(columns=['id', 'date'])
+    
+    dt_start, dt_end = datetime.combine(start_d, datetime.min.time()), datetime.combine(end_d, datetime.max.time())
+    logs = _sync_logs(fleet_id, bus_id if role == 'driver' else None, dt_start, dt_end, fields)
+
+    return _logs_frame(logs, fields)
+
+def _logs_frame(logs, fields):
+    """Convierte registros crudos en el DataFrame tipado que usan las pantallas."""
+    if not logs: return pd.DataFrame(columns=list(dict.fromkeys(('id', 'date') + tuple(fields))))
+    
+    df = pd.DataFrame(logs).drop(columns=['updated_at'], errors='ignore')
+    for col in fields:
+        val = LOG_DEFAULTS.get(col)
+        if col not in df.columns: df[col] = val
+        dtype = LOG_SCHEMA.get(col)
+        if dtype == 'category':
+            df[col] = df[col].fillna(val if val is not None else '').astype(str).astype('category')
+        elif dtype or isinstance(val, (int, float)):
+            num = pd.to_numeric(df[col], errors='coerce').fillna(0)
+            df[col] = num.round().astype(dtype) if dtype and dtype.startswith('int') else num.astype(dtype or 'float64')
+
+    # Las fechas ya llegan como datetime (_normalize_log): solo cambia el contenedor
+    df['date'] = pd.to_datetime(df['date'], errors='coerce')
+    return df
+
+@traced
+def fetch_fleet_data(fleet_id: str, role: str, bus_id: str, start_d: date, end_d: date, fields: tuple = LOG_LIST_FIELDS):
+    if not REFS: return [], pd.DataFrame()
+    try:
+        return fetch_providers(fleet_id), fetch_fleet_logs(fleet_id, role, bus_id, start_d, end_d, tuple(fields))
+    except FailedPrecondition as e:
+        report_missing_index(e); return [], pd.DataFrame()
     except Exception as e:
         st.error(f"Error: {e}"); return [], pd.DataFrame()
 
+@traced
+@fleet_cached("logs", ttl=600)
+def fetch_log_fields(fleet_id: str, log_ids: tuple, fields: tuple):
+    """Lee solo `fields` de los logs indicados en una sola llamada por lotes."""
+    if not REFS or not log_ids: return {}
+    refs = [REFS["data"].collection("logs").document(i) for i in log_ids]
+    return {s.id: s.to_dict() for s in db.get_all(refs, field_paths=list(fields)) if s.exists}
+
+@traced
+def hydrate_logs(df, fleet_id, fields=LOG_HEAVY_FIELDS):
+    """Devuelve una copia de `df` con las columnas pesadas cargadas para esas filas."""
+    out = df.copy()
+    data = fetch_log_fields(fleet_id, tuple(out['id']), tuple(fields)) if not out.empty else {}
+    for col in fields:
+        out[col] = [data.get(i, {}).get(col, LOG_DEFAULTS.get(col, "")) for i in out['id']]
+    return out
+
+HIST_PAGE_SIZE = 25
+HIST_MAX_SCAN = 10  # lotes máximos a recorrer para llenar una página cuando hay filtro de costo
+
+@traced
+@fleet_cached("logs", ttl=120)
+def fetch_log_page(fleet_id: str, bus_id: str, start_d: date, end_d: date, filters: tuple, cursor: tuple = None, page_size: int = HIST_PAGE_SIZE):
+    """Una página de la bitácora, de la más reciente a la más antigua, paginada con cursores.
+
+    `filters` = (bus, categoría, proveedor, costo_min, costo_max). Bus, categoría y proveedor van
+    dentro de la consulta; el costo es la suma de dos campos y se filtra sobre cada lote leído.
+    Devuelve (filas, cursor_siguiente); el cursor es (fecha, id) del último registro devuelto y
+    es None cuando no queda otra página (se pide una fila de más para saberlo).
+    """
+    bus, category, provider, cost_min, cost_max = filters
+    dt_start, dt_end = datetime.combine(start_d, datetime.min.time()), datetime.combine(end_d, datetime.max.time())
+    ensure_native_dates(fleet_id)
+
+    def page_query(text):
+        # Las fechas en texto aún sin migrar son las más viejas: se recorren después de las nativas
+        lo, hi = (start_d.isoformat(), dt_end.isoformat()) if text else (dt_start, dt_end)
+        query = _log_query(fleet_id, bus_id or bus).where("date", ">=", lo).where("date", "<=", hi)
+        if category: query = query.where("category", "==", category)
+        if provider:
+            query = query.where(filter=Or([FieldFilter("mec_name", "==", provider), FieldFilter("com_name", "==", provider)]))
+        query = query.order_by("date", direction=firestore.Query.DESCENDING).order_by("__name__", direction=firestore.Query.DESCENDING)
+        return query.select(list(LOG_LIST_FIELDS)).limit(page_size + 1)
+
+    text = bool(cursor) and isinstance(cursor[0], str)
+    query = page_query(text)
+    rows, last = [], cursor
+    for _ in range(HIST_MAX_SCAN):
+        page = query.start_after({"date": cursor[0], "__name__": cursor[1]}).stream() if cursor else query.stream()
+        docs = [(l.id, l.to_dict()) for l in page]
+        for log_id, d in docs:
+            cursor = (d.get("date"), log_id)
+            _normalize_log(d)
+            costo = float(d.get("mec_cost") or 0) + float(d.get("com_cost") or 0)
+            if cost_min <= costo and (cost_max is None or costo <= cost_max):
+                # La fila de más solo confirma que hay otra página: la siguiente arranca tras la última mostrada
+                if len(rows) == page_size:
+                    return rows, last
+                rows.append(d | {"id": log_id})
+                last = cursor
+        if len(docs) <= page_size:
+            if text or native_dates_ready(fleet_id):
+                return rows, None
+            text, query, cursor = True, page_query(True), None
+    return rows, cursor
+
+# Contador de no leídas por (flota, rol): la campana lee un solo documento por rerun
+# y solo consulta `notifications` cuando hay algo pendiente. `version` sube con cada
+# envío o lectura y forma parte de la clave de caché de la lista.
+NOTIF_LINKED_FIELDS = ('bus', 'category', 'observations', 'km_current', 'km_next', 'mec_name', 'mec_cost', 'com_name', 'com_cost')
+
+def _unread_query(fleet_id, role):
+    return REFS["data"].collection("notifications").where("fleetId", "==", fleet_id).where("target_role", "==", role).where("status", "==", "unread")
+
+def _unread_counter(fleet_id, role):
+    return REFS["data"].collection("notification_counters").document(f"{fleet_id}__{role}")
+
+@traced
+def unread_status(fleet_id, role):
+    """(no leídas, versión) con una lectura. Si el contador no existe se arma por agregación."""
+    ref = _unread_counter(fleet_id, role)
+    data = ref.get().to_dict() or {}
+    if not data.get("bootstrapped"):
+        def bootstrap(transaction):
+            # Contador y conteo se leen en la transacción: un envío que llegue en medio toca el
+            # contador y obliga a repetirla, así el valor guardado no pisa ese Increment
+            current = ref.get(transaction=transaction).to_dict() or {}
+            if current.get("bootstrapped"): return current
+            unread = _unread_query(fleet_id, role).count(alias="n").get(transaction=transaction)[0][0].value
+            counter = {"fleetId": fleet_id, "role": role, "unread": unread, "version": int(current.get("version", 0)) + 1, "bootstrapped": True}
+            transaction.set(ref, counter, merge=True)
+            return counter
+        data = run_transaction(bootstrap)
+    return max(0, int(data.get("unread", 0))), int(data.get("version", 0))
+
+@traced
+@fleet_cached("notifications", ttl=60)
+def fetch_unread_notifications(fleet_id: str, role: str, version: int = 0):
+    return [{"id": n.id, **n.to_dict()} for n in _unread_query(fleet_id, role).stream()]
+
+@traced
+@fleet_cached("notifications", ttl=60)
+def fetch_inbox(fleet_id: str, role: str):
+    notifs = REFS["data"].collection("notifications").where("fleetId", "==", fleet_id).where("target_role", "==", role).stream()
+    return [_normalize_log({"id": n.id, **n.to_dict()}) for n in notifs]
+
+@traced
+@fleet_cached("notifications", ttl=60)
+def fetch_outbox(fleet_id: str, sender_id: str):
+    notifs = REFS["data"].collection("notifications").where("fleetId", "==", fleet_id).where("sender", "==", sender_id).stream()
+    return [_normalize_log({"id": n.id, **n.to_dict()}) for n in notifs]
+
+@traced
+def send_notification(data):
+    batch = db.batch()
+    batch.set(REFS["data"].collection("notifications").document(), data)
+    if data.get("status") == "unread":
+        batch.set(_unread_counter(data["fleetId"], data["target_role"]), {"unread": Increment(1), "version": Increment(1)}, merge=True)
+    batch.commit()
+    bump_fleet_cache(data["fleetId"], "notifications")
+
+@traced
+def mark_notification_read(fleet_id, notif_id):
+    ref = REFS["data"].collection("notifications").document(notif_id)
+
+    def apply(transaction):
+        # Solo descuenta si seguía sin leer; como la lectura va en la transacción, un doble clic
+        # o dos pestañas descuentan una sola vez
+        snap = ref.get(field_paths=["status", "target_role"], transaction=transaction)
+        if not snap.exists or snap.get("status") != "unread":
+            return False
+        transaction.update(ref, {"status": "read"})
+        transaction.set(_unread_counter(fleet_id, snap.get("target_role")), {"unread": Increment(-1), "version": Increment(1)}, merge=True)
+        return True
+    if run_transaction(apply):
+        bump_fleet_cache(fleet_id, "notifications")
+
+@traced
+@fleet_cached("closures")
+def fetch_closures(fleet_id: str):
+    closures = REFS["data"].collection("financial_closures").where("fleetId", "==", fleet_id).stream()
+    return [{"id": c.id, **c.to_dict()} for c in closures]
+
+@traced
+def save_closure(data):
+    REFS["data"].collection("financial_closures").add(data)
+    bump_fleet_cache(data["fleetId"], "closures")
+
+# --- Sincronización incremental: segmentos mensuales por flota + marca de agua (updated_at) ---
+# Cada escritura de la bitácora sella `updated_at` con la hora del servidor y cada
+# borrado deja una lápida en `deleted_logs`. La foto local de cada flota se guarda en
+# segmentos de un mes: cualquier rango de fechas se arma con los meses ya cargados y
+# solo se descargan los que faltan (los contiguos en una sola consulta). Los meses
+# pasados no caducan, porque los cambios les llegan por el delta o la escucha; solo el
+# mes en curso se vuelve a leer cada LOG_SNAPSHOT_MAX_AGE. Las vistas de un conductor
+# filtran los segmentos de la flota en vez de lanzar su propia consulta. Los segmentos
+# también se guardan en disco (3.8) para que un reinicio no vuelva a descargarlos.
+LOG_SYNC_OVERLAP = timedelta(seconds=2)
+LOG_SNAPSHOT_MAX_AGE = timedelta(hours=1)
+
+@st.cache_resource
+def _log_snapshots():
+    """Segmentos mensuales de la bitácora por flota, compartidos por todas las sesiones del proceso."""
+    return {"lock": threading.Lock(), "locks": {}, "fleets": {}}
+
+def _log_query(fleet_id, bus_id=None):
+    query = REFS["data"].collection("logs").where("fleetId", "==", fleet_id)
+    return query.where("bus", "==", bus_id) if bus_id else query
+
+def _max_updated(docs, current=None):
+    stamps = [d["updated_at"] for d in docs if d.get("updated_at")]
+    if current: stamps.append(current)
+    return max(stamps) if stamps else None
+
+def _next_month(month):
+    y, m = int(month[:4]), int(month[5:7])
+    return f"{y + m // 12:04d}-{m % 12 + 1:02d}"
+
+def _months_between(dt_start, dt_end):
+    months, month, last = [], dt_start.strftime('%Y-%m'), dt_end.strftime('%Y-%m')
+    while month <= last:
+        months.append(month)
+        month = _next_month(month)
+    return months
+
+def _load_log_segments(fleet_id, months, fields):
+    """Descarga los meses pedidos (una consulta por tramo contiguo): {mes: {id: doc}}."""
+    loaded = {m: {} for m in months}
+    runs = []
+    for m in sorted(months):
+        if runs and _next_month(runs[-1][-1]) == m: runs[-1].append(m)
+        else: runs.append([m])
+    for run in runs:
+        bounds = [(datetime.strptime(run[0], '%Y-%m'), datetime.strptime(_next_month(run[-1]), '%Y-%m'))]
+        # Firestore compara cada tipo por separado: las fechas en texto aún sin migrar van en otra consulta
+        if not native_dates_ready(fleet_id): bounds.append((run[0], _next_month(run[-1])))
+        for lo, hi in bounds:
+            query = _log_query(fleet_id).where("date", ">=", lo).where("date", "<", hi)
+            for l in query.select(list(fields)).stream():
+                d = _normalize_log(l.to_dict() | {"id": l.id})
+                if _month_of(d.get("date")) in loaded: loaded[_month_of(d.get("date"))][l.id] = d
+    return loaded
+
+def _place_log(fleet, d):
+    """Deja un log en el segmento de su mes (si está cargado) y lo quita de los demás."""
+    d = _normalize_log(dict(d))
+    month = _month_of(d.get("date"))
+    for m, seg in fleet["segments"].items():
+        if m == month:
+            seg["docs"][d["id"]] = {f: d[f] for f in seg["fields"] if f in d} | {"id": d["id"]}
+        else:
+            seg["docs"].pop(d["id"], None)
+
+def _new_fleet_snapshot(watermark, disk=None):
+    # disk: meses que siguen en el Parquet de la flota (3.8); moved: cambios que deben ganarle a esas filas;
+    # reconciled_at: último delta aplicado, hasta donde están al día los meses que se leen del disco
+    return {"segments": {}, "watermark": watermark, "disk": disk, "moved": {}, "dirty": False, "saved_at": None,
+            "reconciled_at": None}
+
+def _apply_log_changes(fleet, upserts, removed):
+    """Aplica altas/ediciones y borrados a los segmentos, incluidos los meses que aún están en disco."""
+    for d in upserts:
+        month = _month_of(d.get("date"))
+        if fleet["disk"]:
+            fleet["moved"][d["id"]] = month
+            if month in fleet["disk"]["months"]: fleet["segments"][month] = _disk_segment(fleet, month)
+        # El solape del delta repite logs ya aplicados: solo lo que cambia obliga a reescribir el disco
+        before = [seg["docs"].get(d["id"]) for seg in fleet["segments"].values()]
+        _place_log(fleet, d)
+        if before != [seg["docs"].get(d["id"]) for seg in fleet["segments"].values()]: fleet["dirty"] = True
+    for log_id in removed:
+        if fleet["disk"]: fleet["moved"][log_id] = None
+        for seg in fleet["segments"].values():
+            if seg["docs"].pop(log_id, None) is not None: fleet["dirty"] = True
+
+def _apply_log_delta(fleet, fleet_id):
+    started, since = datetime.now(timezone.utc), fleet["watermark"] - LOG_SYNC_OVERLAP
+    fields = set().union(*(seg["fields"] for seg in fleet["segments"].values()),
+                         *(info["fields"] for info in (fleet["disk"] or {}).get("months", {}).values()))
+    changed = [l.to_dict() | {"id": l.id} for l in _log_query(fleet_id).where("updated_at", ">=", since).select(sorted(fields)).stream()]
+    tombstones = [t.to_dict() | {"id": t.id} for t in REFS["data"].collection("deleted_logs").where("fleetId", "==", fleet_id).where("updated_at", ">=", since).stream()]
+    fleet["reconciled_at"] = started
+    _apply_log_changes(fleet, changed, [t["id"] for t in tombstones])
+    fleet["watermark"] = _max_updated(changed + tombstones, fleet["watermark"])
+
+def _sync_logs(fleet_id, bus_id, dt_start, dt_end, fields):
+    """Logs del rango armados con los segmentos mensuales; solo se piden a Firestore los meses que faltan y los cambios."""
+    store = _log_snapshots()
+    fields = tuple(dict.fromkeys(tuple(fields) + ("bus", "date", "updated_at")))
+    # La migración corre aparte; hasta que termine, los segmentos se piden en ambos formatos
+    ensure_native_dates(fleet_id)
+    with store["lock"]:
+        lock = store["locks"].setdefault(fleet_id, threading.Lock())
+    with lock:
+        fleet = store["fleets"].get(fleet_id)
+        if fleet is None:
+            # Proceso recién arrancado: se sirve la foto en disco (3.8) y se reconcilia con el delta
+            fleet = _open_disk_snapshot(fleet_id)
+            if fleet is not None: store["fleets"][fleet_id] = fleet
+        # Con una escucha activa (3.5) los segmentos ya reciben los cambios: basta un delta al engancharse
+        token = fleet_listener_token(fleet_id)
+        if fleet is not None and (token is None or fleet.get("listener") != token):
+            _apply_log_delta(fleet, fleet_id)
+
+        now, current = datetime.now(timezone.utc), datetime.now().strftime('%Y-%m')
+        segments = fleet["segments"] if fleet else {}
+        for m in _months_between(dt_start, dt_end):
+            if fleet and fleet["disk"] and m in fleet["disk"]["months"] and m not in segments:
+                segments[m] = _disk_segment(fleet, m)
+        missing = [m for m in _months_between(dt_start, dt_end) if m not in segments
+                   or not set(fields) <= segments[m]["fields"]
+                   or m >= current and now - segments[m]["loaded_at"] > LOG_SNAPSHOT_MAX_AGE]
+        if missing:
+            # Se conservan los campos que ya pedían otras páginas para no recargar al volver a ellas
+            load_fields = set(fields).union(*(segments[m]["fields"] for m in missing if m in segments))
+            loaded = _load_log_segments(fleet_id, missing, sorted(load_fields))
+            if fleet is None:
+                # Sin sellos previos usamos el reloj local con un margen amplio: aplicar un cambio dos veces no hace daño
+                docs = [d for month_docs in loaded.values() for d in month_docs.values()]
+                fleet = store["fleets"][fleet_id] = _new_fleet_snapshot(_max_updated(docs) or now - timedelta(minutes=1))
+            for m, docs in loaded.items():
+                fleet["segments"][m] = {"docs": docs, "fields": load_fields, "loaded_at": now}
+            fleet["dirty"] = True
+        fleet["listener"] = token
+        # Lo descargado de Firestore se guarda pronto; los cambios sueltos, como mucho cada LOG_DISK_SAVE_EVERY.
+        # El guardado va en segundo plano: el render no espera a que se reescriba el Parquet
+        if fleet["dirty"] and (missing or not fleet["saved_at"] or now - fleet["saved_at"] > LOG_DISK_SAVE_EVERY):
+            schedule_disk_save(fleet_id, fleet, lock)
+
+        rows = [dict(d) for m in _months_between(dt_start, dt_end) for d in fleet["segments"][m]["docs"].values()
+                if d.get("date") and dt_start <= d["date"] <= dt_end and (bus_id is None or str(d.get("bus")) == str(bus_id))]
+    return sorted(rows, key=lambda d: d["date"])
+
+# --- Escritura de la bitácora (todas las altas, ediciones y borrados pasan por aquí) ---
+# Las operaciones masivas (3.4) escriben en lotes y reconstruyen las proyecciones al final.
+@traced
+def add_log(data):
+    data = _normalize_log(dict(data))
+    ref = REFS["data"].collection("logs").document()
+    doc = data | {"updated_at": firestore.SERVER_TIMESTAMP}
+    batch = db.batch()
+    batch.set(ref, doc)
+    stats_write(batch, data["fleetId"], _stats_delta(doc))
+    rollup_write(batch, data["fleetId"], _rollup_delta(data))
+    batch.commit()
+    bump_fleet_cache(data["fleetId"], "logs")
+    invalidate_ai_cache(data["fleetId"], data.get("bus", "0"))
+    project_status_add(data["fleetId"], ref.id, data)
+    return ref.id
+
+@traced
+def update_log(fleet_id, log_id, changes):
+    changes = _normalize_log(dict(changes))
+    ref = REFS["data"].collection("logs").document(log_id)
+
+    def apply(transaction):
+        # Una sola lectura con los campos que cambian: sirve para las estadísticas y el estado.
+        # Va en la transacción: dos ediciones a la vez no calculan su diferencia sobre el mismo `old`
+        snap = ref.get(field_paths=sorted(set(changes) | set(STATS_FIELDS) | set(ROLLUP_FIELDS)), transaction=transaction)
+        old = snap.to_dict() or {}
+        transaction.update(ref, changes | {"updated_at": firestore.SERVER_TIMESTAMP})
+        stats_write(transaction, fleet_id, _stats_delta(old, -1), _stats_delta(old | changes))
+        if snap.exists:
+            rollup_write(transaction, fleet_id, _rollup_delta(old, -1), _rollup_delta(_apply_changes(old, changes)))
+        return snap, old
+    snap, old = run_transaction(apply)
+    bump_fleet_cache(fleet_id, "logs")
+    old_bus = str(old.get("bus", "0"))
+    invalidate_ai_cache(fleet_id, old_bus, changes.get("bus", old_bus))
+    if snap.exists and set(changes) & set(STATUS_FIELDS):
+        for bus in {old_bus, str(changes.get("bus", old_bus))}:
+            rebuild_maintenance_status(fleet_id, bus)
+
+@traced
+def delete_log(fleet_id, log_id):
+    ref = REFS["data"].collection("logs").document(log_id)
+
+    def apply(transaction):
+        # Dos borrados a la vez: solo el que todavía ve el log lo descuenta
+        old = ref.get(transaction=transaction)
+        transaction.delete(ref)
+        transaction.set(REFS["data"].collection("deleted_logs").document(log_id), {"fleetId": fleet_id, "updated_at": firestore.SERVER_TIMESTAMP})
+        if old.exists:
+            stats_write(transaction, fleet_id, _stats_delta(old.to_dict(), -1))
+            rollup_write(transaction, fleet_id, _rollup_delta(old.to_dict(), -1))
+        return old
+    old = run_transaction(apply)
+    bump_fleet_cache(fleet_id, "logs")
+    if old.exists:
+        bus = str(old.to_dict().get("bus", "0"))
+        invalidate_ai_cache(fleet_id, bus)
+        rebuild_maintenance_status(fleet_id, bus)
+
+# --- 3.1 ALMACÉN DE FOTOS (DIRECCIONADO POR CONTENIDO) ---
+# Las fotos ya no viajan dentro de cada log: se guardan una sola vez bajo su hash
+# SHA-256 y el log solo conserva la referencia y el hash de la miniatura.
+PHOTO_MAX_SIDE = 1280
+PHOTO_THUMB_SIDE = 256
+PHOTO_QUALITY = 70
+PHOTO_THUMB_QUALITY = 60
+
+class FirestorePhotoStore:
+    """Fotos como documentos binarios en la colección `photos` (id = hash)."""
+    def __init__(self, collection):
+        self.col = collection
+
+    def put(self, key, data):
+        ref = self.col.document(key)
+        if ref.get(field_paths=["size"]).exists:
+            return False
+        ref.set({"data": data, "size": len(data), "content_type": "image/jpeg", "created": datetime.now()})
+        return True
+
+    def get(self, key):
+        snap = self.col.document(key).get()
+        return snap.to_dict().get("data") if snap.exists else None
+
+class LocalPhotoStore:
+    """Fotos en disco local, repartidas en subcarpetas por prefijo del hash."""
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + ".jpg")
+
+    def put(self, key, data):
+        path = self._path(key)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+        return True
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as fh:
+                return fh.read()
+        except FileNotFoundError:
+            return None
+
+class BucketPhotoStore:
+    """Fotos en el bucket de Cloud Storage del proyecto Firebase (prefijo photos/)."""
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def put(self, key, data):
+        blob = self.bucket.blob(f"photos/{key}.jpg")
+        if blob.exists():
+            return False
+        blob.upload_from_string(data, content_type="image/jpeg")
+        return True
+
+    def get(self, key):
+        blob = self.bucket.blob(f"photos/{key}.jpg")
+        return blob.download_as_bytes() if blob.exists() else None
+
+@st.cache_resource
+def get_photo_store():
+    kind = APP_CONFIG.get("PHOTO_STORE", "firestore")
+    if kind == "local":
+        return LocalPhotoStore(APP_CONFIG["PHOTO_DIR"])
+    if kind == "bucket":
+        from firebase_admin import storage
+        return BucketPhotoStore(storage.bucket())
+    if not REFS:
+        return None
+    return FirestorePhotoStore(REFS["data"].collection("photos"))
+
+def _encode_jpeg(img, side, quality):
+    img = img.copy()
+    img.thumbnail((side, side), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buf.getvalue()
+
+def process_photo(raw_bytes):
+    """Corrige la orientación, redimensiona y recomprime. Devuelve (foto, miniatura) en JPEG."""
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(raw_bytes))).convert("RGB")
+    return _encode_jpeg(img, PHOTO_MAX_SIDE, PHOTO_QUALITY), _encode_jpeg(img, PHOTO_THUMB_SIDE, PHOTO_THUMB_QUALITY)
+
+def store_photo(raw_bytes):
+    """Guarda la captura en el almacén y devuelve los campos que se anexan al log."""
+    store = get_photo_store()
+    if not store or not raw_bytes:
+        return {}
+    full, thumb = process_photo(raw_bytes)
+    key, thumb_key = hashlib.sha256(full).hexdigest(), hashlib.sha256(thumb).hexdigest()
+    store.put(key, full)
+    store.put(thumb_key, thumb)
+    return {"photo_ref": key, "photo_thumb": thumb_key, "photo_size": len(full)}
+
+@traced
+@st.cache_data(max_entries=128, show_spinner=False)
+def load_photo(key):
+    # El contenido de un hash nunca cambia, por eso no necesita TTL
+    store = get_photo_store()
+    return store.get(key) if store and key else None
+
+def migrate_photos(page_size=50):
+    """Comando: mueve los `photo_b64` heredados de los logs al almacén de fotos."""
+    if not REFS:
+        print("Sin conexión a la base de datos."); return
+    # Se recorre por id de documento: photo_b64 no está indexado (ver firestore_indexes) y
+    # ordenar por un texto de ~1 MB empata en el prefijo indexado y salta registros
+    query = REFS["data"].collection("logs").order_by("__name__").select(["fleetId", "photo_b64"])
+    migrated = failed = 0
+    cursor = None
+    while True:
+        page_query = query.limit(page_size)
+        if cursor is not None:
+            page_query = page_query.start_after(cursor)
+        page = list(page_query.stream())
+        if not page:
+            break
+        seen = migrated + failed
+        for snap in page:
+            data = snap.to_dict()
+            if not data.get("photo_b64"):
+                continue
+            try:
+                fields = store_photo(base64.b64decode(data["photo_b64"]))
+                update_log(data.get("fleetId"), snap.id, fields | {"photo_b64": firestore.DELETE_FIELD})
+                migrated += 1
+            except Exception as e:
+                failed += 1
+                print(f"  ⚠️ {snap.id}: {e}")
+        cursor = page[-1]
+        if migrated + failed > seen:
+            print(f"Migradas {migrated} fotos ({failed} con error)...")
+    print(f"✅ Migración terminada: {migrated} fotos movidas, {failed} con error.")
+
+# --- 3.2 ESTADO DE MANTENIMIENTO (PROYECCIÓN POR FLOTA) ---
+# `maintenance_status` guarda por (bus, categoría) una fila con el último registro y
+# otra con el último mantenimiento programado (km_next > 0), más una fila de odómetro
+# por bus con el KM máximo reportado. Las escrituras de la bitácora la mantienen al
+# día, así el radar y el estado de unidades leen O(buses × categorías) documentos sin
+# importar el historial ni el rango de fechas.
+STATUS_FIELDS = ('bus', 'category', 'date', 'km_current', 'km_next')
+
+def _status_id(fleet_id, bus, category=None, kind="category"):
+    parts = [fleet_id, bus] if category is None else [fleet_id, bus, "cat" if kind == "category" else "plan", category]
+    return "__".join(urllib.parse.quote(str(p), safe="") for p in parts)
+
+def _num(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _status_row(fleet_id, log_id, data, kind="category"):
+    return {
+        "fleetId": fleet_id, "kind": kind, "bus": str(data.get('bus', '0')), "category": str(data.get('category', '')),
+        "date": data.get('date', ''), "km_current": _num(data.get('km_current')), "km_next": _num(data.get('km_next')),
+        "log_id": log_id, "updated_at": firestore.SERVER_TIMESTAMP
+    }
+
+def _status_kinds(data):
+    """Filas de categoría que le tocan a un log: siempre la del último registro y, si programa uno, la del próximo."""
+    return ("category", "scheduled") if _num(data.get('km_next')) > 0 else ("category",)
+
+def _odometer_row(fleet_id, bus, km):
+    return {"fleetId": fleet_id, "kind": "odometer", "bus": str(bus), "km_current": km, "updated_at": firestore.SERVER_TIMESTAMP}
+
+def project_status_add(fleet_id, log_id, data):
+    """Aplica un log nuevo a la proyección en una transacción: lee sus filas y solo pisa las más viejas."""
+    col = REFS["data"].collection("maintenance_status")
+    bus, cat = str(data.get('bus', '0')), str(data.get('category', ''))
+    refs = {kind: col.document(_status_id(fleet_id, bus, cat, kind)) for kind in _status_kinds(data)} if cat else {}
+    when = _log_datetime(data.get('date')) or datetime.min
+
+    def apply(transaction):
+        # Todas las lecturas antes de la primera escritura, como pide Firestore
+        current = {kind: ref.get(field_paths=["date"], transaction=transaction) for kind, ref in refs.items()}
+        for kind, snap in current.items():
+            # Un log importado con fecha vieja no pisa un mantenimiento más reciente
+            if not snap.exists or (_log_datetime((snap.to_dict() or {}).get("date")) or datetime.min) <= when:
+                transaction.set(refs[kind], _status_row(fleet_id, log_id, data, kind))
+        transaction.set(col.document(_status_id(fleet_id, bus)), _odometer_row(fleet_id, bus, firestore.Maximum(_num(data.get('km_current')))), merge=True)
+    run_transaction(apply)
+    bump_fleet_cache(fleet_id, "status")
+
+def rebuild_maintenance_status(fleet_id, bus=None):
+    """Recalcula la proyección de una flota (o de un solo bus) desde la bitácora."""
+    logs = [l.to_dict() | {"id": l.id} for l in _log_query(fleet_id, bus).select(list(STATUS_FIELDS)).stream()]
+    rows = {}
+    for l in sorted(logs, key=lambda d: _log_datetime(d.get('date')) or datetime.min):
+        b = str(l.get('bus', '0'))
+        odo = rows.setdefault(_status_id(fleet_id, b), _odometer_row(fleet_id, b, 0.0))
+        odo["km_current"] = max(odo["km_current"], _num(l.get('km_current')))
+        if l.get('category'):
+            for kind in _status_kinds(l):
+                rows[_status_id(fleet_id, b, l['category'], kind)] = _status_row(fleet_id, l['id'], l, kind)
+
+    col = REFS["data"].collection("maintenance_status")
+    existing = col.where("fleetId", "==", fleet_id)
+    if bus is not None: existing = existing.where("bus", "==", str(bus))
+    stale = [s.id for s in existing.select(["kind"]).stream() if s.id not in rows]
+
+    ops = [(col.document(k), v) for k, v in rows.items()] + [(col.document(k), None) for k in stale]
+    for i in range(0, len(ops), 500):
+        batch = db.batch()
+        for ref, row in ops[i:i + 500]:
+            if row is None: batch.delete(ref)
+            else: batch.set(ref, row)
+        batch.commit()
+    if ops: bump_fleet_cache(fleet_id, "status")
+    return len(rows)
+
+@traced
+@fleet_cached("status")
+def fetch_maintenance_status(fleet_id: str):
+    query = REFS["data"].collection("maintenance_status").where("fleetId", "==", fleet_id)
+    docs = [s.to_dict() for s in query.stream()]
+    # Flotas anteriores a la proyección (o a sus filas de programados): se construye una sola vez desde la bitácora
+    scheduled = any(d.get('kind') == 'scheduled' for d in docs)
+    if (not docs or not scheduled and any(d.get('kind') == 'category' and _num(d.get('km_next')) > 0 for d in docs)) \
+            and rebuild_maintenance_status(fleet_id):
+        docs = [s.to_dict() for s in query.stream()]
+    df = pd.DataFrame([_normalize_log(d) for d in docs], columns=['kind', 'bus', 'category', 'date', 'km_current', 'km_next', 'log_id'])
+    for col in ('km_current', 'km_next'):
+        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+    df['date'] = pd.to_datetime(df['date'], errors='coerce')
+    return df
+
+@traced
+def maintenance_status_for(user, scheduled=False):
+    """(KM actual por bus, último registro por bus y categoría) visibles para el usuario;
+    con `scheduled`, el último registro que programó un próximo mantenimiento."""
+    df = fetch_maintenance_status(user['fleet'])
+    if user['role'] == 'driver':
+        df = df[df['bus'] == user.get('bus', '0')]
+    odometros = df[df['kind'] == 'odometer'].set_index('bus')['km_current']
+    return odometros, df[df['kind'] == ('scheduled' if scheduled else 'category')]
+
+def rebuild_status_command(fleet_id=None):
+    """Comando: reconstruye `maintenance_status` (todas las flotas o la indicada)."""
+    if not REFS:
+        print("Sin conexión a la base de datos."); return
+    fleets = [fleet_id] if fleet_id else [f.id for f in REFS["fleets"].stream()]
+    for f in fleets:
+        print(f"{f}: {rebuild_maintenance_status(f)} filas de estado")
+
+# --- 3.3 ESTADÍSTICAS POR FLOTA (PANEL MAESTRO) ---
+# `fleet_stats/{flota}` acumula contadores con Increment en el mismo lote que cada
+# escritura de la bitácora. El panel maestro lee los documentos de cada flota en vez de
+# recorrer todos los logs; las flotas sin documento usan consultas de agregación. Cada
+# escritura de la bitácora toca este documento igual que los acumulados (3.7), así que
+# usa los mismos fragmentos (`rollup_shards` de la flota) y al leer se suman todos.
+STATS_FIELDS = ('bus', 'mec_cost', 'com_cost', 'photo_size')
+STATS_IN_LIMIT = 30   # valores máximos de un filtro "in" de Firestore
+
+def _stats_id(fleet_id, shard=0):
+    # El fragmento 0 conserva el id de siempre: las flotas sin fragmentar no cambian de documento
+    return fleet_id if not shard else f"{fleet_id}__{shard}"
+
+def _value_bytes(value):
+    """Tamaño aproximado de un valor según las reglas de almacenamiento de Firestore."""
+    if value is firestore.DELETE_FIELD: return 0
+    if isinstance(value, str): return len(value.encode("utf-8")) + 1
+    if isinstance(value, bytes): return len(value)
+    if isinstance(value, dict): return sum(len(str(k)) + 1 + _value_bytes(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)): return sum(_value_bytes(v) for v in value)
+    if value is None or isinstance(value, bool): return 1
+    return 8  # números, fechas y transformaciones numéricas (Increment, SERVER_TIMESTAMP...)
+
+def _stats_delta(data, sign=1):
+    """Lo que un log aporta (sign=1) o retira (sign=-1) a las estadísticas de su flota."""
+    return {
+        "logs": sign, "bus": str(data.get('bus', '0')),
+        "spend": sign * (_num(data.get('mec_cost')) + _num(data.get('com_cost'))),
+        "bytes": sign * (_value_bytes(data) + int(_num(data.get('photo_size')))),
+    }
+
+def stats_write(batch, fleet_id, *deltas):
+    """Agrega al lote la actualización de `fleet_stats` con la suma de los deltas (un fragmento al azar)."""
+    buses = {}
+    for d in deltas:
+        buses[d["bus"]] = buses.get(d["bus"], 0) + d["logs"]
+    shard = random.randrange(fleet_rollup_shards(fleet_id))
+    batch.set(REFS["data"].collection("fleet_stats").document(_stats_id(fleet_id, shard)), {
+        "fleetId": fleet_id, "shard": shard,
+        "log_count": Increment(sum(d["logs"] for d in deltas)),
+        "total_spend": Increment(sum(d["spend"] for d in deltas)),
+        "storage_bytes": Increment(sum(d["bytes"] for d in deltas)),
+        "buses": {b: Increment(n) for b, n in buses.items() if n},
+        "last_activity": firestore.SERVER_TIMESTAMP,
+    }, merge=True)
+
+def rebuild_fleet_stats(fleet_id):
+    """Recalcula `fleet_stats` de una flota leyendo toda su bitácora."""
+    stats = {"fleetId": fleet_id, "log_count": 0, "total_spend": 0.0, "storage_bytes": 0, "buses": {}, "last_activity": None}
+    for l in _log_query(fleet_id).stream():
+        d = _stats_delta(l.to_dict())
+        stats["log_count"] += 1
+        stats["total_spend"] += d["spend"]
+        stats["storage_bytes"] += d["bytes"]
+        stats["buses"][d["bus"]] = stats["buses"].get(d["bus"], 0) + 1
+        if l.update_time and (stats["last_activity"] is None or l.update_time > stats["last_activity"]):
+            stats["last_activity"] = l.update_time
+    col = REFS["data"].collection("fleet_stats")
+    batch = db.batch()
+    batch.set(col.document(_stats_id(fleet_id)), stats | {"shard": 0, "rebuilt_at": firestore.SERVER_TIMESTAMP})
+    # Todo queda en el fragmento 0: los demás se borran en el mismo lote
+    for s in col.where("fleetId", "==", fleet_id).select(["shard"]).stream():
+        if s.id != _stats_id(fleet_id): batch.delete(s.reference)
+    batch.commit()
+    return stats
+
+def _stats_merge(acc, d):
+    """Suma un fragmento de `fleet_stats` al total de su flota."""
+    acc["log_count"] = acc.get("log_count", 0) + int(d.get("log_count", 0))
+    acc["total_spend"] = acc.get("total_spend", 0.0) + float(d.get("total_spend", 0))
+    acc["storage_bytes"] = acc.get("storage_bytes", 0) + int(d.get("storage_bytes", 0))
+    buses = acc.setdefault("buses", {})
+    for b, n in (d.get("buses") or {}).items():
+        buses[b] = buses.get(b, 0) + n
+    stamps = [t for t in (acc.get("last_activity"), d.get("last_activity")) if t]
+    acc["last_activity"] = max(stamps) if stamps else None
+    return acc
+
+@traced
+def fetch_fleet_stats(fleet_ids):
+    """Estadísticas de varias flotas: una lectura por lotes y agregaciones solo para las que faltan."""
+    col, fleet_ids = REFS["data"].collection("fleet_stats"), list(fleet_ids)
+    found = {}
+    # Una consulta por cada STATS_IN_LIMIT flotas trae todos sus fragmentos
+    for i in range(0, len(fleet_ids), STATS_IN_LIMIT):
+        for s in col.where("fleetId", "in", fleet_ids[i:i + STATS_IN_LIMIT]).stream():
+            d = s.to_dict()
+            _stats_merge(found.setdefault(d["fleetId"], {}), d)
+    out = {}
+    for f in fleet_ids:
+        if f in found:
+            d = found[f]
+            out[f] = {
+                "buses": sum(1 for n in (d.get("buses") or {}).values() if n > 0), "logs": int(d.get("log_count", 0)),
+                "spend": float(d.get("total_spend", 0)), "bytes": int(d.get("storage_bytes", 0)),
+                "last_activity": d.get("last_activity"), "approx": False,
+            }
+            continue
+        # Flota sin documento todavía: conteos por agregación (sin descargar los logs)
+        agg = _log_query(f).count(alias="logs").sum("mec_cost", alias="mec").sum("com_cost", alias="com").get()
+        vals = {r.alias: r.value for r in agg[0]}
+        buses = REFS["data"].collection("maintenance_status").where("fleetId", "==", f).where("kind", "==", "odometer").count(alias="n").get()
+        out[f] = {
+            "buses": int(buses[0][0].value), "logs": int(vals.get("logs", 0)),
+            "spend": float(vals.get("mec") or 0) + float(vals.get("com") or 0), "bytes": None,
+            "last_activity": None, "approx": True,
+        }
+    return out
+
+def rebuild_stats_command(fleet_id=None):
+    """Comando: reconstruye `fleet_stats` (todas las flotas o la indicada)."""
+    if not REFS:
+        print("Sin conexión a la base de datos."); return
+    fleets = [fleet_id] if fleet_id else [f.id for f in REFS["fleets"].stream()]
+    for f in fleets:
+        stats = rebuild_fleet_stats(f)
+        print(f"{f}: {stats['log_count']} logs, {len(stats['buses'])} unidades, ${stats['total_spend']:,.2f}")
+
+# --- 3.4 OPERACIONES MASIVAS (LOTES DE 500, REANUDABLES) ---
+# Renombrar, borrar y transferir una unidad se ejecutan como un trabajo en `bulk_jobs`:
+# los logs se recorren por id de documento, se escriben en lotes de 500 operaciones que
+# se confirman en paralelo y, tras cada página, se guarda el último id como punto de
+# control. Si el script se interrumpe, el mismo trabajo se retoma desde ahí; todas las
+# escrituras son idempotentes (las transferencias usan ids determinísticos).
+BULK_CHUNK = 500
+BULK_WORKERS = 4
+BULK_LEASE = timedelta(minutes=2)   # un trabajo sin avances en este tiempo se da por interrumpido
+
+def _bulk_job_id(fleet_id, kind, bus, params):
+    firma = "|".join([fleet_id, kind, str(bus)] + [f"{k}={params[k]}" for k in sorted(params)])
+    return f"{fleet_id}__{kind}__{hashlib.sha256(firma.encode('utf-8')).hexdigest()[:16]}"
+
+def _bulk_ops(job, snap):
+    """Escrituras que le corresponden a un log según el tipo de trabajo: [(acción, ref, datos)]."""
+    p = job["params"]
+    if job["kind"] == "rename":
+        return [("update", snap.reference, {"bus": p["new"], "updated_at": firestore.SERVER_TIMESTAMP})]
+    if job["kind"] == "delete":
+        tombstone = REFS["data"].collection("deleted_logs").document(snap.id)
+        return [("delete", snap.reference, None), ("set", tombstone, {"fleetId": job["fleetId"], "updated_at": firestore.SERVER_TIMESTAMP})]
+    if job["kind"] == "transfer":
+        data = snap.to_dict()
+        data |= {
+            "fleetId": p["target"], "transferred_from": snap.id, "updated_at": firestore.SERVER_TIMESTAMP,
+            "observations": f"{data.get('observations') or ''} (Importado de {job['fleetId']})",
+        }
+        return [("set", REFS["data"].collection("logs").document(f"{p['target']}__{snap.id}"), data)]
+    if job["kind"] == "dates":
+        value = (snap.to_dict() or {}).get("date")
+        if not isinstance(value, str): return []
+        # Sin tocar `updated_at`: el contenido no cambia y las fotos locales ya leen ambos formatos
+        return [("update", snap.reference, {"date": _log_datetime(value)})]
+    raise ValueError(f"Tipo de trabajo desconocido: {job['kind']}")
+
+def _commit_ops(ops):
+    batch = db.batch()
+    for action, ref, data in ops:
+        if action == "delete": batch.delete(ref)
+        elif action == "update": batch.update(ref, data)
+        else: batch.set(ref, data)
+    batch.commit()
+
+def start_bulk_job(fleet_id, kind, bus, rebuild, **params):
+    """Registra un trabajo masivo (o devuelve el mismo si quedó a medias) y devuelve su id."""
+    job_id = _bulk_job_id(fleet_id, kind, bus, params)
+    ref = REFS["data"].collection("bulk_jobs").document(job_id)
+    snap = ref.get()
+    if snap.exists and snap.get("status") == "running":
+        return job_id
+    total = _log_query(fleet_id, bus).count(alias="n").get()[0][0].value
+    ref.set({
+        "fleetId": fleet_id, "kind": kind, "bus": bus, "params": params, "status": "running",
+        "checkpoint": None, "done": 0, "total": int(total),
+        "rebuild": [{"fleet": f, "bus": b} for f, b in rebuild],
+        "started_at": firestore.SERVER_TIMESTAMP, "updated_at": firestore.SERVER_TIMESTAMP,
+    })
+    return job_id
+
+def run_bulk_job(job_id, progress=None):
+    """Ejecuta (o retoma) un trabajo masivo; `progress(hechos, total)` se llama tras cada página."""
+    ref = REFS["data"].collection("bulk_jobs").document(job_id)
+    job = ref.get().to_dict()
+    if job["status"] == "done":
+        return job
+
+    query = _log_query(job["fleetId"], job["bus"]).order_by("__name__")
+    if job["kind"] != "transfer": query = query.select(["bus", "date"])
+    ops_per_log = 2 if job["kind"] == "delete" else 1
+    page_size = BULK_CHUNK * BULK_WORKERS // ops_per_log
+
+    with ThreadPoolExecutor(max_workers=BULK_WORKERS) as pool:
+        while True:
+            page_query = query.limit(page_size)
+            if job["checkpoint"]: page_query = page_query.start_after({"__name__": job["checkpoint"]})
+            page = list(page_query.stream())
+            if not page: break
+            ops = [op for snap in page for op in _bulk_ops(job, snap)]
+            # list() propaga el error de cualquier lote: el punto de control no avanza
+            list(pool.map(_commit_ops, [ops[i:i + BULK_CHUNK] for i in range(0, len(ops), BULK_CHUNK)]))
+            job["checkpoint"], job["done"] = page[-1].id, job["done"] + len(page)
+            ref.update({"checkpoint": job["checkpoint"], "done": job["done"], "updated_at": firestore.SERVER_TIMESTAMP})
+            if progress: progress(job["done"], job["total"])
+            if len(page) < page_size: break
+
+    # Las proyecciones se reconstruyen una sola vez al final (el sello sigue avisando que hay quien lo corre)
+    if job["rebuild"]: ref.update({"updated_at": firestore.SERVER_TIMESTAMP})
+    for r in job["rebuild"]:
+        rebuild_maintenance_status(r["fleet"], r["bus"])
+        invalidate_ai_cache(r["fleet"], r["bus"])
+    for fleet in {r["fleet"] for r in job["rebuild"]}:
+        ref.update({"updated_at": firestore.SERVER_TIMESTAMP})
+        bump_fleet_cache(fleet, "logs")
+        rebuild_fleet_stats(fleet)
+        rebuild_cost_rollups(fleet)
+    # Tras un corte, los lotes ya confirmados de renombrar/borrar salen de la consulta y no se recuentan
+    job["status"], job["done"] = "done", max(job["done"], job["total"])
+    ref.update({"status": "done", "done": job["done"], "updated_at": firestore.SERVER_TIMESTAMP})
+    return job
+
+DATES_LEASE = timedelta(minutes=2)   # una migración de fechas sin avances en este tiempo se puede retomar
+
+@st.cache_resource
+def _native_dates():
+    """Flotas que este proceso ya comprobó sin fechas en texto y migraciones en curso."""
+    return {"lock": threading.Lock(), "fleets": set(), "running": {}}
+
+def native_dates_ready(fleet_id):
+    """True cuando la bitácora de la flota ya no tiene fechas en texto; mientras tanto se consultan ambos formatos."""
+    return fleet_id in _native_dates()["fleets"]
+
+def ensure_native_dates(fleet_id):
+    """Lanza en segundo plano, una vez por flota y proceso, la migración de las fechas en texto (no la espera)."""
+    state = _native_dates()
+    with state["lock"]:
+        if fleet_id in state["fleets"] or fleet_id in state["running"]: return
+        # Un rango sobre "" solo encuentra valores de texto: los Timestamp quedan fuera
+        if not list(_log_query(fleet_id).where("date", ">=", "").limit(1).stream()):
+            state["fleets"].add(fleet_id)
+            return
+        worker = threading.Thread(target=_migrate_dates, args=(fleet_id, state), name=f"fechas-{fleet_id}", daemon=True)
+        state["running"][fleet_id] = worker
+    worker.start()
+
+def _migrate_dates(fleet_id, state):
+    try:
+        job = REFS["data"].collection("bulk_jobs").document(_bulk_job_id(fleet_id, "dates", None, {})).get()
+        stamp = job.get("updated_at") if job.exists and job.get("status") == "running" else None
+        # Otro proceso la está corriendo: se sigue leyendo en ambos formatos y se vuelve a mirar después
+        if stamp and datetime.now(timezone.utc) - stamp < DATES_LEASE: return
+        # Solo cambia el tipo de `date`: no hay proyecciones que reconstruir
+        run_bulk_job(start_bulk_job(fleet_id, "dates", None, []))
+        with state["lock"]: state["fleets"].add(fleet_id)
+    finally:
+        with state["lock"]: state["running"].pop(fleet_id, None)
+
+def migrate_dates_command(fleet_id=None):
+    """Comando: migra las fechas ISO en texto de la bitácora a Timestamp nativo (todas las flotas o la indicada)."""
+    if not REFS:
+        print("Sin conexión a la base de datos."); return
+    fleets = [fleet_id] if fleet_id else [f.id for f in REFS["fleets"].stream()]
+    for f in fleets:
+        job = run_bulk_job(start_bulk_job(f, "dates", None, []))
+        print(f"{f}: {job['done']} registros revisados")
+    _native_dates()["fleets"].update(fleets)
+
+def pending_bulk_jobs(fleet_id):
+    """Trabajos masivos de la flota sin terminar; `interrupted` si nadie los avanzó en BULK_LEASE.
+
+    La migración de fechas no aparece: corre en segundo plano y ensure_native_dates la retoma sola.
+    """
+    query = REFS["data"].collection("bulk_jobs").where("fleetId", "==", fleet_id).where("status", "==", "running")
+    now, jobs = datetime.now(timezone.utc), []
+    for s in query.stream():
+        job = s.to_dict() | {"id": s.id}
+        if job.get("kind") == "dates": continue
+        job["interrupted"] = not job.get("updated_at") or now - job["updated_at"] >= BULK_LEASE
+        jobs.append(job)
+    return jobs
+
+# --- 3.5 ESCUCHAS EN TIEMPO REAL (on_snapshot) ---
+# Por cada flota con sesiones abiertas el proceso mantiene tres escuchas: notificaciones
+# sin leer, logs modificados desde que arrancó la escucha y lápidas de logs borrados.
+# Los cambios se aplican a las fotos locales de la bitácora y a la lista de no leídas en
+# memoria, así las sesiones se enteran sin volver a consultar Firestore. Cada sesión se
+# registra en cada rerun y se libera al cerrar sesión; las que cierran el navegador sin
+# salir caducan tras LISTENER_IDLE y la última en irse cierra las escuchas.
+LISTENER_IDLE = timedelta(minutes=20)
+NOTIF_REFRESH_SECONDS = 10
+
+@st.cache_resource
+def _listener_hub():
+    """Escuchas activas por flota, compartidas por todas las sesiones del proceso."""
+    return {"lock": threading.Lock(), "fleets": {}}
+
+def _push_log_changes(fleet_id, upserts, removed):
+    """Aplica a los segmentos locales de la flota los logs que llegaron por la escucha."""
+    store = _log_snapshots()
+    with store["lock"]:
+        lock = store["locks"].setdefault(fleet_id, threading.Lock())
+    with lock:
+        fleet = store["fleets"].get(fleet_id)
+        if fleet is not None:
+            _apply_log_changes(fleet, upserts, removed)
+            fleet["watermark"] = _max_updated(upserts, fleet["watermark"])
+    bm25_push(fleet_id, upserts, removed)
+
+def _on_log_snapshot(fleet_id, entry, changes, tombstones=False):
+    upserts, removed = [], []
+    for change in changes:
+        doc = change.document
+        if tombstones:
+            if change.type.name != "REMOVED": removed.append(doc.id)
+        elif change.type.name == "REMOVED":
+            removed.append(doc.id)
+        else:
+            upserts.append(doc.to_dict() | {"id": doc.id})
+    if upserts or removed:
+        _push_log_changes(fleet_id, upserts, removed)
+        bump_fleet_cache(fleet_id, "logs", "status")
+    # La primera entrega de cada escucha es el estado inicial, no un cambio nuevo
+    key = "tomb_primed" if tombstones else "logs_primed"
+    if entry[key]:
+        entry["log_events"] += len(upserts) + len(removed)
+    entry[key] = True
+
+def _on_unread_snapshot(fleet_id, entry, docs):
+    entry["notifs"] = {d.id: d.to_dict() | {"id": d.id} for d in docs}
+    bump_fleet_cache(fleet_id, "notifications")
+
+def _start_fleet_listeners(fleet_id):
+    started = datetime.now(timezone.utc)
+    entry = {"token": uuid.uuid4().hex, "sessions": {}, "notifs": None, "log_events": 0,
+             "logs_primed": False, "tomb_primed": False, "watches": []}
+    since = started - LOG_SYNC_OVERLAP
+    unread = REFS["data"].collection("notifications").where("fleetId", "==", fleet_id).where("status", "==", "unread")
+    tombs = REFS["data"].collection("deleted_logs").where("fleetId", "==", fleet_id).where("updated_at", ">=", since)
+    entry["watches"] = [
+        unread.on_snapshot(lambda docs, changes, read_time: _on_unread_snapshot(fleet_id, entry, docs)),
+        _log_query(fleet_id).where("updated_at", ">=", since).on_snapshot(lambda docs, changes, read_time: _on_log_snapshot(fleet_id, entry, changes)),
+        tombs.on_snapshot(lambda docs, changes, read_time: _on_log_snapshot(fleet_id, entry, changes, tombstones=True)),
+    ]
+    return entry
+
+def _stop_fleet_listeners(entry):
+    for watch in entry["watches"]:
+        try: watch.unsubscribe()
+        except Exception: pass
+
+def _listener_alive(entry):
+    return entry is not None and all(getattr(w, "is_active", True) for w in entry["watches"])
+
+def touch_fleet_listener(fleet_id, session_id):
+    """Registra la sesión en la escucha de su flota (arrancándola si hace falta) y caduca las inactivas."""
+    if not REFS or not APP_CONFIG.get("REALTIME"): return
+    hub, now = _listener_hub(), time.monotonic()
+    with hub["lock"]:
+        entry, sessions = hub["fleets"].get(fleet_id), {}
+        if entry is not None and not _listener_alive(entry):
+            # La escucha se cayó: se reabre conservando las sesiones registradas
+            _stop_fleet_listeners(entry)
+            sessions, entry = hub["fleets"].pop(fleet_id)["sessions"], None
+        if entry is None:
+            try:
+                entry = hub["fleets"][fleet_id] = _start_fleet_listeners(fleet_id)
+                entry["sessions"].update(sessions)
+            except Exception as e:
+                print(f"⚠️ No se pudo abrir la escucha de {fleet_id}: {e}")
+                return
+        entry["sessions"][session_id] = now
+        for fid, e in list(hub["fleets"].items()):
+            e["sessions"] = {sid: seen for sid, seen in e["sessions"].items() if now - seen < LISTENER_IDLE.total_seconds()}
+            if not e["sessions"]:
+                _stop_fleet_listeners(hub["fleets"].pop(fid))
+
+def release_fleet_listener(fleet_id, session_id):
+    """La sesión sale; si era la última de la flota se cierran sus escuchas."""
+    hub = _listener_hub()
+    with hub["lock"]:
+        entry = hub["fleets"].get(fleet_id)
+        if entry is None: return
+        entry["sessions"].pop(session_id, None)
+        if not entry["sessions"]:
+            _stop_fleet_listeners(hub["fleets"].pop(fleet_id))
+
+def fleet_listener_token(fleet_id):
+    """Identificador de la escucha viva de la flota (None si no hay)."""
+    entry = _listener_hub()["fleets"].get(fleet_id)
+    return entry["token"] if _listener_alive(entry) else None
+
+def fleet_log_events(fleet_id):
+    entry = _listener_hub()["fleets"].get(fleet_id)
+    return entry["log_events"] if entry else 0
+
+def live_unread_notifications(fleet_id, role):
+    """No leídas del rol desde la memoria de la escucha, o None si la flota no tiene escucha viva."""
+    entry = _listener_hub()["fleets"].get(fleet_id)
+    if not _listener_alive(entry) or entry["notifs"] is None:
+        return None
+    return sorted((dict(n) for n in entry["notifs"].values() if n.get("target_role") == role), key=lambda n: str(n.get("date", "")))
+
+# --- 3.6 CATÁLOGO DE CONSULTAS E ÍNDICES COMPUESTOS ---
+# Cada consulta con más de un campo que lanza la app está declarada aquí. Firestore resuelve
+# solas las igualdades (combina índices de un campo), pero una igualdad junto a un rango o un
+# orden sobre otro campo necesita un índice compuesto; si falta, la consulta falla en
+# producción con FailedPrecondition. `python app.py export-indexes` genera
+# firestore.indexes.json a partir del catálogo y `python app.py check-indexes` repite cada
+# consulta contra el backend configurado (o el emulador con FIRESTORE_EMULATOR_HOST).
+#   equals: igualdades fijas · optional: igualdades que la app añade según los filtros
+#   any_of: Or opcional de igualdades (Firestore indexa cada rama por separado)
+#   range: campo con >=/<=/> · order: (campo, dirección) · samples: valores de prueba propios
+QUERY_CATALOG = {
+    "logs_segmentos_mes": {"collection": "logs", "equals": ("fleetId",), "range": "date",
+                           "used_by": "_load_log_segments"},
+    "logs_pagina_historial": {"collection": "logs", "equals": ("fleetId",), "optional": ("bus", "category"),
+                              "any_of": ("mec_name", "com_name"), "range": "date", "order": ("date", "DESCENDING"),
+                              "used_by": "fetch_log_page"},
+    "logs_modificados": {"collection": "logs", "equals": ("fleetId",), "range": "updated_at",
+                         "used_by": "fetch_fleet_logs (delta), fleet_log_index, escucha de logs"},
+    "logs_flota": {"collection": "logs", "equals": ("fleetId",), "optional": ("bus",), "order": ("__name__", "ASCENDING"),
+                   "used_by": "operaciones masivas, reconstrucciones y agregaciones"},
+    "logs_fotos_heredadas": {"collection": "logs", "order": ("__name__", "ASCENDING"), "used_by": "migrate_photos"},
+    "lapidas_modificadas": {"collection": "deleted_logs", "equals": ("fleetId",), "range": "updated_at",
+                            "used_by": "fetch_fleet_logs (delta), fleet_log_index, escucha de lápidas"},
+    "notificaciones_no_leidas": {"collection": "notifications", "equals": ("fleetId", "target_role", "status"),
+                                 "used_by": "fetch_unread_notifications"},
+    "notificaciones_no_leidas_flota": {"collection": "notifications", "equals": ("fleetId", "status"),
+                                       "used_by": "escucha de no leídas"},
+    "notificaciones_bandeja": {"collection": "notifications", "equals": ("fleetId", "target_role"),
+                               "used_by": "fetch_inbox"},
+    "notificaciones_enviadas": {"collection": "notifications", "equals": ("fleetId", "sender"),
+                                "used_by": "fetch_outbox"},
+    "cierres_caja": {"collection": "financial_closures", "equals": ("fleetId",), "used_by": "fetch_closures"},
+    "proveedores": {"collection": "providers", "equals": ("fleetId",), "used_by": "fetch_providers"},
+    "informes_ia": {"collection": "ai_reports", "equals": ("fleetId",), "used_by": "fetch_ai_reports"},
+    "estado_mantenimiento": {"collection": "maintenance_status", "equals": ("fleetId",), "optional": ("bus",),
+                             "used_by": "fetch_maintenance_status, rebuild_maintenance_status"},
+    "estadisticas_flotas": {"collection": "fleet_stats", "equals": ("fleetId",),
+                            "used_by": "fetch_fleet_stats (con \"in\"), rebuild_fleet_stats"},
+    "estado_odometros": {"collection": "maintenance_status", "equals": ("fleetId", "kind"),
+                         "samples": {"kind": "odometer"}, "used_by": "fetch_fleet_stats (conteo)"},
+    "acumulados_costos": {"collection": "cost_rollups", "equals": ("fleetId",), "range": "month",
+                          "used_by": "fetch_cost_rollups"},
+    "trabajos_masivos_pendientes": {"collection": "bulk_jobs", "equals": ("fleetId", "status"),
+                                    "samples": {"status": "running"}, "used_by": "pending_bulk_jobs"},
+}
+INDEXES_FILE = "firestore.indexes.json"
+
+def query_variants(name):
+    """Formas concretas de una consulta del catálogo: una por combinación de filtros opcionales y rama del Or."""
+    spec = QUERY_CATALOG[name]
+    optional, branches = spec.get("optional", ()), [()] + [(f,) for f in spec.get("any_of", ())]
+    variants = []
+    for n in range(len(optional) + 1):
+        for extra in itertools.combinations(optional, n):
+            for branch in branches:
+                variants.append({"name": name, "collection": spec["collection"], "equals": spec.get("equals", ()) + extra + branch,
+                                 "range": spec.get("range"), "order": spec.get("order")})
+    return variants
+
+def required_index(variant):
+    """Campos del índice compuesto que necesita la variante, o None si bastan los de un campo."""
+    tail = []
+    if variant["range"]:
+        tail.append((variant["range"], "ASCENDING"))
+    if variant["order"] and variant["order"][0] != "__name__":
+        tail = [variant["order"]] + [t for t in tail if t[0] != variant["order"][0]]
+    # Solo igualdades (con o sin orden por id), o un único campo de rango/orden: índices simples
+    if not tail or not variant["equals"] and len(tail) == 1:
+        return None
+    return tuple((f, "ASCENDING") for f in variant["equals"]) + tuple(tail)
+
+def firestore_indexes():
+    """Contenido de firestore.indexes.json con los índices compuestos que pide el catálogo."""
+    indexes, seen = [], set()
+    for name in QUERY_CATALOG:
+        for variant in query_variants(name):
+            fields = required_index(variant)
+            if fields and (variant["collection"], fields) not in seen:
+                seen.add((variant["collection"], fields))
+                indexes.append({"collectionGroup": variant["collection"], "queryScope": "COLLECTION",
+                                "fields": [{"fieldPath": f, "order": o} for f, o in fields]})
+    # photo_b64 guarda hasta ~1 MB de texto y ninguna consulta filtra por él: fuera de los índices
+    overrides = [{"collectionGroup": "logs", "fieldPath": "photo_b64", "indexes": []}]
+    return {"indexes": indexes, "fieldOverrides": overrides}
+
+def export_indexes_command(path=INDEXES_FILE):
+    """Comando: escribe firestore.indexes.json (luego: firebase deploy --only firestore:indexes)."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(firestore_indexes(), f, indent=2, ensure_ascii=False)
+        f.write("\n")
+    print(f"{path}: {len(firestore_indexes()['indexes'])} índices compuestos")
+
+def _declared_indexes(path=INDEXES_FILE):
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return set()
+    return {(i["collectionGroup"], tuple((x["fieldPath"], x.get("order", "ASCENDING")) for x in i["fields"])) for i in data.get("indexes", [])}
+
+def _sample_values(fleet_id):
+    """Valores reales de la flota para repetir las consultas (bus y proveedor existentes)."""
+    status = [s.to_dict() for s in REFS["data"].collection("maintenance_status").where("fleetId", "==", fleet_id).limit(1).stream()]
+    provs = fetch_providers(fleet_id)
+    provider = provs[0]["name"] if provs else "-"
+    return {"fleetId": fleet_id, "bus": status[0].get("bus", "01") if status else "01", "category": "Combustible",
+            "target_role": "owner", "status": "unread", "sender": "owner", "mec_name": provider, "com_name": provider,
+            "date": datetime.now() - timedelta(days=90), "updated_at": datetime.now(timezone.utc) - timedelta(days=1),
+            "month": (date.today() - timedelta(days=365)).strftime('%Y-%m')}
+
+def build_catalog_query(variant, values):
+    """Arma la consulta de una variante del catálogo con los valores de prueba."""
+    values = values | QUERY_CATALOG[variant["name"]].get("samples", {})
+    query = REFS["data"].collection(variant["collection"])
+    for field in variant["equals"]:
+        query = query.where(filter=FieldFilter(field, "==", values[field]))
+    if variant["range"]:
+        query = query.where(filter=FieldFilter(variant["range"], ">=", values[variant["range"]]))
+    if variant["order"]:
+        query = query.order_by(*variant["order"])
+    return query
+
+def _explain(query):
+    """(leídos, devueltos) de la consulta; leídos es None si el backend no lo informa."""
+    raw = _unwrap(query)
+    if hasattr(raw, "explain_stats"):
+        return raw.explain_stats()
+    from google.cloud.firestore_v1.query_profile import ExplainOptions, QueryExplainError
+    results = raw.stream(explain_options=ExplainOptions(analyze=True))
+    returned = sum(1 for _ in results)
+    try:
+        stats = results.get_explain_metrics().execution_stats
+    except QueryExplainError:
+        return None, returned
+    scanned = stats.debug_stats.get("documents_scanned")
+    return (int(scanned) if scanned is not None else None), stats.results_returned
+
+def check_indexes_command(fleet_id=None):
+    """Comando: repite cada consulta del catálogo e informa índices faltantes y documentos leídos/devueltos.
+
+    El emulador de Firestore no exige índices compuestos, así que además de los errores
+    FailedPrecondition se compara cada variante con lo declarado en firestore.indexes.json.
+    """
+    if not REFS:
+        print("Sin conexión a la base de datos."); return
+    fleet_id = fleet_id or next((f.id for f in REFS["fleets"].limit(1).stream()), None)
+    if not fleet_id:
+        print("No hay flotas registradas."); return
+    declared, values, missing = _declared_indexes(), _sample_values(fleet_id), 0
+    destino = os.environ.get("FIRESTORE_EMULATOR_HOST") or APP_CONFIG["STORAGE"]
+    print(f"Flota {fleet_id} · backend {destino} · índices declarados: {len(declared)}")
+    for name in QUERY_CATALOG:
+        for variant in query_variants(name):
+            label = f'{variant["collection"]}: ' + " + ".join(variant["equals"] + ((variant["range"],) if variant["range"] else ()))
+            fields = required_index(variant)
+            estado = "ok" if fields is None or (variant["collection"], fields) in declared else "SIN ÍNDICE DECLARADO"
+            try:
+                scanned, returned = _explain(build_catalog_query(variant, values))
+            except FailedPrecondition as e:
+                scanned, returned, estado = None, 0, f"SIN ÍNDICE ({e.message.split('.')[0]})"
+            if estado != "ok": missing += 1
+            ratio = f"{scanned}/{returned} ({scanned / max(returned, 1):.1f}x)" if scanned is not None else f"?/{returned}"
+            print(f"  {estado:<22} {name:<32} {label:<56} leídos/devueltos {ratio}")
+    print("Todas las consultas tienen índice." if not missing else f"{missing} consultas sin índice: python app.py export-indexes y despliega el archivo.")
+
+@st.cache_resource
+def _missing_index_log():
+    """Consultas que fallaron por falta de índice en este proceso (para el panel maestro)."""
+    return deque(maxlen=50)
+
+def report_missing_index(error):
+    """Avisa en pantalla de un índice compuesto faltante y guarda el enlace de creación de la consola."""
+    link = re.search(r"https://console\.firebase\.google\.com\S+", str(error))
+    _missing_index_log().append((datetime.now().strftime("%d/%m %H:%M"), link.group(0) if link else str(error)))
+    st.error("⚠️ Esta consulta necesita un índice de Firestore que aún no está creado. "
+             "El administrador debe desplegar firestore.indexes.json (python app.py export-indexes).")
+
+def run_page(render):
+    """Dibuja la página elegida; un índice faltante deja el aviso en vez de romper la sesión."""
+    try:
+        render()
+    except FailedPrecondition as e:
+        report_missing_index(e)
+
+# --- 3.7 ACUMULADOS MENSUALES DE COSTOS (CIERRE DE CAJA) ---
+# `cost_rollups/{flota}__{mes}__{fragmento}` suma por mes y por bus los costos, abonos,
+# combustible y cantidad de registros. Cada alta, edición, abono y borrado de la bitácora
+# agrega su diferencia con Increment en el mismo lote, así el cierre de caja y el resumen
+# de 12 meses leen un documento por mes en vez de la bitácora. Las flotas con mucho
+# movimiento reparten las escrituras en varios fragmentos (`rollup_shards` en el registro
+# de la flota) para no saturar un solo documento; al leer se suman todos. Una flota
+# anterior a los acumulados los construye en un hilo aparte (o con `rebuild-rollups`);
+# mientras tanto sus meses se suman desde los segmentos de la bitácora.
+ROLLUP_FIELDS = ('bus', 'date', 'category', 'mec_cost', 'com_cost', 'mec_paid', 'com_paid', 'gallons')
+ROLLUP_METRICS = ('logs', 'mec_cost', 'com_cost', 'mec_paid', 'com_paid', 'fuel_gallons', 'fuel_cost')
+ROLLUP_MAX_SHARDS = 10
+
+def _rollup_id(fleet_id, month=None, shard=0):
+    """Id de un fragmento mensual; sin mes, el marcador de que la flota ya tiene acumulados."""
+    fleet = urllib.parse.quote(str(fleet_id), safe="")
+    return fleet if month is None else f"{fleet}__{month}__{shard}"
+
+def _month_of(value):
+    if isinstance(value, (datetime, date)): return value.strftime('%Y-%m')
+    text = str(value or '')
+    return text[:7] if re.match(r"\d{4}-\d{2}", text) else None
+
+def _rollup_delta(data, sign=1):
+    """Lo que un log aporta (sign=1) o retira (sign=-1) al acumulado de su mes y bus."""
+    fuel = data.get('category') == "Combustible"
+    return {
+        "month": _month_of(data.get('date')), "bus": str(data.get('bus', '0')), "logs": sign,
+        "mec_cost": sign * _num(data.get('mec_cost')), "com_cost": sign * _num(data.get('com_cost')),
+        "mec_paid": sign * _num(data.get('mec_paid')), "com_paid": sign * _num(data.get('com_paid')),
+        "fuel_gallons": sign * _num(data.get('gallons')) if fuel else 0.0,
+        "fuel_cost": sign * _num(data.get('com_cost')) if fuel else 0.0,
+    }
+
+def _rollup_add(months, delta):
+    if not delta["month"]: return
+    acc = months.setdefault(delta["month"], {}).setdefault(delta["bus"], dict.fromkeys(ROLLUP_METRICS, 0))
+    for m in ROLLUP_METRICS:
+        acc[m] += delta[m]
+
+def _apply_changes(old, changes):
+    """Cómo queda un log después de `update(changes)`, resolviendo los Increment de los abonos."""
+    return old | {k: _num(old.get(k)) + v.value if isinstance(v, Increment) else v for k, v in changes.items()}
+
+@st.cache_data(ttl=600, show_spinner=False)
+def fleet_rollup_shards(fleet_id):
+    """Cantidad de fragmentos de los acumulados de la flota (1 salvo que el super admin la suba)."""
+    snap = REFS["fleets"].document(fleet_id).get(field_paths=["rollup_shards"])
+    n = (snap.to_dict() or {}).get("rollup_shards") if snap.exists else None
+    return min(max(int(n or 1), 1), ROLLUP_MAX_SHARDS)
+
+def rollup_write(batch, fleet_id, *deltas):
+    """Agrega al lote los Increment de `cost_rollups` (un fragmento al azar por mes)."""
+    months = {}
+    for d in deltas:
+        _rollup_add(months, d)
+    shards = fleet_rollup_shards(fleet_id) if months else 1
+    for month, buses in months.items():
+        buses = {b: {m: Increment(v) for m, v in acc.items() if v} for b, acc in buses.items()}
+        buses = {b: acc for b, acc in buses.items() if acc}
+        if not buses: continue
+        shard = random.randrange(shards)
+        batch.set(REFS["data"].collection("cost_rollups").document(_rollup_id(fleet_id, month, shard)), {
+            "fleetId": fleet_id, "month": month, "shard": shard, "buses": buses, "updated_at": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+
+def rebuild_cost_rollups(fleet_id):
+    """Recalcula `cost_rollups` de una flota desde la bitácora (todo queda en el fragmento 0)."""
+    months = {}
+    for l in _log_query(fleet_id).select(list(ROLLUP_FIELDS)).stream():
+        _rollup_add(months, _rollup_delta(l.to_dict()))
+    rows = {_rollup_id(fleet_id, m, 0): {"fleetId": fleet_id, "month": m, "shard": 0, "buses": buses, "updated_at": firestore.SERVER_TIMESTAMP}
+            for m, buses in months.items()}
+    rows[_rollup_id(fleet_id)] = {"fleetId": fleet_id, "rebuilt_at": firestore.SERVER_TIMESTAMP}
+
+    col = REFS["data"].collection("cost_rollups")
+    stale = [s.id for s in col.where("fleetId", "==", fleet_id).select(["shard"]).stream() if s.id not in rows]
+    ops = [(col.document(k), v) for k, v in rows.items()] + [(col.document(k), None) for k in stale]
+    for i in range(0, len(ops), 500):
+        batch = db.batch()
+        for ref, row in ops[i:i + 500]:
+            if row is None: batch.delete(ref)
+            else: batch.set(ref, row)
+        batch.commit()
+    bump_fleet_cache(fleet_id, "logs")
+    return len(months)
+
+@st.cache_resource
+def _rollup_ready():
+    """Flotas que este proceso ya comprobó con el marcador de acumulados y construcciones en curso."""
+    return {"lock": threading.Lock(), "fleets": set(), "running": {}}
+
+def ensure_cost_rollups(fleet_id):
+    """True si la flota ya tiene acumulados; si no, lanza en segundo plano (una vez por proceso) su construcción."""
+    ready = _rollup_ready()
+    if fleet_id in ready["fleets"]: return True
+    with ready["lock"]:
+        if fleet_id in ready["fleets"]: return True
+        if fleet_id in ready["running"]: return False
+        # Solo cuenta el marcador: un alta posterior al despliegue ya crea el fragmento de su mes
+        if REFS["data"].collection("cost_rollups").document(_rollup_id(fleet_id)).get(field_paths=["fleetId"]).exists:
+            ready["fleets"].add(fleet_id)
+            return True
+        worker = threading.Thread(target=_build_cost_rollups, args=(fleet_id, ready), name=f"acumulados-{fleet_id}", daemon=True)
+        ready["running"][fleet_id] = worker
+    worker.start()
+    return False
+
+def _build_cost_rollups(fleet_id, ready):
+    try:
+        # Al terminar sube la generación de "logs": la página deja de servir el cálculo provisorio
+        rebuild_cost_rollups(fleet_id)
+        with ready["lock"]: ready["fleets"].add(fleet_id)
+    finally:
+        with ready["lock"]: ready["running"].pop(fleet_id, None)
+
+def _rollups_from_logs(fleet_id, first_month, last_month):
+    """Acumulados de los meses pedidos sumados desde los segmentos de la bitácora, mientras se construyen los de verdad."""
+    dt_start = datetime.strptime(first_month, '%Y-%m')
+    dt_end = datetime.strptime(_next_month(last_month), '%Y-%m') - timedelta(microseconds=1)
+    months = {}
+    for d in _sync_logs(fleet_id, None, dt_start, dt_end, ROLLUP_FIELDS):
+        _rollup_add(months, _rollup_delta(d))
+    return [{"month": m, "buses": buses} for m, buses in months.items()]
+
+@traced
+@fleet_cached("logs", ttl=600)
+def fetch_cost_rollups(fleet_id: str, first_month: str, last_month: str):
+    """Acumulados por mes y bus entre dos meses (AAAA-MM), con los fragmentos ya sumados."""
+    if ensure_cost_rollups(fleet_id):
+        query = REFS["data"].collection("cost_rollups").where("fleetId", "==", fleet_id).where("month", ">=", first_month).where("month", "<=", last_month)
+        docs = [s.to_dict() for s in query.stream()]
+    else:
+        # La flota todavía no tiene acumulados: solo se leen los meses pedidos, no toda la historia
+        docs = _rollups_from_logs(fleet_id, first_month, last_month)
+    rows = [{"month": d["month"], "bus": b, **{m: _num(acc.get(m)) for m in ROLLUP_METRICS}}
+            for d in docs for b, acc in (d.get("buses") or {}).items()]
+    df = pd.DataFrame(rows, columns=["month", "bus", *ROLLUP_METRICS])
+    return df.groupby(["month", "bus"], as_index=False).sum() if not df.empty else df
+
+def rebuild_rollups_command(fleet_id=None):
+    """Comando: reconstruye `cost_rollups` (todas las flotas o la indicada)."""
+    if not REFS:
+        print("Sin conexión a la base de datos."); return
+    fleets = [fleet_id] if fleet_id else [f.id for f in REFS["fleets"].stream()]
+    for f in fleets:
+        print(f"{f}: {rebuild_cost_rollups(f)} meses acumulados")
+    _rollup_ready()["fleets"].update(fleets)
+
+# --- 3.8 FOTO DE LA BITÁCORA EN DISCO (PARQUET) ---
+# Los segmentos mensuales de cada flota se guardan en un Parquet por flota, con un grupo
+# de filas por mes y, en los metadatos, la marca de agua y los campos de cada mes. Un
+# proceso recién arrancado lee solo el pie del archivo y abre con memory-map los grupos
+# de los meses que pide cada página; luego reconcilia con el delta desde la marca de
+# agua, así el primer render no depende de cuánta historia tenga la flota. Los cambios
+# que llegan para meses que siguen en disco se anotan en `moved` y les ganan a esas
+# filas. El archivo se reescribe en un hilo aparte, uno por flota, que junta las cargas
+# de LOG_DISK_SAVE_DELAY. Si la carpeta pasa de LOG_DISK_MAX_BYTES se borran las fotos de
+# las flotas que el proceso no tiene cargadas, empezando por la que lleva más tiempo sin usarse.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    HAS_PARQUET = True
+except ImportError:
+    HAS_PARQUET = False
+
+LOG_DISK_VERSION = 1
+LOG_DISK_MAX_BYTES = 512 * 1024 * 1024
+LOG_DISK_SAVE_EVERY = timedelta(minutes=5)
+LOG_DISK_SAVE_DELAY = timedelta(seconds=2)   # las cargas seguidas de una misma página se guardan juntas
+
+def _disk_snapshot_path(fleet_id):
+    # La foto es de una flota en un backend concreto: cambiar de base no reutiliza la de otra
+    origen = "|".join([APP_CONFIG["APP_ID"], APP_CONFIG["STORAGE"], APP_CONFIG["STORAGE_PATH"] if APP_CONFIG["STORAGE"] != "firestore" else "", fleet_id])
+    name = hashlib.sha256(origen.encode('utf-8')).hexdigest()[:24]
+    return os.path.join(APP_CONFIG["LOG_SNAPSHOT_DIR"], f"{name}.parquet")
+
+def _disk_type(field):
+    if field == 'date': return pa.timestamp('us')
+    if field == 'updated_at': return pa.timestamp('us', tz='UTC')
+    if LOG_SCHEMA.get(field, 'category') != 'category' or isinstance(LOG_DEFAULTS.get(field), (int, float)):
+        return pa.float64()
+    return pa.string()
+
+def _disk_column(field, values):
+    kind = _disk_type(field)
+    if pa.types.is_floating(kind):
+        return pa.array(pd.to_numeric(pd.Series(values, dtype=object), errors='coerce'), kind, from_pandas=True)
+    if pa.types.is_string(kind):
+        values = [None if v is None else str(v) for v in values]
+    return pa.array(values, kind)
+
+def _disk_month_rows(fleet, month, schema):
+    """Filas de un mes para el Parquet nuevo: copia de las de memoria o el grupo del archivo actual sin las que cambiaron."""
+    seg = fleet["segments"].get(month)
+    if seg is not None: return list(seg["docs"].values())
+    info = fleet["disk"]["months"][month]
+    if info["row_group"] is None: return []
+    table = fleet["disk"]["file"].read_row_group(info["row_group"])
+    if fleet["moved"]:
+        table = table.filter(pa.array([fleet["moved"].get(i, month) == month for i in table.column("id").to_pylist()]))
+    return pa.table({f.name: table.column(f.name) if f.name in table.column_names else pa.nulls(table.num_rows, f.type) for f in schema})
+
+def _disk_month_table(rows, schema):
+    if isinstance(rows, pa.Table): return rows
+    return pa.table({f.name: _disk_column(f.name, [d.get(f.name) for d in rows]) for f in schema})
+
+def _open_disk_snapshot(fleet_id):
+    """Foto de la flota guardada en disco, con solo el pie leído; None si no hay una válida."""
+    if not HAS_PARQUET or not APP_CONFIG.get("LOG_SNAPSHOT_DIR"): return None
+    path = _disk_snapshot_path(fleet_id)
+    try:
+        # El archivo queda abierto: si otro proceso lo reemplaza, este sigue leyendo su versión
+        file = pq.ParquetFile(path, memory_map=True)
+        meta = json.loads(file.schema_arrow.metadata[b"itero"])
+        os.utime(path)   # uso reciente, para el desalojo
+    except (OSError, KeyError, TypeError, ValueError):
+        return None
+    if meta.get("version") != LOG_DISK_VERSION or meta.get("fleet") != fleet_id: return None
+    months = {m: {"row_group": i["row_group"], "fields": set(i["fields"]), "loaded_at": datetime.fromisoformat(i["loaded_at"])}
+              for m, i in meta["months"].items()}
+    return _new_fleet_snapshot(datetime.fromisoformat(meta["watermark"]), {"path": path, "file": file, "months": months} if months else None)
+
+def _disk_segment(fleet, month):
+    """Lee del Parquet solo el grupo de filas del mes y lo devuelve como segmento en memoria."""
+    disk = fleet["disk"]
+    info = disk["months"].pop(month)
+    docs = {}
+    if info["row_group"] is not None:
+        for row in disk["file"].read_row_group(info["row_group"], columns=sorted(info["fields"] | {"id"})).to_pylist():
+            if fleet["moved"].get(row["id"], month) == month:
+                docs[row["id"]] = {k: v for k, v in row.items() if v is not None}
+    if not disk["months"]: fleet["disk"], fleet["moved"] = None, {}
+    # Si el delta ya corrió sobre la foto, el mes está al día desde ese momento y no cuenta como caducado
+    loaded_at = max(info["loaded_at"], fleet["reconciled_at"]) if fleet["reconciled_at"] else info["loaded_at"]
+    return {"docs": docs, "fields": info["fields"], "loaded_at": loaded_at}
+
+def save_disk_snapshot(fleet_id, fleet, lock):
+    """Reescribe de forma atómica el Parquet de la flota: meses en memoria y los que siguen en disco.
+
+    Con el candado de la flota solo se copia el estado (y se leen los grupos que siguen en el
+    archivo abierto); la conversión y la escritura van fuera, sin frenar a las páginas.
+    """
+    if not HAS_PARQUET or not APP_CONFIG.get("LOG_SNAPSHOT_DIR"): return
+    with lock:
+        if not fleet["dirty"]: return
+        infos = {m: dict(info) for m, info in ((fleet["disk"]["months"] if fleet["disk"] else {}) | fleet["segments"]).items()}
+        names = ["id"] + sorted(set().union(*(info["fields"] for info in infos.values())) - {"id"})
+        schema = pa.schema([(f, _disk_type(f)) for f in names])
+        rows = {m: _disk_month_rows(fleet, m, schema) for m in infos}
+        moved, watermark = dict(fleet["moved"]), fleet["watermark"]
+        # Lo que cambie mientras se escribe vuelve a marcar la foto como pendiente
+        fleet["dirty"] = False
+
+    tables, months = [], {}
+    for m in sorted(infos):
+        table = _disk_month_table(rows[m], schema)
+        months[m] = {"row_group": len(tables) if table.num_rows else None, "fields": sorted(infos[m]["fields"]),
+                     "loaded_at": infos[m]["loaded_at"].isoformat()}
+        if table.num_rows: tables.append(table)
+    meta = {"version": LOG_DISK_VERSION, "fleet": fleet_id, "watermark": watermark.isoformat(), "months": months}
+
+    path = _disk_snapshot_path(fleet_id)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(APP_CONFIG["LOG_SNAPSHOT_DIR"], exist_ok=True)
+        with pq.ParquetWriter(tmp, schema.with_metadata({"itero": json.dumps(meta)})) as writer:
+            for table in tables:
+                writer.write_table(table, row_group_size=table.num_rows)
+        os.replace(tmp, path)
+    except OSError:
+        # Sin disco la app sigue con la foto en memoria
+        with contextlib.suppress(OSError): os.remove(tmp)
+        with lock: fleet["dirty"] = True
+        return
+    with lock:
+        fleet["saved_at"] = datetime.now(timezone.utc)
+        if fleet["disk"]:
+            # Los meses que siguen en disco pasan al archivo nuevo, ya sin las filas que cambiaron;
+            # de `moved` solo quedan los cambios que llegaron durante la escritura
+            disk = {"path": path, "file": pq.ParquetFile(path, memory_map=True), "months": {}}
+            for m in fleet["disk"]["months"]:
+                disk["months"][m] = fleet["disk"]["months"][m] | {"row_group": months[m]["row_group"]}
+            fleet["disk"] = disk
+            fleet["moved"] = {k: v for k, v in fleet["moved"].items() if k not in moved or moved[k] != v}
+    _evict_disk_snapshots()
+
+@st.cache_resource
+def _disk_saves():
+    """Guardados pendientes por flota: un solo hilo por flota y las peticiones seguidas se juntan en uno."""
+    return {"lock": threading.Lock(), "pending": {}, "flush": threading.Event()}
+
+def schedule_disk_save(fleet_id, fleet, lock):
+    """Programa el guardado de la foto de la flota a LOG_DISK_SAVE_DELAY; si ya hay uno pendiente, no hace nada."""
+    if not HAS_PARQUET or not APP_CONFIG.get("LOG_SNAPSHOT_DIR"): return
+    saves = _disk_saves()
+    with saves["lock"]:
+        if fleet_id in saves["pending"]: return
+        worker = threading.Thread(target=_run_disk_save, args=(fleet_id, fleet, lock, saves), name=f"foto-{fleet_id}", daemon=True)
+        saves["pending"][fleet_id] = worker
+    worker.start()
+
+def _run_disk_save(fleet_id, fleet, lock, saves):
+    try:
+        saves["flush"].wait(LOG_DISK_SAVE_DELAY.total_seconds())
+        save_disk_snapshot(fleet_id, fleet, lock)
+    finally:
+        with saves["lock"]: saves["pending"].pop(fleet_id, None)
+
+def flush_disk_snapshots():
+    """Adelanta los guardados pendientes y espera a que terminen (al cerrar el proceso o antes de medir un reinicio)."""
+    saves = _disk_saves()
+    with saves["lock"]: workers = list(saves["pending"].values())
+    saves["flush"].set()
+    try:
+        for worker in workers: worker.join()
+    finally:
+        saves["flush"].clear()
+
+def _evict_disk_snapshots():
+    """Deja la carpeta bajo LOG_DISK_MAX_BYTES borrando fotos de flotas no cargadas, la de uso más antiguo primero."""
+    folder = APP_CONFIG["LOG_SNAPSHOT_DIR"]
+    loaded = {_disk_snapshot_path(f) for f in list(_log_snapshots()["fleets"])}
+    files = []
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        with contextlib.suppress(FileNotFoundError):
+            info = os.stat(path)
+            files.append((info.st_mtime, info.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= LOG_DISK_MAX_BYTES: break
+        if path in loaded: continue
+        with contextlib.suppress(FileNotFoundError): os.remove(path)
+        total -= size
+
 # --- 4. UI LOGIN Y SUPER ADMIN ---
 def ui_render_login():
     st.markdown('<div class="main-title">Itero AI</div>', unsafe_allow_html=True)
@@ -253,6 +2589,7 @@ def handle_register(nid, own, pas):
             st.success("✅ Empresa creada."); st.rerun()
         else: st.error("Código en uso.")
 
+@traced
 def render_super_admin():
     if not REFS: return
     st.header("⚙️ Panel de Control Maestro (Super Admin)")
@@ -267,15 +2604,59 @@ def render_super_admin():
             REFS["data"].set({"support_contact": c_msg}, merge=True)
             st.success("✅ ¡Contacto guardado!")
 
+    with st.expander("📈 Caché por Flota (aciertos / fallos)"):
+        stats = fleet_cache_stats()
+        if stats:
+            st.dataframe(pd.DataFrame(stats).sort_values(["Flota", "Dataset"]), use_container_width=True, hide_index=True)
+        else:
+            st.info("La caché aún no registra actividad en este servidor.")
+
+    with st.expander("🤖 Latencia de la IA (segundos)"):
+        resumen_ia = ai_metrics_summary()
+        if not resumen_ia.empty:
+            st.dataframe(resumen_ia, use_container_width=True, hide_index=True)
+        else:
+            st.info("Todavía no hay consultas a la IA en este servidor.")
+
+    with st.expander("📡 Consumo del backend por flota"):
+        tel = telemetry_snapshot()
+        if tel["fleets"]:
+            consumo = pd.DataFrame([{"Flota": f, "Lecturas": v["reads"], "Escrituras": v["writes"], "MB leídos": round(v["read_bytes"] / 2**20, 2),
+                                     "MB escritos": round(v["write_bytes"] / 2**20, 2)} for f, v in tel["fleets"].items()])
+            st.dataframe(consumo.sort_values("Lecturas", ascending=False), use_container_width=True, hide_index=True)
+            tiempos = pd.DataFrame([{"Span": n, "Llamadas": a["count"], "Promedio ms": round(a["seconds"] / a["count"] * 1000, 1), "Máximo ms": round(a["max"] * 1000, 1)}
+                                    for n, a in tel["spans"].items()])
+            st.dataframe(tiempos.sort_values("Promedio ms", ascending=False), use_container_width=True, hide_index=True)
+            if APP_CONFIG.get("METRICS_PORT"):
+                st.caption(f"Prometheus: http://{APP_CONFIG['METRICS_HOST']}:{APP_CONFIG['METRICS_PORT']}/metrics")
+        else:
+            st.info("Todavía no hay operaciones registradas en este servidor.")
+
+    faltantes = list(_missing_index_log())
+    if faltantes:
+        with st.expander(f"🗂️ Índices faltantes ({len(faltantes)})", expanded=True):
+            st.caption("Consultas que Firestore rechazó por falta de índice compuesto. Ejecuta `python app.py export-indexes` y despliega el archivo.")
+            for cuando, detalle in reversed(faltantes):
+                st.markdown(f"- {cuando}: {detalle}")
+
     st.subheader("🏢 Gestión de Empresas Registradas")
     
-    for f in REFS["fleets"].stream():
+    flotas = list(REFS["fleets"].stream())
+    estadisticas = fetch_fleet_stats([f.id for f in flotas]) if flotas else {}
+    for f in flotas:
         d = f.to_dict()
-        unidades = REFS["data"].collection("logs").where("fleetId", "==", f.id).stream()
-        bus_list = set([u.to_dict().get('bus') for u in unidades if u.to_dict().get('bus')])
-        total_buses = len(bus_list)
+        est = estadisticas[f.id]
+        total_buses = est["buses"]
 
         with st.expander(f"Empresa: {f.id} | Dueño: {d.get('owner')} | 🚛 {total_buses} Unidades", expanded=False):
+            m1, m2, m3, m4 = st.columns(4)
+            m1.metric("📝 Registros", f"{est['logs']:,}")
+            m2.metric("💰 Gasto Total", f"${est['spend']:,.2f}")
+            m3.metric("💾 Almacenamiento", f"{est['bytes'] / 1024 / 1024:,.1f} MB" if est['bytes'] is not None else "-")
+            m4.metric("🕒 Última Actividad", est['last_activity'].strftime('%d/%m/%Y') if est['last_activity'] else "-")
+            if est["approx"]:
+                st.caption("ℹ️ Estadísticas calculadas por agregación; ejecuta `python app.py rebuild-stats` para generarlas.")
+            
             c1, c2, c3 = st.columns(3)
             
             is_active = d.get('status') == 'active'
@@ -296,72 +2677,98 @@ def render_super_admin():
                 REFS["fleets"].document(f.id).delete()
                 st.rerun()
 
-def draw_svg_gauge(category, faltan, km_meta, km_actual):
-    """
-    Dibuja un medidor circular (Gauge) en formato SVG.
-    Muestra el % de DESGASTE de la pieza, no la vida útil restante.
-    0% = Nuevo. 100% = Toca Cambiar.
-    """
-    # 1. CASO: PIEZA SIN META PROGRAMADA (Gris)
-    if km_meta <= 0 or faltan == float('inf'):
-        color = "#AAAAAA" # Gris
-        texto_central = "N/A"
-        texto_inferior = "Sin Programar"
-        dash_array = "0, 100"
-    else:
-        # Sistema de Semáforo de Urgencia (basado en kilómetros restantes):
-        if faltan <= 0:
-            porcentaje = 100 # Círculo lleno, rojo
-            color = "#FF4B4B" # Rojo (Vencido)
-            texto_inferior = f"VENCIDO por {abs(int(faltan)):,} km"
-        elif faltan <= 1500:
-            porcentaje = 80 + ((1500 - faltan) / 1500) * 19
-            color = "#FFAA00" # Naranja (Próximo)
-            texto_inferior = f"Faltan {int(faltan):,} km"
-        elif faltan <= 5000:
-            porcentaje = 50 + ((5000 - faltan) / 3500) * 30
-            color = "#FFEA00" # Amarillo (Atención)
-            texto_inferior = f"Faltan {int(faltan):,} km"
-        else:
-            porcentaje = max(1, 50 - (faltan / 20000) * 50)
-            if porcentaje < 1: porcentaje = 1
-            color = "#4CAF50" # Verde (Óptimo)
-            texto_inferior = f"Faltan {int(faltan):,} km"
-
-        texto_central = f"{int(porcentaje)}%"
-        dash_array = f"{porcentaje}, 100"
-
-    # 2. CONSTRUIR EL GRÁFICO SVG
-    svg = f"""
-    <div style="display: flex; flex-direction: column; align-items: center; justify-content: center; margin-bottom: 20px;">
-        <svg viewBox="0 0 36 36" width="120" height="120">
-            <path class="circle-bg"
-                d="M18 2.0845
-                a 15.9155 15.9155 0 0 1 0 31.831
-                a 15.9155 15.9155 0 0 1 0 -31.831"
-                fill="none"
-                stroke="#333333"
-                stroke-width="3"
-            />
-            <path class="circle"
-                stroke-dasharray="{dash_array}"
-                d="M18 2.0845
-                a 15.9155 15.9155 0 0 1 0 31.831
-                a 15.9155 15.9155 0 0 1 0 -31.831"
-                fill="none"
-                stroke="{color}"
-                stroke-width="3"
-                stroke-linecap="round"
-            />
-            <text x="18" y="20" class="percentage" dominant-baseline="middle" text-anchor="middle" fill="white" font-size="8" font-weight="bold" font-family="sans-serif">{texto_central}</text>
-        </svg>
-        <p style="color: {color}; margin: 5px 0 0 0; font-weight: bold; font-size: 16px; text-align: center;">{category}</p>
-        <p style="color: #AAAAAA; margin: 0; font-size: 12px; text-align: center;">{texto_inferior}</p>
-        <p style="color: #666666; margin: 0; font-size: 10px; text-align: center;">Meta: {int(km_meta):,} km</p>
-    </div>
-    """
-    return svg
+            # Flotas con mucho movimiento: más fragmentos = menos choques al escribir los acumulados
+            fragmentos = c3.number_input("Fragmentos de acumulados", 1, ROLLUP_MAX_SHARDS, int(d.get('rollup_shards', 1)), key=f"rs_{f.id}")
+            if fragmentos != int(d.get('rollup_shards', 1)) and c3.button("Guardar fragmentos", key=f"brs_{f.id}"):
+                REFS["fleets"].document(f.id).update({"rollup_shards": int(fragmentos)})
+                fleet_rollup_shards.clear()
+                st.rerun()
+
+# --- PLANTILLAS DEL RADAR (se compilan una vez; el HTML de cada bus sale en un solo bloque) ---
+RADAR_RADIO = 40
+RADAR_CIRCUNFERENCIA = 2 * math.pi * RADAR_RADIO
+RADAR_COLORES = {"VENCIDO": "#dc3545", "ÓPTIMO": "#28a745", "PREVENTIVO": "#ffc107", "CRÍTICO": "#dc3545"}
+
+RADAR_GRID_TPL = '<div style="display: grid; grid-template-columns: repeat(auto-fill, minmax(220px, 1fr)); gap: 15px;">{tarjetas}</div>'
+RADAR_CARD_TPL = (
+    '<div style="display: flex; flex-direction: column; align-items: center; background-color: #1E2129; padding: 20px; border-radius: 10px; box-shadow: 0 4px 6px rgba(0,0,0,0.3);">'
+    '<h4 style="color: white; font-size: 13px; text-transform: uppercase; margin-top: 0; margin-bottom: 15px; text-align: center; height: 30px;">{cat}</h4>'
+    '<svg width="120" height="120" viewBox="0 0 100 100">'
+    '<circle cx="50" cy="50" r="{radio}" fill="none" stroke="#333333" stroke-width="8" />'
+    '<circle cx="50" cy="50" r="{radio}" fill="none" stroke="{color}" stroke-width="8" stroke-dasharray="{circ}" stroke-dashoffset="{dashoffset}" stroke-linecap="round" transform="rotate(-90 50 50)" />'
+    '<text x="50" y="45" font-family="Arial" font-size="20" font-weight="bold" fill="white" text-anchor="middle" alignment-baseline="middle">{pct}%</text>'
+    '<text x="50" y="65" font-family="Arial" font-size="9" fill="#AAAAAA" text-anchor="middle" alignment-baseline="middle">DESGASTE</text>'
+    '</svg>'
+    '<div style="margin-top: 15px; text-align: center; width: 100%;">'
+    '<span style="color: {color}; font-weight: 900; font-size: 14px;">{estado}</span><br>'
+    '<span style="color: #AAAAAA; font-size: 12px;">{texto_faltan}</span><br>'
+    '<span style="color: #666666; font-size: 10px;">Meta: {km_meta:,.0f} km</span>'
+    '</div>'
+    '<details style="width: 100%; margin-top: 10px;"><summary style="color: #AAAAAA; font-size: 12px; cursor: pointer;">📜 Historial de {cat}</summary>{historial}</details>'
+    '</div>'
+)
+RADAR_HIST_TPL = (
+    '<div style="border-top: 1px solid #333333; padding: 6px 0; font-size: 12px;">'
+    '<b style="color: white;">📅 {fecha}</b><br><i style="color: #AAAAAA;">{obs}</i>{costo}</div>'
+)
+RADAR_COSTO_TPL = '<br><span style="color: #28a745;">💰 Inversión: ${costo:,.2f}</span>'
+
+
+def compute_radar(odometros, estado):
+    """Desgaste %, km restantes y semáforo de todas las unidades y categorías en una sola pasada."""
+    cols = ['bus', 'category', 'date', 'km_current', 'km_next', 'km_actual', 'faltan', 'porcentaje', 'estado', 'color']
+    if estado.empty:
+        return pd.DataFrame(columns=cols)
+    r = estado[(estado['km_next'] > 0) & (estado['km_current'] > 0)].copy()
+    r['km_actual'] = r['bus'].map(odometros).fillna(0)
+    r['faltan'] = r['km_next'] - r['km_actual']
+
+    # El intervalo EXACTO que se programó en el registro (10.000 km si viene mal cargado)
+    intervalo = r['km_next'] - r['km_current']
+    intervalo = intervalo.where(intervalo > 0, 10000)
+    pct = ((r['km_actual'] - r['km_current']) / intervalo * 100).astype(int).clip(0, 100)
+    vencido = r['faltan'] <= 0
+    r['porcentaje'] = pct.where(~vencido, 100)
+    r['estado'] = np.select([vencido, pct < 70, pct < 90], ["VENCIDO", "ÓPTIMO", "PREVENTIVO"], "CRÍTICO")
+    r['color'] = r['estado'].map(RADAR_COLORES)
+    return r[cols]
+
+
+def radar_history_html(historial):
+    """HTML de los últimos registros por categoría, armado con un único groupby."""
+    if historial.empty:
+        return {}
+    costo = historial['mec_cost'].fillna(0) + historial['com_cost'].fillna(0)
+    items = pd.Series([
+        RADAR_HIST_TPL.format(
+            fecha=html.escape(str(f)[:10]),
+            obs=html.escape(str(o) if pd.notna(o) and o else 'Sin observaciones').replace("\n", "<br>"),
+            costo=RADAR_COSTO_TPL.format(costo=c) if c > 0 else "",
+        )
+        for f, o, c in zip(historial['date'], historial['observations'], costo)
+    ], index=historial.index)
+    return items.groupby(historial['category'].astype(str), sort=False).agg("".join).to_dict()
+
+
+def radar_bus_html(radar_bus, historial_por_cat):
+    """Todas las tarjetas de una unidad en un solo payload HTML."""
+    faltan = radar_bus['faltan']
+    textos = [f"Faltan: {f:,.0f} km" if f > 0 else f"Vencido por: {abs(f):,.0f} km" for f in faltan]
+    dashoffsets = RADAR_CIRCUNFERENCIA - radar_bus['porcentaje'] / 100 * RADAR_CIRCUNFERENCIA
+    tarjetas = "".join(
+        RADAR_CARD_TPL.format(
+            cat=html.escape(cat), radio=RADAR_RADIO, circ=RADAR_CIRCUNFERENCIA, color=color,
+            dashoffset=dash, pct=pct, estado=est, texto_faltan=texto, km_meta=meta,
+            historial=historial_por_cat.get(cat, ""),
+        )
+        for cat, color, dash, pct, est, texto, meta in zip(
+            radar_bus['category'].astype(str), radar_bus['color'], dashoffsets,
+            radar_bus['porcentaje'], radar_bus['estado'], textos, radar_bus['km_next'],
+        )
+    )
+    return RADAR_GRID_TPL.format(tarjetas=tarjetas)
     
+@traced
 def render_radar(df, user):
     st.header("🏠 Radar de la Flota")
     
@@ -370,8 +2777,7 @@ def render_radar(df, user):
         if not df.empty and 'bus' in df.columns and 'date' in df.columns:
             df_bus_chk = df[df['bus'] == user.get('bus', '0')]
             if not df_bus_chk.empty:
-                df_bus_chk['date_obj'] = pd.to_datetime(df_bus_chk['date'])
-                ultima_fecha = df_bus_chk['date_obj'].max()
+                ultima_fecha = df_bus_chk['date'].max()
                 dias_sin_reporte = (datetime.now() - ultima_fecha).days
                 if dias_sin_reporte >= 3: 
                     st.error(f"🚨 **¡ATENCIÓN!** Llevas **{dias_sin_reporte} días** sin actualizar el kilometraje de la Unidad {user.get('bus', '0')}. Haz un reporte para actualizar el Radar.")
@@ -379,110 +2785,45 @@ def render_radar(df, user):
                     st.warning("⚠️ Recuerda actualizar tu kilometraje pronto.")
     # ------------------------------------------------
 
-    # 1. SELECTOR DE BUS
-    if not df.empty and 'bus' in df.columns:
-        buses_disponibles = sorted(list(df['bus'].dropna().unique()))
+    # 1. SELECTOR DE BUS (el estado viene de la proyección, no del rango de fechas)
+    odometros, estado = maintenance_status_for(user)
+    buses_disponibles = sorted(set(odometros.index) | (set(df['bus'].dropna().unique()) if 'bus' in df.columns else set()))
+    if buses_disponibles:
         bus_sel = st.selectbox("🎯 Selecciona la Unidad a Escanear:", buses_disponibles, key="radar_bus_selector_unico")
     else:
         st.info("No hay datos suficientes para mostrar el radar.")
         return
 
     # 2. FILTRAR DATOS DEL BUS SELECCIONADO
-    df_bus = df[df['bus'] == bus_sel].copy()
-    if df_bus.empty or 'km_current' not in df_bus.columns:
+    df_bus = df[df['bus'] == bus_sel].copy() if 'bus' in df.columns else pd.DataFrame(columns=df.columns)
+    if bus_sel not in odometros.index:
         st.warning("No hay registros de kilometraje para esta unidad.")
         return
 
-    km_actual = df_bus['km_current'].max()
+    km_actual = odometros[bus_sel]
     st.markdown(f"### 🚌 Bus {bus_sel} | Odómetro Actual: **{km_actual:,.0f} km**")
     st.markdown("---")
 
-    # 3. CONSEGUIR LOS ÚLTIMOS MANTENIMIENTOS
-    ultimos = df_bus.sort_values('date', ascending=False).drop_duplicates(subset=['category'])
+    # 3. CALCULAR TODOS LOS RADARES DE UNA VEZ Y QUEDARNOS CON LOS DEL BUS
+    radar = compute_radar(odometros, estado)
+    radar_bus = radar[radar['bus'] == bus_sel].sort_values('date', ascending=False)
+    if radar_bus.empty:
+        st.info("Esta unidad no tiene mantenimientos con meta de kilometraje.")
+        return
 
-    # 4. DIBUJAR LOS RADARES EN 3 COLUMNAS
-    cols = st.columns(3)
-    contador = 0
-    
-    for _, row in ultimos.iterrows():
-        cat = str(row.get('category', 'Desconocido'))
-        km_meta = row.get('km_next', 0)
-        km_cuando_se_hizo = row.get('km_current', 0)
+    # Las observaciones solo se cargan para los 5 registros que muestra cada historial
+    historial = hydrate_logs(df_bus.sort_values('date', ascending=False).groupby('category', observed=True).head(5), user['fleet'], ('observations',))
 
-        if km_meta > 0 and km_cuando_se_hizo > 0:
-            faltan = km_meta - km_actual
-            
-            # MAGIA: Calculamos el intervalo EXACTO que tú le programaste
-            intervalo_real = km_meta - km_cuando_se_hizo
-            if intervalo_real <= 0:
-                intervalo_real = 10000 
-            
-            desgaste_km = km_actual - km_cuando_se_hizo
-            porcentaje = int((desgaste_km / intervalo_real) * 100)
-            porcentaje_visual = max(0, min(100, porcentaje))
-            
-            # Lógica de Colores Semáforo
-            if faltan <= 0:
-                color = "#dc3545" # Rojo
-                estado = "VENCIDO"
-                porcentaje_visual = 100
-            elif porcentaje_visual < 70:
-                color = "#28a745" # Verde
-                estado = "ÓPTIMO"
-            elif porcentaje_visual < 90:
-                color = "#ffc107" # Amarillo
-                estado = "PREVENTIVO"
-            else:
-                color = "#dc3545" # Rojo
-                estado = "CRÍTICO"
-
-            radio = 40
-            circunferencia = 2 * math.pi * radio  # BUG FIX #7: Usar math.pi
-            dashoffset = circunferencia - (porcentaje_visual / 100) * circunferencia
-            texto_faltan = f"Faltan: {faltan:,.0f} km" if faltan > 0 else f"Vencido por: {abs(faltan):,.0f} km"
-
-            # ---------------------------------------------------------
-            # DIBUJAMOS SOLO EL RADAR EN HTML
-            # ---------------------------------------------------------
-            svg = f"""
-<div style="display: flex; flex-direction: column; align-items: center; justify-content: center; background-color: #1E2129; padding: 20px; border-radius: 10px; margin-bottom: 5px; box-shadow: 0 4px 6px rgba(0,0,0,0.3);">
-<h4 style="color: white; font-size: 13px; text-transform: uppercase; margin-top: 0; margin-bottom: 15px; text-align: center; height: 30px;">{cat}</h4>
-<svg width="120" height="120" viewBox="0 0 100 100">
-<circle cx="50" cy="50" r="{radio}" fill="none" stroke="#333333" stroke-width="8" />
-<circle cx="50" cy="50" r="{radio}" fill="none" stroke="{color}" stroke-width="8" stroke-dasharray="{circunferencia}" stroke-dashoffset="{dashoffset}" stroke-linecap="round" transform="rotate(-90 50 50)" />
-<text x="50" y="45" font-family="Arial" font-size="20" font-weight="bold" fill="white" text-anchor="middle" alignment-baseline="middle">{porcentaje_visual}%</text>
-<text x="50" y="65" font-family="Arial" font-size="9" fill="#AAAAAA" text-anchor="middle" alignment-baseline="middle">DESGASTE</text>
-</svg>
-<div style="margin-top: 15px; text-align: center; width: 100%;">
-<span style="color: {color}; font-weight: 900; font-size: 14px;">{estado}</span><br>
-<span style="color: #AAAAAA; font-size: 12px;">{texto_faltan}</span><br>
-<span style="color: #666666; font-size: 10px;">Meta: {km_meta:,.0f} km</span>
-</div>
-</div>
-"""
-            
-            with cols[contador % 3]:
-                # 1. Dibujamos la tarjeta gráfica
-                st.markdown(svg, unsafe_allow_html=True)
-                
-                # 2. AGREGAMOS EL HISTORIAL OFICIAL DE LA APP DEBAJO
-                with st.expander(f"📜 Historial de {cat}"):
-                    # Buscamos los últimos 5 registros de ESTA pieza en específico
-                    historial_cat = df_bus[df_bus['category'] == cat].sort_values('date', ascending=False).head(5)
-                    
-                    for _, h_row in historial_cat.iterrows():
-                        h_fecha = str(h_row.get('date', ''))[:10]
-                        h_obs = str(h_row.get('observations', 'Sin observaciones'))
-                        h_costo = float(h_row.get('mec_cost', 0)) + float(h_row.get('com_cost', 0))
-                        
-                        st.markdown(f"**📅 {h_fecha}**")
-                        st.caption(f"_{h_obs}_")
-                        if h_costo > 0:
-                            st.markdown(f"<span style='color:#28a745; font-size:12px;'>💰 Inversión: ${h_costo:,.2f}</span>", unsafe_allow_html=True)
-                        st.divider()
+    # 4. DIBUJAR TODOS LOS RADARES DEL BUS EN UN SOLO BLOQUE
+    st.markdown(radar_bus_html(radar_bus, radar_history_html(historial)), unsafe_allow_html=True)
 
-            contador += 1
-                    
+    # 5. DIAGNÓSTICO IA (se reutiliza del caché mientras el bus no tenga registros nuevos)
+    if HAS_AI and st.button("🤖 Analizar con IA", key="radar_ai_btn"):
+        with st.spinner("Analizando el historial de la unidad..."):
+            historial_ia = hydrate_logs(df_bus.sort_values('date', ascending=False).head(15), user['fleet'], ('observations',))
+            st.info(get_ai_analysis(historial_ia, bus_sel, user['fleet']))
+
+@traced
 def render_ai_training(user):
     st.header("🧠 Entrenar Inteligencia Artificial")
     st.info("Escribe aquí las reglas personalizadas para tu flota (Ej: 'Alerta si el cambio de aceite supera los 10,000km' o 'El Bus 05 siempre gasta más diesel').")
@@ -511,13 +2852,11 @@ def render_ai_training(user):
             try:
                 # 3. Guardar en Firebase con merge=True para no borrar otros datos (como la clave)
                 doc_ref.set({"ai_rules": new_rules}, merge=True)
+                bump_fleet_cache(user['fleet'], "ai_rules")
                 
                 # 4. MENSAJE DE ÉXITO VISUAL
                 st.success("✅ ¡Reglas guardadas! La IA ahora usará estas instrucciones para analizar tu flota.")
                 st.balloons() # Efecto visual de éxito
-                
-                # Limpiamos cache para que la IA use las nuevas reglas de inmediato
-                st.cache_data.clear()
                 time.sleep(2)
                 st.rerun()
             except Exception as e:
@@ -529,12 +2868,47 @@ def render_ai_training(user):
     else:
         st.warning("⚠️ La IA está usando parámetros genéricos. Escribe tus reglas arriba para personalizarla.")
 
+def render_trace_panel(user):
+    """Barra lateral del dueño: pasos del rerun actual y consumo de la sesión y de la flota."""
+    trace = _current_trace.get()
+    tel = telemetry_snapshot()
+    with st.sidebar.expander("⏱️ Rendimiento"):
+        if trace and trace["spans"]:
+            pasos = pd.DataFrame([{"Paso": "· " * r["depth"] + r["name"], "ms": round(r["ms"], 1), "Lecturas": r["reads"],
+                                   "Escrituras": r["writes"], "KB leídos": round(r["read_bytes"] / 1024, 1)} for r in trace["spans"]])
+            st.dataframe(pasos, use_container_width=True, hide_index=True)
+        sesion = tel["sessions"].get(st.session_state.get("session_id"), {})
+        flota = tel["fleets"].get(user['fleet'], {})
+        c1, c2 = st.columns(2)
+        c1.metric("Lecturas sesión", f"{sesion.get('reads', 0):,}")
+        c2.metric("Lecturas flota", f"{flota.get('reads', 0):,}")
+        c1.metric("Escrituras sesión", f"{sesion.get('writes', 0):,}")
+        c2.metric("Escrituras flota", f"{flota.get('writes', 0):,}")
+        st.caption(f"Leído en esta sesión: {sesion.get('read_bytes', 0) / 1024:,.0f} KB · en la flota (este servidor): {flota.get('read_bytes', 0) / 2**20:,.1f} MB")
+
+def render_live_header(user):
+    """Campana y aviso de cambios en la bitácora; con escucha activa se refresca sola sin leer Firestore."""
+    if fleet_log_events(user['fleet']) > st.session_state.get("log_events_seen", 0):
+        c_aviso, c_btn = st.columns([4, 1])
+        c_aviso.info("🆕 Hay cambios nuevos en la bitácora de la flota.")
+        if c_btn.button("🔄 Actualizar", key="refresh_live", use_container_width=True):
+            st.rerun()
+    display_top_notifications(user)
+
+@traced
 def display_top_notifications(user):
     """Muestra alertas y permite edición total al Administrador"""
     if not REFS: return
     
-    notifs = REFS["data"].collection("notifications").where("fleetId", "==", user['fleet']).where("target_role", "==", user['role']).where("status", "==", "unread").stream()
-    lista_notifs = [{"id": n.id, **n.to_dict()} for n in notifs]
+    # Con escucha activa la lista sale de memoria; si no, el contador decide si hay que consultar
+    lista_notifs = live_unread_notifications(user['fleet'], user['role'])
+    if lista_notifs is None:
+        pendientes, version = unread_status(user['fleet'], user['role'])
+        if not pendientes: return
+        lista_notifs = fetch_unread_notifications(user['fleet'], user['role'], version)
+    # Los registros vinculados se traen juntos en una sola lectura por lotes
+    ids_vinculados = tuple(dict.fromkeys(n['log_id'] for n in lista_notifs if n.get('log_id')))
+    logs_vinculados = fetch_log_fields(user['fleet'], ids_vinculados, NOTIF_LINKED_FIELDS) if user['role'] == 'owner' and ids_vinculados else {}
     
     if lista_notifs:
         st.error(f"🔔 TIENES {len(lista_notifs)} NOTIFICACIÓN(ES) NUEVA(S) QUE REQUIEREN TU ATENCIÓN")
@@ -546,11 +2920,9 @@ def display_top_notifications(user):
                 
                 # --- EDICIÓN TOTAL DIRECTO DESDE LA ALERTA ---
                 if 'log_id' in n and user['role'] == 'owner':
-                    log_ref = REFS["data"].collection("logs").document(n['log_id'])
-                    log_doc = log_ref.get()
+                    log_data = logs_vinculados.get(n['log_id'])
                     
-                    if log_doc.exists:
-                        log_data = log_doc.to_dict()
+                    if log_data is not None:
                         with st.expander("✏️ Corregir TODO el registro aquí mismo"):
                             with st.form(f"quick_edit_{n['id']}"):
                                 st.write(f"**Actualizando:** Bus {log_data.get('bus')}")
@@ -570,14 +2942,13 @@ def display_top_notifications(user):
                                 new_rc = cm2.number_input("Costo Repuestos $", value=float(log_data.get('com_cost', 0.0)))
                                 
                                 if st.form_submit_button("💾 Aplicar Corrección y Cerrar Alerta", type="primary"):
-                                    log_ref.update({
+                                    update_log(user['fleet'], n['log_id'], {
                                         "category": new_cat, "observations": new_obs,
                                         "km_current": new_ka, "km_next": new_kn,
                                         "mec_name": new_mn, "mec_cost": new_mc,
                                         "com_name": new_rn, "com_cost": new_rc
                                     })
-                                    REFS["data"].collection("notifications").document(n['id']).update({"status": "read"})
-                                    st.cache_data.clear()
+                                    mark_notification_read(user['fleet'], n['id'])
                                     st.success("✅ Corregido!")
                                     time.sleep(1)
                                     st.rerun()
@@ -585,11 +2956,12 @@ def display_top_notifications(user):
                         st.warning("⚠️ El registro original ya fue eliminado.")
 
                 if st.button("✅ Simplemente marcar como leído", key=f"read_{n['id']}"):
-                    REFS["data"].collection("notifications").document(n['id']).update({"status": "read"})
+                    mark_notification_read(user['fleet'], n['id'])
                     st.rerun()
                     
         st.divider()
 
+@traced
 def render_communications(user):
     """Módulo completo con Historial de Mensajes y Alertas"""
     st.header("💬 Centro de Mensajes e Historial")
@@ -611,7 +2983,7 @@ def render_communications(user):
         if enviar_btn:
             if mensaje.strip():
                 # 1. Guardamos el mensaje en la base de datos
-                REFS["data"].collection("notifications").add({
+                send_notification({
                     "fleetId": user['fleet'],
                     "sender": f"{user['name']} ({user['role'].upper()})",
                     "target_role": roles[destino],
@@ -648,17 +3020,15 @@ def render_communications(user):
     with t2:
         st.subheader("📥 Historial de Mensajes Recibidos")
         # Consultamos TODOS los mensajes dirigidos a este rol en esta flota
-        notifs_ref = REFS["data"].collection("notifications").where("fleetId", "==", user['fleet']).where("target_role", "==", user['role']).stream()
-        recibidos = [{"id": n.id, **n.to_dict()} for n in notifs_ref]
+        recibidos = fetch_inbox(user['fleet'], user['role'])
         
         if recibidos:
             df_rec = pd.DataFrame(recibidos)
             # Ordenamos del más nuevo al más viejo
-            df_rec['date_obj'] = pd.to_datetime(df_rec['date'])
-            df_rec = df_rec.sort_values('date_obj', ascending=False)
+            df_rec = df_rec.sort_values('date', ascending=False)
             
             for _, r in df_rec.iterrows():
-                fecha_formato = r['date_obj'].strftime('%d/%m/%Y %H:%M')
+                fecha_formato = r['date'].strftime('%d/%m/%Y %H:%M') if pd.notna(r['date']) else "-"
                 es_nuevo = r.get('status') == 'unread'
                 icono = "🆕 (NO LEÍDO)" if es_nuevo else "✅ (Leído)"
                 
@@ -670,7 +3040,7 @@ def render_communications(user):
                         
                     if es_nuevo:
                         if st.button("Marcar como leído", key=f"hist_read_{r['id']}"):
-                            REFS["data"].collection("notifications").document(r['id']).update({"status": "read"})
+                            mark_notification_read(user['fleet'], r['id'])
                             st.rerun()
         else:
             st.info("No tienes mensajes en tu bandeja de entrada.")
@@ -679,16 +3049,14 @@ def render_communications(user):
         st.subheader("📤 Historial de Mensajes Enviados")
         # Consultamos todos los mensajes enviados por el usuario actual
         sender_id = f"{user['name']} ({user['role'].upper()})"
-        sent_ref = REFS["data"].collection("notifications").where("fleetId", "==", user['fleet']).where("sender", "==", sender_id).stream()
-        enviados = [{"id": n.id, **n.to_dict()} for n in sent_ref]
+        enviados = fetch_outbox(user['fleet'], sender_id)
         
         if enviados:
             df_env = pd.DataFrame(enviados)
-            df_env['date_obj'] = pd.to_datetime(df_env['date'])
-            df_env = df_env.sort_values('date_obj', ascending=False)
+            df_env = df_env.sort_values('date', ascending=False)
             
             for _, r in df_env.iterrows():
-                fecha_formato = r['date_obj'].strftime('%d/%m/%Y %H:%M')
+                fecha_formato = r['date'].strftime('%d/%m/%Y %H:%M') if pd.notna(r['date']) else "-"
                 estado_lectura = "Visto por destinatario 👀" if r.get('status') == 'read' else "Entregado, no leído 📩"
                 
                 with st.expander(f"📅 {fecha_formato} | Para: {r.get('target_role', '').upper()} | {estado_lectura}"):
@@ -696,7 +3064,8 @@ def render_communications(user):
         else:
             st.info("Aún no has enviado ningún mensaje por el sistema.")
 
-def render_reports(df, user):
+@traced
+def render_reports(df, user, date_range):
     st.header("📊 Reportes y Auditoría")
     if df.empty: 
         st.warning("No hay datos.")
@@ -708,7 +3077,7 @@ def render_reports(df, user):
         st.subheader("📈 Análisis Financiero y Operativo")
         
         # BUG FIX #2: Cambiar df.get() por df[]
-        df['total_cost'] = df['mec_cost'] + df['com_cost']
+        df = df.assign(total_cost=df['mec_cost'] + df['com_cost'])
         
         # 2. Creamos el filtro independiente para el Administrador
         buses_disp = sorted(df['bus'].unique())
@@ -757,12 +3126,13 @@ def render_reports(df, user):
             )
             fig_pie.update_traces(textposition='inside', textinfo='percent+label', marker=dict(line=dict(color='#000000', width=1)))
             fig_pie.update_layout(plot_bgcolor="rgba(0,0,0,0)", paper_bgcolor="rgba(0,0,0,0)") # Fondo transparente
-            col_g1.plotly_chart(fig_pie, use_container_width=True)
+            with span("plotly"):
+                col_g1.plotly_chart(fig_pie, use_container_width=True)
             
             # Gráfico 2: Dinámico según la selección
             if filtro_bus == "TODA LA FLOTA":
                 # Ranking de unidades (Con barras de calor rojas para los más gastadores)
-                costos_por_bus = df_graficos.groupby('bus')['total_cost'].sum().reset_index()
+                costos_por_bus = df_graficos.groupby('bus', observed=True)['total_cost'].sum().reset_index()
                 fig_bar = px.bar(
                     costos_por_bus, 
                     x='bus', 
@@ -773,10 +3143,11 @@ def render_reports(df, user):
                     color_continuous_scale='Reds' # 🔥 MAPA DE CALOR ROJO
                 )
                 fig_bar.update_layout(xaxis_title="Unidad (Bus)", yaxis_title="Costo ($)", coloraxis_showscale=False, plot_bgcolor="rgba(0,0,0,0)", paper_bgcolor="rgba(0,0,0,0)")
-                col_g2.plotly_chart(fig_bar, use_container_width=True)
+                with span("plotly"):
+                    col_g2.plotly_chart(fig_bar, use_container_width=True)
             else:
                 # Si el Administrador selecciona un solo bus, le mostramos la línea de tiempo de gastos
-                df_graficos['fecha_corta'] = pd.to_datetime(df_graficos['date']).dt.date
+                df_graficos = df_graficos.assign(fecha_corta=df_graficos['date'].dt.date)
                 df_tiempo = df_graficos.groupby('fecha_corta')['total_cost'].sum().reset_index()
                 fig_line = px.line(
                     df_tiempo, 
@@ -788,12 +3159,15 @@ def render_reports(df, user):
                 )
                 fig_line.update_traces(line_color="#28a745", marker=dict(size=8, color="#ffffff", line=dict(width=2, color="#28a745")))
                 fig_line.update_layout(xaxis_title="Fecha del Gasto", yaxis_title="Costo en USD", plot_bgcolor="rgba(0,0,0,0)", paper_bgcolor="rgba(0,0,0,0)")
-                col_g2.plotly_chart(fig_line, use_container_width=True)
+                with span("plotly"):
+                    col_g2.plotly_chart(fig_line, use_container_width=True)
 
     with t2:
         st.subheader("🚦 Buscador y Estado de Unidades")
         
-        buses_list = sorted(df['bus'].unique())
+        # Estado desde la proyección: incluye mantenimientos anteriores al rango elegido
+        km_reales, ultimos_programados = maintenance_status_for(user, scheduled=True)
+        buses_list = sorted(set(df['bus'].unique()) | set(km_reales.index))
         
         if not buses_list:
             st.info("No hay unidades registradas aún.")
@@ -801,11 +3175,8 @@ def render_reports(df, user):
             # --- EL BUSCADOR ---
             bus_seleccionado = st.selectbox("🔍 Buscar por número de Unidad (Bus):", ["TODOS LOS BUSES"] + list(buses_list))
             
-            # 1. KM máximo reportado para cada bus (El real actual)
-            km_reales = df.groupby('bus')['km_current'].max()
-            
-            # 2. Última meta programada para cada pieza
-            mantenimientos = df[df['km_next'] > 0].sort_values('date', ascending=False).drop_duplicates(subset=['bus', 'category'])
+            # 1. KM máximo reportado para cada bus (km_reales) y 2. última meta programada para cada pieza
+            mantenimientos = ultimos_programados.sort_values('date', ascending=False)
             
             if bus_seleccionado != "TODOS LOS BUSES":
                 # --- VISTA DETALLADA DE UN SOLO BUS ---
@@ -875,15 +3246,47 @@ def render_reports(df, user):
 
     with t3:
         st.subheader("📜 Bitácora de Movimientos (EDICIÓN TOTAL)")
-        df_sorted = df.sort_values('date', ascending=False)
         
         # BUG FIX #3: Cambiar df.get() por df[]
         lista_mecs = ["N/A"] + sorted([str(m) for m in df['mec_name'].unique() if pd.notna(m) and m not in ["N/A", ""]])
         lista_coms = ["N/A"] + sorted([str(c) for c in df['com_name'].unique() if pd.notna(c) and c not in ["N/A", ""]])
         
-        for _, r in df_sorted.iterrows():
+        # --- FILTROS: bus, categoría y proveedor viajan en la consulta a Firestore ---
+        es_chofer = user['role'] == 'driver'
+        f_bus, f_cat, f_prov, f_min, f_max = st.columns(5)
+        filtro_bus = "" if es_chofer else f_bus.selectbox("🚌 Unidad", [""] + sorted(df['bus'].unique()), format_func=lambda b: b or "Todas", key="hist_f_bus")
+        filtro_cat = f_cat.selectbox("🔧 Categoría", [""] + sorted(df['category'].unique()), format_func=lambda c: c or "Todas", key="hist_f_cat")
+        filtro_prov = f_prov.selectbox("🏢 Proveedor", [""] + sorted(set(lista_mecs[1:] + lista_coms[1:])), format_func=lambda p: p or "Todos", key="hist_f_prov")
+        costo_min = f_min.number_input("💲 Costo mín.", min_value=0.0, value=0.0, step=10.0, key="hist_f_min")
+        costo_max = f_max.number_input("💲 Costo máx. (0 = sin límite)", min_value=0.0, value=0.0, step=10.0, key="hist_f_max")
+        filtros = (filtro_bus, filtro_cat, filtro_prov, costo_min, costo_max or None)
+        
+        # Pila de cursores: cada página guarda dónde empieza; cambiar filtros o fechas vuelve a la primera
+        paginas = st.session_state.setdefault("hist_paginas", {"clave": None, "cursores": [None]})
+        clave = (filtros, tuple(date_range))
+        if paginas["clave"] != clave:
+            paginas.update(clave=clave, cursores=[None])
+        
+        registros, siguiente = fetch_log_page(user['fleet'], user['bus'] if es_chofer else None, date_range[0], date_range[-1], filtros, paginas["cursores"][-1])
+        df_sorted = _logs_frame(registros, LOG_LIST_FIELDS)
+        
+        n_pagina = len(paginas["cursores"])
+        c_prev, c_info, c_next = st.columns([1, 2, 1])
+        c_prev.button("⬅️ Anterior", disabled=n_pagina == 1, key="hist_prev", on_click=lambda: paginas["cursores"].pop())
+        c_info.caption(f"Página {n_pagina} · {len(df_sorted)} registros")
+        c_next.button("Siguiente ➡️", disabled=siguiente is None, key="hist_next", on_click=lambda: paginas["cursores"].append(siguiente))
+        
+        if df_sorted.empty:
+            st.info("No hay registros con estos filtros.")
+        
+        for idx, r in df_sorted.iterrows():
             fecha_str = r['date'].strftime('%d/%m/%Y %H:%M')
-            with st.expander(f"📅 {fecha_str} | Bus {r['bus']} | {r['category']} | KM: {r['km_current']:,.0f}"):
+            exp = st.expander(f"📅 {fecha_str} | Bus {r['bus']} | {r['category']} | KM: {r['km_current']:,.0f}", key=f"hist_exp_{r['id']}", on_change="rerun")
+            if not exp.open:
+                continue
+            # Solo los registros abiertos descargan el detalle y la foto heredada
+            r = hydrate_logs(df_sorted.loc[[idx]], user['fleet']).iloc[0]
+            with exp:
                 col_txt, col_img = st.columns([2, 1])
                 
                 with col_txt:
@@ -932,20 +3335,18 @@ def render_reports(df, user):
                                 
                                 col_btn1, col_btn2 = st.columns(2)
                                 if col_btn1.form_submit_button("💾 Guardar Todos los Cambios", type="primary"):
-                                    REFS["data"].collection("logs").document(r['id']).update({
+                                    update_log(user['fleet'], r['id'], {
                                         "category": new_cat, "observations": new_obs,
                                         "km_current": new_ka, "km_next": new_kn,
                                         "mec_name": new_mn, "mec_cost": new_mc,
                                         "com_name": new_rn, "com_cost": new_rc
                                     })
-                                    st.cache_data.clear()
                                     st.success("✅ Registro actualizado por completo.")
                                     time.sleep(1)
                                     st.rerun()
                                     
                         if st.button("🗑️ Eliminar Reporte", key=f"del_rep_{r['id']}"):
-                            REFS["data"].collection("logs").document(r['id']).delete()
-                            st.cache_data.clear()
+                            delete_log(user['fleet'], r['id'])
                             st.rerun()
                             
                     elif user['role'] in ['driver', 'mechanic']:
@@ -958,7 +3359,7 @@ def render_reports(df, user):
                                 st.error("❌ Escribe tu explicación antes de enviar.")
                             else:
                                 from datetime import datetime
-                                REFS["data"].collection("notifications").add({
+                                send_notification({
                                     "fleetId": user['fleet'], "sender": f"{user['name']} ({user['role'].upper()})",
                                     "target_role": "owner", "log_id": r['id'],
                                     "message": f"🚩 CORRECCIÓN Bus {r['bus']} ({r['category']}): {explicacion}",
@@ -973,12 +3374,20 @@ def render_reports(df, user):
                         col_wa.markdown(f'<a href="{wa_link}" target="_blank" class="btn-whatsapp" style="padding:10px; font-size:14px; text-align:center; display:flex; justify-content:center; align-items:center;">{svg_whatsapp} Avisar por WhatsApp</a>', unsafe_allow_html=True)
                 
                 with col_img:
-                    if "photo_b64" in r and pd.notna(r["photo_b64"]) and r["photo_b64"]:
+                    if r.get("photo_thumb") and pd.notna(r["photo_thumb"]):
+                        ver_original = st.checkbox("🔍 Ver foto original", key=f"foto_full_{r['id']}")
+                        foto = load_photo(r["photo_ref"] if ver_original else r["photo_thumb"])
+                        if foto:
+                            st.image(foto, use_container_width=True)
+                        else:
+                            st.error("Foto no encontrada")
+                    elif "photo_b64" in r and pd.notna(r["photo_b64"]) and r["photo_b64"]:
                         try:
                             st.image(f"data:image/jpeg;base64,{r['photo_b64']}", use_container_width=True)
                         except:
                             st.error("Error de imagen")
 
+@traced
 def render_accounting(df, user, phone_map):
     st.header("💰 Contabilidad y Abonos")
     
@@ -1008,7 +3417,8 @@ def render_accounting(df, user, phone_map):
                 ]
                 
                 for t, cost, paid, name, lbl in deudas:
-                    debt = r[cost] - r[paid]
+                    # En centavos: el saldo es el tope del abono y termina escrito en Firestore
+                    debt = round(float(r[cost]) - float(r[paid]), 2)
                     col = c1 if t == 'm' else c2
                     
                     if debt > 0:
@@ -1026,11 +3436,12 @@ def render_accounting(df, user, phone_map):
                                 
                                 if st.button(f"Registrar Pago", key=f"btn_{t}{r['id']}", type="primary", use_container_width=True):
                                     # BUG FIX #8: Usar Increment directamente
-                                    REFS["data"].collection("logs").document(r['id']).update({
+                                    v = round(v, 2)
+                                    update_log(user['fleet'], r['id'], {
                                         paid: Increment(v)
                                     })
                                     
-                                    nuevo_saldo = debt - v
+                                    nuevo_saldo = round(debt - v, 2)
                                     ph = format_phone(phone_map.get(r.get(name), ''))
                                     
                                     if ph:
@@ -1055,11 +3466,11 @@ def render_accounting(df, user, phone_map):
                                         """, unsafe_allow_html=True)
                                     
                                     st.success(f"Abono de ${v} registrado.")
-                                    st.cache_data.clear()
                                     time.sleep(2)
                                     st.rerun()
                 st.markdown("---")
 
+@traced
 def render_workshop(user, providers):
     st.header("🛠️ Registro de Taller")
     
@@ -1108,11 +3519,9 @@ def render_workshop(user, providers):
                 else:
                     cat_final = cat_sel.replace(" (Escribir abajo)", "")
                 
-                base64_photo = ""
-                if foto_archivo:
-                    base64_photo = base64.b64encode(foto_archivo.getvalue()).decode()
+                foto_campos = store_photo(foto_archivo.getvalue()) if foto_archivo else {}
                 
-                REFS["data"].collection("logs").add({
+                add_log({
                     "fleetId": user['fleet'],
                     "bus": user['bus'],
                     "date": fecha_registro,
@@ -1126,15 +3535,14 @@ def render_workshop(user, providers):
                     "com_name": rn,
                     "com_cost": rc,
                     "com_paid": rp,
-                    "photo_b64": base64_photo,
                     "status": "completed"
-                })
+                } | foto_campos)
                 
-                st.cache_data.clear()
                 st.success("✅ ¡Registro guardado con éxito!")
                 time.sleep(1)
                 st.rerun()
 
+@traced
 def render_fuel():
     u = st.session_state.user
     st.header("⛽ Registro de Combustible")
@@ -1149,7 +3557,7 @@ def render_fuel():
         
         if st.form_submit_button("🚀 REGISTRAR CARGA", type="primary", use_container_width=True):
             if k > 0 and g > 0 and c > 0:
-                REFS["data"].collection("logs").add({
+                add_log({
                     "fleetId": u['fleet'],
                     "bus": u['bus'],
                     "date": fecha_actual,
@@ -1160,13 +3568,13 @@ def render_fuel():
                     "com_paid": c 
                 })
                 
-                st.cache_data.clear() 
                 st.success("✅ Carga registrada correctamente")
                 time.sleep(1)
                 st.rerun()
             else:
                 st.error("❌ Por favor, llena todos los campos con valores mayores a 0.")
 
+@traced
 def render_personnel(user):
     st.header("👥 Gestión de Personal")
     
@@ -1185,7 +3593,6 @@ def render_personnel(user):
                         "bus": bs,
                         "role": rol 
                     })
-                    st.cache_data.clear()
                     st.success(f"Usuario {nm} creado como {rol}")
                     st.rerun()
                 else:
@@ -1211,14 +3618,24 @@ def render_personnel(user):
                 if nb != d.get('bus',''):
                     if c2.button("💾", key=f"s_{us.id}"): 
                         REFS["fleets"].document(user['fleet']).collection("authorized_users").document(us.id).update({"bus": nb})
-                        st.cache_data.clear()
                         st.rerun()
                 
                 if c3.button("🗑️", key=f"d_{us.id}"): 
                     REFS["fleets"].document(user['fleet']).collection("authorized_users").document(us.id).delete()
-                    st.cache_data.clear()
                     st.rerun()
 
+BULK_LABELS = {"rename": "Renombrar unidad", "delete": "Borrar historial", "transfer": "Transferencia"}
+
+def run_bulk_job_ui(job_id):
+    """Ejecuta un trabajo masivo mostrando una barra de progreso."""
+    barra = st.progress(0.0, text="Procesando registros...")
+    def avance(hechos, total):
+        barra.progress(min(hechos / total, 1.0) if total else 1.0, text=f"Procesando registros... {hechos:,}/{total:,}")
+    job = run_bulk_job(job_id, progress=avance)
+    barra.progress(1.0, text=f"✅ {job['done']:,} registros procesados")
+    return job
+
+@traced
 def render_fleet_management(df, user):
     st.header("🚛 Gestión de Flota")
     
@@ -1242,6 +3659,18 @@ def render_fleet_management(df, user):
     
     st.divider()
 
+    # Operaciones masivas que se cortaron a la mitad (se retoman desde su punto de control)
+    for job in pending_bulk_jobs(user['fleet']):
+        if not job['interrupted']:
+            # Otra sesión lo está corriendo: retomarlo ahora repetiría sus lotes y sus reconstrucciones
+            st.info(f"⏳ Operación en curso: {BULK_LABELS.get(job['kind'], job['kind'])} · Bus {job['bus']} ({job['done']}/{job['total']} registros)")
+            continue
+        col_j1, col_j2 = st.columns([3, 1])
+        col_j1.warning(f"⏸️ Operación interrumpida: {BULK_LABELS.get(job['kind'], job['kind'])} · Bus {job['bus']} ({job['done']}/{job['total']} registros)")
+        if col_j2.button("▶️ Reanudar", key=f"resume_{job['id']}", use_container_width=True):
+            run_bulk_job_ui(job['id'])
+            st.success("✅ Operación completada."); time.sleep(1); st.rerun()
+
     buses = sorted(df['bus'].unique()) if 'bus' in df.columns and not df.empty else []
     c1, c2 = st.columns(2)
     
@@ -1251,9 +3680,8 @@ def render_fleet_management(df, user):
             old = st.selectbox("Unidad", buses, key="ren_old")
             new = st.text_input("Nuevo Nombre/Número")
             if st.button("Actualizar Nombre") and new:
-                for d in REFS["data"].collection("logs").where("fleetId","==",user['fleet']).where("bus","==",old).stream():
-                    REFS["data"].collection("logs").document(d.id).update({"bus": new})
-                st.cache_data.clear()
+                job_id = start_bulk_job(user['fleet'], "rename", old, [(user['fleet'], old), (user['fleet'], new)], new=new)
+                run_bulk_job_ui(job_id)
                 st.success("Nombre actualizado"); st.rerun()
         else:
             st.warning("No tienes unidades registradas aún.")
@@ -1263,11 +3691,9 @@ def render_fleet_management(df, user):
         if buses:
             dbus = st.selectbox("Eliminar unidad", buses, key="del_bus")
             if st.button("ELIMINAR TODO EL HISTORIAL", type="secondary"):
-                docs = REFS["data"].collection("logs").where("fleetId","==",user['fleet']).where("bus","==",dbus).stream()
-                for d in docs:
-                    REFS["data"].collection("logs").document(d.id).delete()
+                job_id = start_bulk_job(user['fleet'], "delete", dbus, [(user['fleet'], dbus)])
+                run_bulk_job_ui(job_id)
                 
-                st.cache_data.clear() 
                 st.success(f"✅ Historial de la unidad {dbus} borrado por completo")
                 time.sleep(1) 
                 st.rerun()
@@ -1292,19 +3718,9 @@ def render_fleet_management(df, user):
             else:
                 dest_doc = REFS["fleets"].document(target_fleet).get()
                 if dest_doc.exists:
-                    logs_to_transfer = REFS["data"].collection("logs")\
-                        .where("fleetId", "==", user['fleet'])\
-                        .where("bus", "==", bus_to_send).stream()
-                    
-                    count = 0
-                    for doc in logs_to_transfer:
-                        data = doc.to_dict()
-                        data['fleetId'] = target_fleet
-                        data['observations'] = f"{data.get('observations', '')} (Importado de {user['fleet']})"
-                        
-                        REFS["data"].collection("logs").add(data)
-                        count += 1
-                    
+                    # Ids determinísticos: repetir la transferencia sobrescribe, no duplica
+                    job_id = start_bulk_job(user['fleet'], "transfer", bus_to_send, [(target_fleet, bus_to_send)], target=target_fleet)
+                    count = run_bulk_job_ui(job_id)["done"]
                     if count > 0:
                         st.success(f"✅ ¡Transferencia Exitosa! Se enviaron {count} registros al código {target_fleet}.")
                         st.balloons()
@@ -1317,6 +3733,7 @@ def render_fleet_management(df, user):
     else:
         st.warning("Necesitas tener unidades con historial antes de poder transferirlas.")
 
+@traced
 def render_directory(providers, user):
     st.header("🏢 Directorio de Proveedores")
     
@@ -1332,7 +3749,7 @@ def render_directory(providers, user):
                         REFS["data"].collection("providers").add({
                             "name": n, "phone": p, "type": t, "fleetId": user['fleet']
                         })
-                        st.cache_data.clear() 
+                        bump_fleet_cache(user['fleet'], "providers")
                         st.success("✅ Guardado con éxito")
                         time.sleep(1)
                         st.rerun()
@@ -1383,7 +3800,7 @@ def render_directory(providers, user):
                     
                     if c_del.button("🗑️ Eliminar", key=f"del_btn_{p_id}", use_container_width=True):
                         REFS["data"].collection("providers").document(p_id).delete()
-                        st.cache_data.clear()
+                        bump_fleet_cache(user['fleet'], "providers")
                         st.toast(f"Eliminado: {p['name']}")
                         time.sleep(0.5)
                         st.rerun()
@@ -1404,7 +3821,7 @@ def render_directory(providers, user):
                                     "phone": new_p, 
                                     "type": new_t
                                 })
-                                st.cache_data.clear()
+                                bump_fleet_cache(user['fleet'], "providers")
                                 st.success("Actualizado"); time.sleep(0.5); st.rerun()
 
     # Mostrar el contenido en cada pestaña
@@ -1414,6 +3831,7 @@ def render_directory(providers, user):
     with t2:
         mostrar_lista(comercios)
         
+@traced
 def render_mechanic_work(user, df, providers):
     st.header("🛠️ Registrar Trabajo Mecánico")
     
@@ -1475,10 +3893,9 @@ def render_mechanic_work(user, df, providers):
                 else:
                     cat_final = cat_sel.replace(" (Escribir abajo)", "")
                 
-                bytes_data = foto.getvalue()
-                b64 = base64.b64encode(bytes_data).decode()
+                foto_campos = store_photo(foto.getvalue())
                 
-                REFS["data"].collection("logs").add({
+                add_log({
                     "fleetId": user['fleet'],
                     "bus": bus_id,
                     "date": datetime.now().isoformat(),
@@ -1492,17 +3909,16 @@ def render_mechanic_work(user, df, providers):
                     "com_name": store_name,
                     "com_cost": rep_cost,
                     "com_paid": 0, 
-                    "photo_b64": b64,
                     "status": "pending_driver",
                     "driver_feedback": ""
-                })
+                } | foto_campos)
                 
-                st.cache_data.clear()
                 st.success("✅ Reporte enviado. Los radares han sido actualizados.")
                 time.sleep(1)
                 st.rerun()
 
-def render_ai_chat(df, user):
+@traced
+def render_ai_chat(user):
     html_header = """
 <div style="display:flex; align-items:center; gap:18px; margin-bottom: 5px; padding-bottom: 15px; border-bottom: 1px solid #333333;">
 <svg width="50" height="50" viewBox="0 0 100 100" xmlns="http://www.w3.org/2000/svg">
@@ -1553,37 +3969,36 @@ def render_ai_chat(df, user):
         st.session_state.chat_history.append({"role": "user", "content": prompt})
 
         # --- 4. PROCESAMIENTO CON GEMINI (PERO COMO IA ITERO) ---
-        with st.spinner("IA Itero está analizando tus datos..."):
-            try:
+        try:
+            with st.spinner("IA Itero está analizando tus datos..."):
                 model = get_ai_model()
                 
                 # A. Traer las reglas del dueño
-                fleet_doc = REFS["fleets"].document(user['fleet']).get()
-                ai_rules = fleet_doc.to_dict().get("ai_rules", "") if fleet_doc.exists else ""
+                ai_rules = fetch_ai_rules(user['fleet'])
                 
-                # B. Construir un resumen exacto del estado de los buses
-                contexto_datos = "ESTADO ACTUAL DE LOS MANTENIMIENTOS DE LA FLOTA:\n"
-                if not df.empty:
-                    df['total_cost'] = df['mec_cost'] + df['com_cost']
-                    km_reales = df.groupby('bus')['km_current'].max().to_dict()
-                    ultimos_mantenimientos = df.sort_values('date', ascending=False).drop_duplicates(subset=['bus', 'category'])
-                    
-                    for _, r in ultimos_mantenimientos.iterrows():
-                        b = r['bus']
-                        c = r['category']
-                        km_act = km_reales.get(b, 0)
-                        km_meta = r.get('km_next', 0)
-                        if km_meta > 0:
-                            faltan = km_meta - km_act
-                            estado = f"Faltan {faltan:,.0f} km" if faltan >= 0 else f"VENCIDO por {abs(faltan):,.0f} km"
-                        else:
-                            estado = "Sin meta programada a futuro."
-                            
-                        contexto_datos += f"- Bus {b} | {c}: KM Actual ({km_act:,.0f}). Meta Programada ({km_meta:,.0f}). Estado: {estado}.\n"
-                        
-                    logs_recientes = df[['date', 'bus', 'category', 'total_cost', 'observations']].head(20).to_string()
-                else:
-                    logs_recientes = "No hay registros."
+                # B. Solo los registros de la bitácora relacionados con la pregunta (índice BM25, 2.4)
+                logs_relevantes, pares = chat_log_context(user['fleet'], prompt, bus=user['bus'] if user['role'] == 'driver' else None)
+                buses_pregunta = set(bm25_tokens(prompt))
+
+                # Estado de los buses: primero lo que toca la pregunta, luego lo más urgente, hasta el presupuesto
+                km_reales, ultimos_mantenimientos = maintenance_status_for(user)
+                km_reales = km_reales.to_dict()
+                lineas_estado = []
+                for _, r in ultimos_mantenimientos.iterrows():
+                    b = r['bus']
+                    c = r['category']
+                    km_act = km_reales.get(b, 0)
+                    km_meta = r.get('km_next', 0)
+                    if km_meta > 0:
+                        faltan = km_meta - km_act
+                        estado = f"Faltan {faltan:,.0f} km" if faltan >= 0 else f"VENCIDO por {abs(faltan):,.0f} km"
+                    else:
+                        faltan = math.inf
+                        estado = "Sin meta programada a futuro."
+                    relacionado = (str(b), c) in pares or bool(set(bm25_tokens(b)) & buses_pregunta)
+                    lineas_estado.append((not relacionado, faltan, f"- Bus {b} | {c}: KM Actual ({km_act:,.0f}). Meta Programada ({km_meta:,.0f}). Estado: {estado}."))
+                lineas_estado.sort(key=lambda x: x[:2])
+                contexto_datos = "ESTADO ACTUAL DE LOS MANTENIMIENTOS DE LA FLOTA:\n" + "\n".join(_budget_lines([x[2] for x in lineas_estado], CHAT_STATUS_TOKENS))
 
                 # C. Enviar todo al cerebro de la IA (Gemini) con nueva identidad
                 sys_prompt = f"""
@@ -1597,8 +4012,8 @@ def render_ai_chat(df, user):
                 
                 {contexto_datos}
                 
-                ÚLTIMOS TRABAJOS REGISTRADOS EN LA BITÁCORA:
-                {logs_recientes}
+                REGISTROS DE LA BITÁCORA RELACIONADOS CON LA PREGUNTA:
+                {logs_relevantes}
                 
                 Pregunta del usuario: {prompt}
                 
@@ -1610,37 +4025,71 @@ def render_ai_chat(df, user):
                 5. Al final de respuestas complejas, puedes usar una frase como "Enviado por IA Itero".
                 """
                 
-                response = model.generate_content(sys_prompt)
-                
-                # Mostrar respuesta de IA Itero
-                with st.chat_message("assistant", avatar="✨"):
-                    st.markdown(response.text)
-                st.session_state.chat_history.append({"role": "assistant", "content": response.text})
-                
-            except Exception as e:
-                st.error(f"Hubo un error al conectar con el cerebro de IA Itero: {e}")
+            # Mostrar respuesta de IA Itero a medida que llega
+            metricas = {}
+            with st.chat_message("assistant", avatar="✨"):
+                respuesta = st.write_stream(stream_ai_text(model, sys_prompt, metricas))
+                if metricas["ttft"] is not None:
+                    st.caption(f"⏱️ Primer texto en {metricas['ttft']:.1f} s · respuesta completa en {metricas['total']:.1f} s")
+            st.session_state.chat_history.append({"role": "assistant", "content": respuesta})
+            
+        except Exception as e:
+            st.error(f"Hubo un error al conectar con el cerebro de IA Itero: {e}")
 
+@traced
+def render_fleet_audit(df, user):
+    st.header("🩺 Auditoría IA de toda la Flota")
+    if not HAS_AI:
+        st.error("⚠️ La Inteligencia Artificial no está configurada. Revisa tus Secrets en Streamlit.")
+        return
+    st.caption("La IA revisa los últimos 15 registros de cada unidad. Los informes se guardan y solo se vuelven a generar para las unidades con registros nuevos.")
+
+    progreso = audit_progress(user['fleet'])
+    if progreso and progreso["running"]:
+        @st.fragment(run_every=2)
+        def barra_auditoria():
+            p = audit_progress(user['fleet'])
+            if not p["running"]:
+                st.rerun()
+            hechos = p["done"] + p["errors"]
+            st.progress(hechos / p["total"] if p["total"] else 1.0, text=f"🔎 Auditando... {hechos}/{p['total']} unidades ({p['errors']} con error)")
+        barra_auditoria()
+    else:
+        if progreso and progreso["error"]:
+            st.error(f"❌ La última auditoría falló: {progreso['error']}")
+        elif progreso:
+            st.success(f"✅ Última auditoría: {progreso['done']} informes nuevos, {progreso['skipped']} sin cambios, {progreso['errors']} con error.")
+        if st.button("🚀 Auditar toda la flota", type="primary", disabled=df.empty):
+            recientes = df.sort_values('date', ascending=False).groupby('bus', observed=True).head(15)
+            recientes = hydrate_logs(recientes, user['fleet'], ('observations',))
+            resumenes = {bus: bus_history_summary(g) for bus, g in recientes.groupby('bus', observed=True)}
+            start_fleet_audit(user['fleet'], resumenes, get_ai_model(), fetch_ai_rules(user['fleet']))
+            st.rerun()
+
+    informes = sorted(fetch_ai_reports(user['fleet']), key=lambda r: str(r.get('bus', '')))
+    iconos = {"done": "✅", "pending": "⏳", "error": "❌"}
+    for r in informes:
+        fecha = r['updated_at'].strftime('%d/%m/%Y %H:%M') if hasattr(r.get('updated_at'), 'strftime') else ""
+        with st.expander(f"{iconos.get(r.get('status'), '•')} Bus {r.get('bus')} | {fecha}"):
+            if r.get('status') == 'done':
+                st.markdown(r.get('report', ''))
+            elif r.get('status') == 'error':
+                st.error(r.get('error', 'Error desconocido'))
+            else:
+                st.info("En cola...")
+
+@traced
 def render_cierre_caja(df, user):
     st.header("💵 Cierre de Caja y Rentabilidad")
     st.caption("Evalúa y guarda la rentabilidad de tu flota. Todo quedará registrado en el historial.")
     
-    # 1. GENERAR MESES SIEMPRE
+    # 1. GENERAR MESES SIEMPRE (los costos salen de los acumulados mensuales, no del rango de fechas)
     mes_actual = datetime.now().strftime('%Y-%m')
-    meses_base = pd.date_range(end=pd.Timestamp.now(), periods=12, freq='MS').strftime('%Y-%m').tolist()
-    meses_base.reverse()
-    
-    if not df.empty and 'date' in df.columns:
-        df_calc = df.copy()
-        df_calc['date_obj'] = pd.to_datetime(df_calc['date'])
-        df_calc['mes'] = df_calc['date_obj'].dt.strftime('%Y-%m')
-        meses_db = df_calc['mes'].unique().tolist()
-    else:
-        df_calc = pd.DataFrame()
-        meses_db = []
-        
-    meses_disp = list(dict.fromkeys(meses_base + meses_db))
+    meses_disp = pd.date_range(end=pd.Timestamp.now(), periods=12, freq='MS').strftime('%Y-%m').tolist()
+    meses_disp.reverse()
     if mes_actual not in meses_disp:
         meses_disp.insert(0, mes_actual)
+    acumulados = fetch_cost_rollups(user['fleet'], meses_disp[-1], meses_disp[0])
         
     # 2. SELECTORES DE MES Y ALCANCE
     c_top1, c_top2 = st.columns(2)
@@ -1649,22 +4098,21 @@ def render_cierre_caja(df, user):
     
     bus_sel = "N/A"
     if tipo_cierre == "Por Unidad":
+        buses_disponibles = set(acumulados['bus'])
         if not df.empty and 'bus' in df.columns:
-            buses_disponibles = sorted(list(df['bus'].dropna().unique()))
-        else:
-            buses_disponibles = ["Sin Unidades"]
+            buses_disponibles |= set(df['bus'].dropna().astype(str))
+        buses_disponibles = sorted(buses_disponibles) or ["Sin Unidades"]
             
         bus_sel = st.selectbox("🚌 Selecciona la Unidad", buses_disponibles, key="cierre_bus_sel_caja")
 
     # 3. EXTRAER GASTOS
-    df_mes = pd.DataFrame()
-    if not df_calc.empty and 'mes' in df_calc.columns:
-        df_mes = df_calc[df_calc['mes'] == mes_sel]
-        if tipo_cierre == "Por Unidad" and bus_sel and bus_sel != "Sin Unidades":
-            df_mes = df_mes[df_mes['bus'] == bus_sel]
+    df_mes = acumulados[acumulados['month'] == mes_sel]
+    if tipo_cierre == "Por Unidad" and bus_sel and bus_sel != "Sin Unidades":
+        df_mes = df_mes[df_mes['bus'] == bus_sel]
             
-    gastos_mec = df_mes['mec_cost'].sum() if not df_mes.empty and 'mec_cost' in df_mes.columns else 0
-    gastos_com = df_mes['com_cost'].sum() if not df_mes.empty and 'com_cost' in df_mes.columns else 0
+    gastos_mec = df_mes['mec_cost'].sum()
+    gastos_com = df_mes['com_cost'].sum()
+    gastos_combustible = df_mes['fuel_cost'].sum()
     gastos_taller_app = gastos_mec + gastos_com
     
     # 4. FORMULARIO Y GUARDADO
@@ -1679,6 +4127,8 @@ def render_cierre_caja(df, user):
         
         st.markdown("---")
         st.write(f"🔧 **Gastos de Taller en {mes_sel}:** Mano de Obra (${gastos_mec:,.2f}) + Repuestos (${gastos_com:,.2f}) = **${gastos_taller_app:,.2f}**")
+        if gastos_combustible:
+            st.caption(f"⛽ Los repuestos incluyen ${gastos_combustible:,.2f} de combustible.")
         
         # BOTÓN DE GUARDADO
         guardar_cierre = st.form_submit_button("💾 CALCULAR Y GUARDAR REGISTRO", type="primary", use_container_width=True)
@@ -1689,7 +4139,7 @@ def render_cierre_caja(df, user):
             margen = (utilidad / ingresos) * 100 if ingresos > 0 else 0
             
             # --- MAGIA: GUARDAR EN LA BASE DE DATOS ---
-            REFS["data"].collection("financial_closures").add({
+            save_closure({
                 "fleetId": user['fleet'],
                 "month": mes_sel,
                 "scope": tipo_cierre,
@@ -1719,14 +4169,31 @@ def render_cierre_caja(df, user):
             time.sleep(1.5)
             st.rerun()
 
-    # 5. TABLA DE HISTORIAL DE CIERRES
+    # Consultamos la base de datos
+    closures_list = fetch_closures(user['fleet'])
+
+    # 5. RESULTADOS DE LOS ÚLTIMOS 12 MESES (un documento de acumulados por mes)
+    st.markdown("---")
+    st.subheader("📆 Resultados de los Últimos 12 Meses")
+    por_mes = acumulados.groupby('month')[list(ROLLUP_METRICS)].sum().reindex(meses_disp, fill_value=0)
+    cierres_flota = {}
+    for c in sorted(closures_list, key=lambda c: c.get('saved_at', '')):
+        if c.get('scope') == "Toda la Flota": cierres_flota[c.get('month')] = c
+    resumen = pd.DataFrame({
+        "📅 Mes": por_mes.index,
+        "🔧 Mano de Obra": por_mes['mec_cost'].map(lambda x: f"${x:,.2f}"),
+        "🛒 Repuestos": (por_mes['com_cost'] - por_mes['fuel_cost']).map(lambda x: f"${x:,.2f}"),
+        "⛽ Combustible": por_mes['fuel_cost'].map(lambda x: f"${x:,.2f}"),
+        "✅ Abonado": (por_mes['mec_paid'] + por_mes['com_paid']).map(lambda x: f"${x:,.2f}"),
+        "📝 Registros": por_mes['logs'].astype(int),
+        "💵 Utilidad (cierre)": [f"${cierres_flota[m]['profit']:,.2f}" if m in cierres_flota else "-" for m in por_mes.index],
+    })
+    st.dataframe(resumen, use_container_width=True, hide_index=True)
+
+    # 6. TABLA DE HISTORIAL DE CIERRES
     st.markdown("---")
     st.subheader("📂 Historial de Cierres Guardados")
     
-    # Consultamos la base de datos
-    closures_ref = REFS["data"].collection("financial_closures").where("fleetId", "==", user['fleet']).stream()
-    closures_list = [{"id": c.id, **c.to_dict()} for c in closures_ref]
-    
     if closures_list:
         df_closures = pd.DataFrame(closures_list)
         # Ordenar de más reciente a más antiguo
@@ -1749,6 +4216,12 @@ def render_cierre_caja(df, user):
         st.info("Aún no tienes cierres de caja guardados. Llena el formulario de arriba para guardar tu primer registro.")
             
 def main():
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    begin_trace(st.session_state.session_id, st.session_state.get("user", {}).get("fleet"))
+    if APP_CONFIG.get("METRICS_PORT"):
+        start_metrics_server(APP_CONFIG["METRICS_PORT"])
+
     if 'user' not in st.session_state:
         ui_render_login()
     else:
@@ -1760,13 +4233,18 @@ def main():
         
         dr = st.sidebar.date_input("Fechas", [date.today() - timedelta(days=90), date.today()])
         
-        provs, df = fetch_fleet_data(u['fleet'], u['role'], u['bus'], dr[0], dr[1])
-        phone_map = {p['name']: p.get('phone', '') for p in provs}
+        # Cada página declara qué campos de la bitácora necesita; se descarga solo eso
+        def load(*field_sets):
+            fields = tuple(dict.fromkeys(f for fs in field_sets for f in fs))
+            return fetch_fleet_data(u['fleet'], u['role'], u['bus'], dr[0], dr[1], fields)
 
         # ---------------------------------------------------------
         # 🔔 CAMPANA DE NOTIFICACIONES (Se muestra arriba para todos)
         # ---------------------------------------------------------
-        display_top_notifications(u)
+        touch_fleet_listener(u['fleet'], st.session_state.session_id)
+        st.session_state.log_events_seen = fleet_log_events(u['fleet'])
+        en_vivo = fleet_listener_token(u['fleet']) is not None
+        st.fragment(render_live_header, run_every=NOTIF_REFRESH_SECONDS if en_vivo else None)(u)
 
         # --- LÓGICA POR ROLES ---
         
@@ -1780,11 +4258,10 @@ def main():
                 c = c3.number_input("$ Total", min_value=0.0)
                 if st.form_submit_button("🚀 GUARDAR COMBUSTIBLE", type="primary", use_container_width=True):
                     if k > 0 and g > 0 and c > 0:
-                        REFS["data"].collection("logs").add({
+                        add_log({
                             "fleetId": u['fleet'], "bus": u['bus'], "date": datetime.now().isoformat(),
                             "category": "Combustible", "km_current": k, "gallons": g, "com_cost": c, "com_paid": c
                         })
-                        st.cache_data.clear()
                         st.success("Registrado con éxito")
                         time.sleep(1)
                         st.rerun()
@@ -1792,16 +4269,18 @@ def main():
             
             # ---> MENÚ CONDUCTOR <---
             menu = {
-                "🏠 Radar de Unidad": lambda: render_radar(df, u),
-                "🤖 Chat IA": lambda: render_ai_chat(df, u),
-                "💰 Pagos y Abonos": lambda: render_accounting(df, u, phone_map),
-                "📊 Reportes": lambda: render_reports(df, u), 
-                "🛠️ Reportar Taller": lambda: render_workshop(u, provs),
-                "💬 Mensajes": lambda: render_communications(u),
-                "🏢 Directorio": lambda: render_directory(provs, u)
+                "🏠 Radar de Unidad": (LOG_CORE_FIELDS, lambda: render_radar(df, u)),
+                "🤖 Chat IA": ((), lambda: render_ai_chat(u)),
+                "💰 Pagos y Abonos": (LOG_LIST_FIELDS, lambda: render_accounting(df, u, phone_map)),
+                "📊 Reportes": (LOG_LIST_FIELDS, lambda: render_reports(df, u, dr)), 
+                "🛠️ Reportar Taller": ((), lambda: render_workshop(u, provs)),
+                "💬 Mensajes": ((), lambda: render_communications(u)),
+                "🏢 Directorio": ((), lambda: render_directory(provs, u))
             }
             choice = st.sidebar.radio("Más opciones:", list(menu.keys()))
-            menu[choice]()
+            provs, df = load(menu[choice][0])
+            phone_map = {p['name']: p.get('phone', '') for p in provs}
+            run_page(menu[choice][1])
 
         # 2. ROL MECÁNICO
         elif u['role'] == 'mechanic':
@@ -1809,44 +4288,70 @@ def main():
             
             # ---> MENÚ MECÁNICO <---
             menu = {
-                "🏠 Radar de Taller": lambda: render_radar(df, u),
-                "🤖 Chat IA": lambda: render_ai_chat(df, u),
-                "📝 Registrar Trabajo": lambda: render_mechanic_work(u, df, provs),
-                "📊 Historial Técnico": lambda: render_reports(df, u), 
-                "💬 Mensajes": lambda: render_communications(u),
-                "🏢 Directorio": lambda: render_directory(provs, u)
+                "🏠 Radar de Taller": (LOG_CORE_FIELDS, lambda: render_radar(df, u)),
+                "🤖 Chat IA": ((), lambda: render_ai_chat(u)),
+                "📝 Registrar Trabajo": (LOG_CORE_FIELDS, lambda: render_mechanic_work(u, df, provs)),
+                "📊 Historial Técnico": (LOG_LIST_FIELDS, lambda: render_reports(df, u, dr)), 
+                "💬 Mensajes": ((), lambda: render_communications(u)),
+                "🏢 Directorio": ((), lambda: render_directory(provs, u))
             }
             choice = st.sidebar.radio("Menú Mecánico:", list(menu.keys()))
-            menu[choice]()
+            provs, df = load(menu[choice][0])
+            run_page(menu[choice][1])
 
         # 3. ROL DUEÑO / ADMINISTRADOR
         else:
-            render_radar(df, u)
-            st.divider()
-            
             # BUG FIX #4: Indentación correcta
             # ---> MENÚ DUEÑO <---
             menu = {
-                "💵 Cierre de Caja": lambda: render_cierre_caja(df, u),
-                "🏠 Radar / Escáner": lambda: render_radar(df, u),
-                "🤖 Chat Asistente IA": lambda: render_ai_chat(df, u),
-                "📊 Reportes": lambda: render_reports(df, u), 
-                "🛠️ Taller": lambda: render_workshop(u, provs),
-                "💰 Contabilidad": lambda: render_accounting(df, u, phone_map),
-                "💬 Mensajes": lambda: render_communications(u), 
-                "🏢 Directorio": lambda: render_directory(provs, u),
-                "👥 Personal": lambda: render_personnel(u),
-                "🚛 Gestión": lambda: render_fleet_management(df, u),
-                "🧠 Entrenar IA": lambda: render_ai_training(u)
+                "💵 Cierre de Caja": (LOG_CORE_FIELDS, lambda: render_cierre_caja(df, u)),
+                "🏠 Radar / Escáner": (LOG_CORE_FIELDS, lambda: render_radar(df, u)),
+                "🤖 Chat Asistente IA": ((), lambda: render_ai_chat(u)),
+                "🩺 Auditoría IA": (LOG_CORE_FIELDS, lambda: render_fleet_audit(df, u)),
+                "📊 Reportes": (LOG_LIST_FIELDS, lambda: render_reports(df, u, dr)), 
+                "🛠️ Taller": ((), lambda: render_workshop(u, provs)),
+                "💰 Contabilidad": (LOG_LIST_FIELDS, lambda: render_accounting(df, u, phone_map)),
+                "💬 Mensajes": ((), lambda: render_communications(u)), 
+                "🏢 Directorio": ((), lambda: render_directory(provs, u)),
+                "👥 Personal": ((), lambda: render_personnel(u)),
+                "🚛 Gestión": (LOG_CORE_FIELDS, lambda: render_fleet_management(df, u)),
+                "🧠 Entrenar IA": ((), lambda: render_ai_training(u))
             }
             choice = st.sidebar.radio("Ir a:", list(menu.keys()))
-            menu[choice]()
+            # El radar siempre se dibuja arriba, así que sus campos van en la misma consulta
+            provs, df = load(LOG_CORE_FIELDS, menu[choice][0])
+            phone_map = {p['name']: p.get('phone', '') for p in provs}
+            
+            # En la página del radar no se vuelve a dibujar arriba (duplicaría sus widgets)
+            if choice != "🏠 Radar / Escáner":
+                render_radar(df, u)
+                st.divider()
+            run_page(menu[choice][1])
         
+        # Al final del rerun: así el panel ya incluye los pasos de la página
+        if u['role'] == 'owner':
+            render_trace_panel(u)
+
         # --- BOTÓN DE SALIDA UNIFICADO ---
         st.sidebar.divider()
         if st.sidebar.button("Cerrar Sesión", use_container_width=True): 
+            release_fleet_listener(u['fleet'], st.session_state.get("session_id"))
             st.session_state.clear()
             st.rerun()
 
+# --- COMANDOS DE MANTENIMIENTO (python app.py <comando>) ---
+CLI_COMMANDS = {
+    "migrate-photos": migrate_photos,
+    "rebuild-status": rebuild_status_command,
+    "rebuild-stats": rebuild_stats_command,
+    "rebuild-rollups": rebuild_rollups_command,
+    "migrate-dates": migrate_dates_command,
+    "export-indexes": export_indexes_command,
+    "check-indexes": check_indexes_command,
+}
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        CLI_COMMANDS[sys.argv[1]](*sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,384 @@
+"""Benchmarks de Itero: flota sintética y tiempos por página con el AppTest de Streamlit.
+
+    python benchmark.py generate --buses 200 --logs 100000 --storage sqlite --path itero.sqlite3
+    python benchmark.py run --scale small medium [--runs 3] [--save-baseline | --check]
+
+`generate` llena un backend local (storage.py) con una flota realista: bitácora de
+combustible, preventivos y correctivos con odómetros coherentes por bus, fotos del
+tamaño indicado, proveedores, personal, notificaciones y cierres de caja.
+
+`run` genera cada escala en memoria y mide, dentro de un AppTest, `fetch_fleet_data` y
+las páginas de radar, reportes, contabilidad y cierre de caja: tiempo en frío (cachés
+y fotos en disco vacías), tras un reinicio (solo con la foto Parquet de la bitácora) y
+en caliente, memoria pico (tracemalloc) y lecturas del backend. Con
+`--save-baseline` guarda los resultados en BASELINE_FILE; con `--check` los compara y
+termina con código 1 si alguna medición empeoró más de la tolerancia o si la línea
+base no tiene la escala medida.
+
+Los tiempos dependen de la máquina, así que la línea base no se versiona: se crea en la
+máquina donde se va a comparar, sobre el commit de referencia, con
+`python benchmark.py run --scale small medium --save-baseline`.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta, timezone
+
+os.environ.setdefault("ITERO_STORAGE", "memory")
+os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(ROOT, "benchmark_baseline.json")
+FLEET_ID = "BENCH"
+OWNER = {'role': 'owner', 'fleet': FLEET_ID, 'name': 'BOSS', 'bus': '0'}
+
+SCALES = {
+    "small": {"buses": 10, "logs": 2_000},
+    "medium": {"buses": 50, "logs": 20_000},
+    "large": {"buses": 200, "logs": 100_000},
+}
+
+# Mantenimientos preventivos: categoría -> intervalo en km
+PREVENTIVE = {"Aceite Motor": 5_000, "Frenos": 20_000, "Llantas": 40_000, "Caja": 60_000, "Corona": 80_000}
+CORRECTIVE = ["Suspensión", "Eléctrico", "Motor", "Otro"]
+OBSERVATIONS = {
+    "Aceite Motor": ["cambio de aceite 15W40 y filtro", "cambio de aceite sintético, filtro de aire revisado"],
+    "Frenos": ["cambio de pastillas delanteras", "rectificado de tambores y zapatas nuevas"],
+    "Llantas": ["rotación y alineación", "dos llantas nuevas en eje trasero"],
+    "Caja": ["cambio de aceite de caja", "ajuste de sincronizados"],
+    "Corona": ["cambio de aceite de corona", "revisión de piñón y corona"],
+    "Suspensión": ["cambio de amortiguadores", "bujes de ballesta desgastados"],
+    "Eléctrico": ["alternador no carga, se reparó", "cambio de batería"],
+    "Motor": ["fuga de refrigerante en bomba de agua", "calibración de válvulas"],
+    "Otro": ["revisión general", "arreglo de puerta trasera"],
+}
+PHOTO_POOL = 16   # fotos distintas que se reparten entre los logs con foto
+
+
+def _app():
+    """Importa app.py en modo sin servidor (los avisos de Streamlit se silencian)."""
+    from streamlit import logger
+    logger.set_log_level(logging.ERROR)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import app
+    return app
+
+
+def _use_client(app, client):
+    app.db = client
+    app.REFS = app.get_refs()
+
+
+# --- Generador de flota sintética ---
+def _noise_jpeg(rnd, kb):
+    """JPEG de ruido de aproximadamente `kb` KB (el ruido casi no se comprime)."""
+    from PIL import Image
+    side = max(16, int((kb * 1024 / 1.2) ** 0.5))
+    img = Image.frombytes("L", (side, side), rnd.randbytes(side * side)).convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+def _log_entries(rnd, bus, n, start, days, shops, mechanics, photo_rate):
+    """Bitácora de un bus en orden cronológico con el odómetro siempre creciente."""
+    km = rnd.randint(20_000, 300_000)
+    due = {cat: km + rnd.randint(0, every) for cat, every in PREVENTIVE.items()}
+    step = days * 86400 / max(n, 1)
+    for i in range(n):
+        when = start + timedelta(seconds=i * step + rnd.uniform(0, step * 0.8))
+        km += int(step / 86400 * rnd.uniform(150, 400))
+        entry = {"bus": bus, "date": when, "km_current": km, "updated_at": when.replace(tzinfo=timezone.utc)}
+        overdue = [cat for cat, km_due in due.items() if km >= km_due]
+        kind = rnd.random()
+        if overdue and kind < 0.3:
+            cat = overdue[0]
+            due[cat] = km + PREVENTIVE[cat]
+            mec, com = rnd.randint(15, 120), rnd.randint(20, 400)
+            entry |= {"category": cat, "km_next": km + PREVENTIVE[cat], "mec_name": rnd.choice(mechanics), "mec_cost": mec,
+                      "com_name": rnd.choice(shops), "com_cost": com, "observations": rnd.choice(OBSERVATIONS[cat])}
+        elif kind < 0.38:
+            cat = rnd.choice(CORRECTIVE)
+            mec, com = rnd.randint(20, 300), rnd.randint(0, 900)
+            entry |= {"category": cat, "km_next": 0, "mec_name": rnd.choice(mechanics), "mec_cost": mec,
+                      "com_name": rnd.choice(shops), "com_cost": com, "observations": rnd.choice(OBSERVATIONS[cat])}
+        else:
+            gallons = round(rnd.uniform(15, 60), 1)
+            entry |= {"category": "Combustible", "km_next": 0, "gallons": gallons, "com_cost": round(gallons * rnd.uniform(2.3, 2.6), 2)}
+            mec = 0
+        # La mayoría de trabajos ya están pagados; algunos quedan con saldo pendiente
+        entry["mec_paid"] = mec if rnd.random() < 0.9 else round(mec * rnd.choice([0, 0.5]), 2)
+        entry["com_paid"] = entry.get("com_cost", 0) if rnd.random() < 0.9 else 0
+        entry["photo"] = rnd.random() < photo_rate
+        yield entry
+
+def generate_fleet(client, fleet_id=FLEET_ID, buses=10, logs=2_000, days=365, photo_kb=0, photo_rate=0.05, seed=0):
+    """Llena `client` con una flota sintética y reconstruye sus proyecciones. Devuelve los conteos."""
+    app = _app()
+    _use_client(app, client)
+    rnd = random.Random(seed)
+    fleets, data = app.REFS["fleets"], app.REFS["data"]
+    bus_ids = [f"{i:02d}" if buses < 100 else f"{i:03d}" for i in range(1, buses + 1)]
+    shops = [f"REPUESTOS {i}" for i in range(1, max(2, buses // 10) + 1)]
+    mechanics = [f"TALLER {i}" for i in range(1, max(2, buses // 10) + 1)]
+
+    fleets.document(fleet_id).set({"owner": OWNER["name"], "status": "active", "password": "bench", "created": datetime.now(),
+                                   "ai_rules": "Priorizar seguridad: frenos y llantas antes que estética."})
+    batch, pending = client.batch(), 0
+
+    def write(ref, doc):
+        nonlocal batch, pending
+        batch.set(ref, doc)
+        pending += 1
+        if pending == 500:
+            batch.commit()
+            batch, pending = client.batch(), 0
+
+    users = fleets.document(fleet_id).collection("authorized_users")
+    write(users.document(OWNER["name"]), {"active": True, "role": "admin"})
+    for i, bus in enumerate(bus_ids, 1):
+        write(users.document(f"CHOFER {i}"), {"active": True, "role": "driver", "bus": bus})
+    write(users.document("MECANICO"), {"active": True, "role": "mechanic", "bus": "0"})
+    for name in mechanics + shops:
+        write(data.collection("providers").document(), {"name": name, "phone": f"09{rnd.randint(10_000_000, 99_999_999)}",
+                                                         "type": "Mecánico" if name in mechanics else "Comercio", "fleetId": fleet_id})
+
+    photos = [app.store_photo(_noise_jpeg(rnd, photo_kb)) for _ in range(PHOTO_POOL)] if photo_kb else []
+    start = datetime.combine(date.today() - timedelta(days=days), datetime.min.time())
+    per_bus = [logs // buses + (1 if i < logs % buses else 0) for i in range(buses)]
+    for bus, n in zip(bus_ids, per_bus):
+        for entry in _log_entries(rnd, bus, n, start, days, shops, mechanics, photo_rate):
+            has_photo = entry.pop("photo")
+            doc = entry | {"fleetId": fleet_id, "status": "completed"}
+            if has_photo and photos:
+                doc |= rnd.choice(photos)
+            write(data.collection("logs").document(), doc)
+
+    senders = [(f"CHOFER {i} (DRIVER)", "owner") for i in range(1, buses + 1)] + [("BOSS (OWNER)", "mechanic")]
+    for i in range(buses * 2):
+        sender, target = rnd.choice(senders)
+        when = datetime.now() - timedelta(hours=rnd.randint(1, 24 * 30))
+        write(data.collection("notifications").document(), {"fleetId": fleet_id, "sender": sender, "target_role": target,
+                                                             "message": f"Revisar unidad, reporte #{i}", "date": when.isoformat(),
+                                                             "status": "unread" if rnd.random() < 0.2 else "read"})
+    for m in range(max(1, days // 30)):
+        month = (date.today().replace(day=1) - timedelta(days=30 * m)).strftime('%Y-%m')
+        income, driver_pay, other = rnd.randint(20_000, 60_000) * buses / 10, rnd.randint(5_000, 15_000) * buses / 10, rnd.randint(200, 2_000)
+        write(data.collection("financial_closures").document(), {
+            "fleetId": fleet_id, "month": month, "scope": "Toda la Flota", "bus": "Todos", "income": income,
+            "driver_pay": driver_pay, "other_expenses": other, "taller_expenses": 0, "total_expenses": driver_pay + other,
+            "profit": income - driver_pay - other, "margin_percent": (income - driver_pay - other) / income * 100,
+            "saved_at": datetime.now().isoformat(), "saved_by": OWNER["name"]})
+    if pending:
+        batch.commit()
+
+    app.rebuild_maintenance_status(fleet_id)
+    app.rebuild_fleet_stats(fleet_id)
+    app.rebuild_cost_rollups(fleet_id)
+    return {"buses": buses, "logs": logs, "providers": len(shops) + len(mechanics), "photos": len(photos)}
+
+
+# --- Páginas medidas ---
+# página -> (campos de la bitácora que carga la app para esa página, cómo se dibuja)
+def _pages(app):
+    return {
+        "fetch_fleet_data": (app.LOG_LIST_FIELDS, None),
+        "render_radar": (app.LOG_CORE_FIELDS, lambda df, provs, dr: app.render_radar(df, OWNER)),
+        "render_reports": (app.LOG_LIST_FIELDS, lambda df, provs, dr: app.render_reports(df, OWNER, dr)),
+        "render_accounting": (app.LOG_LIST_FIELDS, lambda df, provs, dr: app.render_accounting(df, OWNER, {p['name']: p.get('phone', '') for p in provs})),
+        "render_cierre_caja": (app.LOG_CORE_FIELDS, lambda df, provs, dr: app.render_cierre_caja(df, OWNER)),
+    }
+
+def _clear_caches():
+    """Vacía las cachés del proceso (la conexión al backend se conserva: app.db la fija el benchmark)."""
+    import streamlit as st
+    st.cache_data.clear()
+    st.cache_resource.clear()
+
+def _clear_snapshots(app):
+    """Borra las fotos Parquet de la bitácora (un arranque sin nada en disco)."""
+    shutil.rmtree(app.APP_CONFIG["LOG_SNAPSHOT_DIR"], ignore_errors=True)
+
+def measure_page(cfg):
+    """Mide una página dentro del script de AppTest. Devuelve {"seconds", "reads", "peak_mb"}."""
+    app = _app()
+    fields, render = _pages(app)[cfg["page"]]
+    dr = (date.fromisoformat(cfg["start"]), date.fromisoformat(cfg["end"]))
+    if cfg["cold"]:
+        # Que la foto de la corrida anterior quede escrita antes de vaciar las cachés o borrarla
+        app.flush_disk_snapshots()
+        _clear_caches()
+        if not cfg.get("restart"):
+            _clear_snapshots(app)
+    load = lambda: app.fetch_fleet_data(FLEET_ID, OWNER['role'], OWNER['bus'], dr[0], dr[1], fields)
+    if render is not None:
+        provs, df = load()
+    reads = app.db.stats["reads"]
+    if cfg["trace"]:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        if render is None:
+            load()
+        else:
+            render(df, provs, dr)
+        seconds = time.perf_counter() - started
+    finally:
+        peak = tracemalloc.get_traced_memory()[1] if cfg["trace"] else 0
+        if cfg["trace"]:
+            tracemalloc.stop()
+    return {"seconds": seconds, "reads": app.db.stats["reads"] - reads, "peak_mb": peak / 2**20}
+
+def _page_script(cfg):
+    import sys
+    import streamlit as st
+    if cfg["root"] not in sys.path:
+        sys.path.insert(0, cfg["root"])
+    import benchmark
+    st.session_state["bench_result"] = benchmark.measure_page(cfg)
+
+def _run_page(cfg):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_function(_page_script, args=(cfg,), default_timeout=600)
+    at.run()
+    if at.exception:
+        raise RuntimeError(f"{cfg['page']}: {at.exception[0].value}")
+    return at.session_state["bench_result"]
+
+def run_scale(scale, runs=3, days=90, seed=0):
+    """Genera la escala en memoria y mide cada página. Devuelve {página: métricas}."""
+    import storage
+    app = _app()
+    client = storage.MemoryClient(seed=seed)
+    app.APP_CONFIG["REALTIME"] = False
+    app.APP_CONFIG["LOG_SNAPSHOT_DIR"] = tempfile.mkdtemp(prefix="itero-bench-")
+    generate_fleet(client, buses=SCALES[scale]["buses"], logs=SCALES[scale]["logs"], seed=seed)
+    _use_client(app, client)
+    base = {"root": ROOT, "start": (date.today() - timedelta(days=days)).isoformat(), "end": date.today().isoformat()}
+    results = {}
+    for page in _pages(app):
+        cold, restart, warm = [], [], []
+        for _ in range(runs):
+            cold.append(_run_page(base | {"page": page, "cold": True, "trace": False}))
+            restart.append(_run_page(base | {"page": page, "cold": True, "restart": True, "trace": False}))
+            warm.append(_run_page(base | {"page": page, "cold": False, "trace": False}))
+        traced = _run_page(base | {"page": page, "cold": True, "trace": True})
+        results[page] = {
+            "cold_s": round(statistics.median(r["seconds"] for r in cold), 4),
+            "restart_s": round(statistics.median(r["seconds"] for r in restart), 4),
+            "warm_s": round(statistics.median(r["seconds"] for r in warm), 4),
+            "peak_mb": round(traced["peak_mb"], 2),
+            "reads_cold": cold[0]["reads"],
+            "reads_restart": restart[0]["reads"],
+            "reads_warm": warm[0]["reads"],
+        }
+        print(f"  {scale:<7} {page:<20} " + "  ".join(f"{k}={v}" for k, v in results[page].items()), flush=True)
+    app.flush_disk_snapshots()
+    _clear_snapshots(app)
+    return results
+
+
+# --- Línea base ---
+def compare(results, baseline, tolerance=0.25, min_seconds=0.1):
+    """Regresiones respecto a la línea base: [(escala, página, métrica, antes, ahora)].
+
+    Tiempos y memoria fallan si crecen más de `tolerance` (y, los tiempos, más de
+    `min_seconds` en absoluto, para no saltar por ruido); las lecturas son deterministas
+    y fallan ante cualquier aumento.
+    """
+    regressions = []
+    for scale, pages in results.items():
+        for page, metrics in pages.items():
+            before = baseline.get(scale, {}).get(page)
+            if not before: continue
+            for metric, now in metrics.items():
+                old = before.get(metric)
+                if old is None: continue
+                if metric.startswith("reads"):
+                    worse = now > old
+                elif metric.endswith("_s"):
+                    worse = now > old * (1 + tolerance) and now - old > min_seconds
+                else:
+                    worse = now > old * (1 + tolerance)
+                if worse:
+                    regressions.append((scale, page, metric, old, now))
+    return regressions
+
+def _load_baseline(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="llena un backend local con una flota sintética")
+    gen.add_argument("--storage", choices=["memory", "sqlite"], default="sqlite")
+    gen.add_argument("--path", default="itero.sqlite3")
+    gen.add_argument("--fleet", default=FLEET_ID)
+    gen.add_argument("--buses", type=int, default=200)
+    gen.add_argument("--logs", type=int, default=100_000)
+    gen.add_argument("--days", type=int, default=365)
+    gen.add_argument("--photo-kb", type=int, default=0)
+    gen.add_argument("--photo-rate", type=float, default=0.05)
+    gen.add_argument("--seed", type=int, default=0)
+
+    run = sub.add_parser("run", help="mide las páginas en una o varias escalas")
+    run.add_argument("--scale", nargs="+", choices=list(SCALES), default=["small"])
+    run.add_argument("--runs", type=int, default=3)
+    run.add_argument("--days", type=int, default=90, help="rango de fechas de las páginas (como la barra lateral)")
+    run.add_argument("--baseline", default=BASELINE_FILE)
+    run.add_argument("--tolerance", type=float, default=0.25)
+    mode = run.add_mutually_exclusive_group()
+    mode.add_argument("--save-baseline", action="store_true")
+    mode.add_argument("--check", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        import storage
+        client = storage.open_client(args.storage, args.path, seed=args.seed)
+        started = time.perf_counter()
+        counts = generate_fleet(client, args.fleet, args.buses, args.logs, args.days, args.photo_kb, args.photo_rate, args.seed)
+        print(f"{args.fleet}: {counts} en {time.perf_counter() - started:.1f} s ({args.storage} {args.path if args.storage == 'sqlite' else ''})")
+        print(f"Entrar como Administrador de {args.fleet} con la contraseña 'bench' (ITERO_STORAGE={args.storage}).")
+        return 0
+
+    results = {}
+    for scale in args.scale:
+        print(f"Escala {scale}: {SCALES[scale]['buses']} buses, {SCALES[scale]['logs']:,} logs", flush=True)
+        results[scale] = run_scale(scale, args.runs, args.days)
+    baseline = _load_baseline(args.baseline)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Línea base guardada en {args.baseline}")
+    elif args.check:
+        missing = [scale for scale in results if scale not in baseline]
+        if missing:
+            print(f"❌ La línea base {args.baseline} no tiene las escalas: {', '.join(missing)} (créala con --save-baseline)")
+            return 1
+        regressions = compare(results, baseline, args.tolerance)
+        for scale, page, metric, old, now in regressions:
+            print(f"❌ {scale} {page} {metric}: {old} -> {now}")
+        if regressions:
+            return 1
+        print("✅ Sin regresiones respecto a la línea base")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,671 @@
+"""Backends de almacenamiento locales para Itero.
+
+Implementan el subconjunto del cliente de Firestore que usa app.py: colecciones y
+subcolecciones, documentos, consultas (where / FieldFilter / Or, select, order_by, limit,
+start_after), agregaciones count/sum, lotes, transacciones, get_all, transformaciones (SERVER_TIMESTAMP,
+Increment, Maximum, DELETE_FIELD) y escuchas on_snapshot. Así `REFS` y todas las
+consultas de la app funcionan igual sin un proyecto de Firebase:
+
+- MemoryClient: los documentos viven en un dict del proceso (desarrollo sin conexión,
+  pruebas de carga y benchmarks deterministas).
+- SQLiteClient: un archivo SQLite con índices por colección y por `fleetId`, para
+  instalaciones pequeñas de una sola empresa.
+
+La app elige el backend con APP_CONFIG["STORAGE"] ("firestore" | "memory" | "sqlite").
+"""
+import base64
+import copy
+import json
+import queue
+import random
+import sqlite3
+import string
+import threading
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import InvalidArgument, NotFound
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.base_aggregation import AggregationResult
+from google.cloud.firestore_v1.base_query import And, FieldFilter, Or
+from google.cloud.firestore_v1.watch import ChangeType, DocumentChange
+
+MAX_BATCH_WRITES = 500
+_MISSING = object()
+
+
+# --- Valores y rutas de campos ---
+def _now():
+    return datetime.now(timezone.utc)
+
+def _get_field(data, field_path):
+    cur = data
+    for part in field_path.split("."):
+        if not isinstance(cur, dict) or part not in cur:
+            return _MISSING
+        cur = cur[part]
+    return cur
+
+def _project(data, field_paths):
+    out = {}
+    for path in field_paths:
+        value = _get_field(data, path)
+        if value is _MISSING: continue
+        cur, parts = out, path.split(".")
+        for part in parts[:-1]:
+            cur = cur.setdefault(part, {})
+        cur[parts[-1]] = copy.deepcopy(value)
+    return out
+
+def _transform(old, value, now):
+    """Valor final de un campo: resuelve las transformaciones del servidor."""
+    if value is transforms.SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, transforms.Increment):
+        base = old if isinstance(old, (int, float)) and not isinstance(old, bool) else 0
+        return base + value.value
+    if isinstance(value, transforms.Maximum):
+        return max(old, value.value) if isinstance(old, (int, float)) and not isinstance(old, bool) else value.value
+    if isinstance(value, transforms.Minimum):
+        return min(old, value.value) if isinstance(old, (int, float)) and not isinstance(old, bool) else value.value
+    if isinstance(value, dict):
+        return _merge_map({}, value, now)
+    return copy.deepcopy(value)
+
+def _merge_map(target, data, now):
+    """Fusiona `data` en `target` como `set(..., merge=True)`: los mapas se fusionan campo a campo."""
+    for key, value in data.items():
+        if value is transforms.DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict):
+            current = target.get(key)
+            target[key] = _merge_map(current if isinstance(current, dict) else {}, value, now)
+        else:
+            target[key] = _transform(target.get(key), value, now)
+    return target
+
+def _update_path(target, field_path, value, now):
+    """Aplica un campo de `update()`: la clave es una ruta con puntos y el valor reemplaza."""
+    parts = field_path.split(".")
+    cur = target
+    for part in parts[:-1]:
+        if not isinstance(cur.get(part), dict):
+            cur[part] = {}
+        cur = cur[part]
+    if value is transforms.DELETE_FIELD:
+        cur.pop(parts[-1], None)
+    else:
+        cur[parts[-1]] = _transform(cur.get(parts[-1]), value, now)
+
+# Orden entre tipos de Firestore: null < bool < número < fecha < texto < bytes < lista < mapa
+def _type_rank(value):
+    if value is None: return 0
+    if isinstance(value, bool): return 1
+    if isinstance(value, (int, float)): return 2
+    if isinstance(value, datetime): return 3
+    if isinstance(value, str): return 4
+    if isinstance(value, bytes): return 5
+    if isinstance(value, (list, tuple)): return 7
+    if isinstance(value, dict): return 8
+    return 6
+
+def _sort_key(value):
+    rank = _type_rank(value)
+    if rank == 3 and value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    if rank == 7:
+        return rank, tuple(_sort_key(v) for v in value)
+    if rank == 8:
+        return rank, tuple(sorted((k, _sort_key(v)) for k, v in value.items()))
+    return rank, value
+
+def _compare(value, op, target):
+    if op == "!=":
+        return value is not _MISSING and value != target
+    if op == "not-in":
+        return value is not _MISSING and value not in target
+    if value is _MISSING:
+        return False
+    if op == "==":
+        return _type_rank(value) == _type_rank(target) and _sort_key(value) == _sort_key(target)
+    if op == "in":
+        return any(_compare(value, "==", t) for t in target)
+    if op == "array_contains":
+        return isinstance(value, list) and any(_compare(v, "==", target) for v in value)
+    if op == "array_contains_any":
+        return isinstance(value, list) and any(_compare(v, "==", t) for v in value for t in target)
+    # Las desigualdades solo comparan valores del mismo tipo
+    if _type_rank(value) != _type_rank(target):
+        return False
+    a, b = _sort_key(value), _sort_key(target)
+    return {"<": a < b, "<=": a <= b, ">": a > b, ">=": a >= b}[op]
+
+def _matches(data, flt):
+    if isinstance(flt, FieldFilter):
+        return _compare(_get_field(data, flt.field_path), flt.op_string, flt.value)
+    if isinstance(flt, Or):
+        return any(_matches(data, f) for f in flt.filters)
+    if isinstance(flt, And):
+        return all(_matches(data, f) for f in flt.filters)
+    raise TypeError(f"Filtro no soportado: {flt!r}")
+
+def _split_path(path):
+    parent, _, doc_id = path.rpartition("/")
+    return parent, doc_id
+
+
+# --- Documentos y colecciones ---
+class DocumentSnapshot:
+    """Foto de un documento, con la misma interfaz que la de Firestore."""
+    def __init__(self, reference, data, update_time=None, read_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self.create_time = update_time
+        self.read_time = read_time
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self.exists else None
+
+    def get(self, field_path):
+        if not self.exists: return None
+        value = _get_field(self._data, field_path)
+        if value is _MISSING:
+            raise KeyError(f"'{field_path}' is not contained in the data")
+        return copy.deepcopy(value)
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentSnapshot) and self.reference == other.reference and self._data == other._data
+
+
+class DocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rpartition("/")[2]
+
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self.path.rpartition("/")[0])
+
+    def collection(self, collection_id):
+        return CollectionReference(self._client, f"{self.path}/{collection_id}")
+
+    def get(self, field_paths=None, **kwargs):
+        return self._client._snapshot(self, field_paths)
+
+    def set(self, document_data, merge=False):
+        return self._client._commit([("set", self, document_data, merge)])[0]
+
+    def create(self, document_data):
+        return self._client._commit([("create", self, document_data, False)])[0]
+
+    def update(self, field_updates):
+        return self._client._commit([("update", self, field_updates, False)])[0]
+
+    def delete(self):
+        return self._client._commit([("delete", self, None, False)])[0]
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other._client is self._client and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class AggregationQuery:
+    def __init__(self, query, aggregations=()):
+        self._query = query
+        self._aggregations = list(aggregations)
+
+    def _with(self, kind, field_path, alias):
+        alias = alias or f"field_{len(self._aggregations) + 1}"
+        return AggregationQuery(self._query, self._aggregations + [(kind, field_path, alias)])
+
+    def count(self, alias=None):
+        return self._with("count", None, alias)
+
+    def sum(self, field_ref, alias=None):
+        return self._with("sum", field_ref, alias)
+
+    def avg(self, field_ref, alias=None):
+        return self._with("avg", field_ref, alias)
+
+    def get(self, **kwargs):
+        rows = self._query._run()
+        # Firestore cobra una lectura por cada 1000 entradas de índice recorridas
+        self._query._client._count("reads", max(1, -(-len(rows) // 1000)))
+        read_time = _now()
+        results = []
+        for kind, field_path, alias in self._aggregations:
+            if kind == "count":
+                value = len(rows)
+            else:
+                nums = [v for _, d, _ in rows for v in [_get_field(d, field_path)]
+                        if isinstance(v, (int, float)) and not isinstance(v, bool)]
+                if kind == "sum":
+                    value = sum(nums) if all(isinstance(v, int) for v in nums) else float(sum(nums))
+                else:
+                    value = sum(nums) / len(nums) if nums else None
+            results.append(AggregationResult(alias, value, read_time))
+        return [results]
+
+
+class Query:
+    def __init__(self, client, parent_path, filters=(), fields=None, orders=(), limit=None, cursor=None):
+        self._client = client
+        self._parent_path = parent_path
+        self._filters = tuple(filters)
+        self._fields = fields
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._cursor = cursor
+
+    def _copy(self, **changes):
+        state = {"filters": self._filters, "fields": self._fields, "orders": self._orders, "limit": self._limit, "cursor": self._cursor}
+        state.update(changes)
+        return Query(self._client, self._parent_path, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        flt = filter if filter is not None else FieldFilter(field_path, op_string, value)
+        return self._copy(filters=self._filters + (flt,))
+
+    def select(self, field_paths):
+        return self._copy(fields=tuple(field_paths))
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(cursor=document_fields_or_snapshot)
+
+    def count(self, alias=None):
+        return AggregationQuery(self).count(alias)
+
+    def sum(self, field_ref, alias=None):
+        return AggregationQuery(self).sum(field_ref, alias)
+
+    def avg(self, field_ref, alias=None):
+        return AggregationQuery(self).avg(field_ref, alias)
+
+    def _equalities(self):
+        return [(f.field_path, f.value) for f in self._filters if isinstance(f, FieldFilter) and f.op_string == "=="]
+
+    def _effective_orders(self):
+        """Orden explícito, luego los campos con desigualdad y al final el id (como Firestore)."""
+        orders = list(self._orders)
+        ordered = {f for f, _ in orders}
+        for flt in self._filters:
+            if isinstance(flt, FieldFilter) and flt.op_string in ("<", "<=", ">", ">=", "!=", "not-in") and flt.field_path not in ordered:
+                orders.append((flt.field_path, "ASCENDING"))
+                ordered.add(flt.field_path)
+        if "__name__" not in ordered:
+            orders.append(("__name__", orders[-1][1] if orders else "ASCENDING"))
+        return orders
+
+    def _run(self):
+        """[(id, datos, update_time)] que cumplen la consulta, ya ordenados y recortados."""
+        rows = [(doc_id, data, ut) for doc_id, data, ut in self._client._scan(self._parent_path, self._equalities())
+                if all(_matches(data, f) for f in self._filters)]
+        orders = self._effective_orders()
+        # Los documentos sin el campo de orden no aparecen en la consulta
+        rows = [r for r in rows if all(f == "__name__" or _get_field(r[1], f) is not _MISSING for f, _ in orders)]
+
+        def value(row, field_path):
+            return row[0] if field_path == "__name__" else _get_field(row[1], field_path)
+
+        for field_path, direction in reversed(orders):
+            rows.sort(key=lambda r: _sort_key(value(r, field_path)), reverse=direction == "DESCENDING")
+        if self._cursor is not None:
+            cursor = self._cursor_values(orders)
+            rows = [r for r in rows if self._after(r, cursor, orders, value)]
+        return rows[: self._limit] if self._limit is not None else rows
+
+    def _cursor_values(self, orders):
+        cursor = self._cursor
+        if isinstance(cursor, DocumentSnapshot):
+            return [cursor.id if f == "__name__" else _get_field(cursor._data or {}, f) for f, _ in orders]
+        values = []
+        for field_path, _ in orders:
+            if field_path not in cursor: break
+            v = cursor[field_path]
+            if field_path == "__name__":
+                v = v.id if isinstance(v, DocumentReference) else str(v).rpartition("/")[2]
+            values.append(v)
+        return values
+
+    @staticmethod
+    def _after(row, cursor, orders, value):
+        for (field_path, direction), target in zip(orders, cursor):
+            a, b = _sort_key(value(row, field_path)), _sort_key(target)
+            if a != b:
+                return a > b if direction != "DESCENDING" else a < b
+        return False
+
+    def stream(self, **kwargs):
+        read_time = _now()
+        rows = self._run()
+        self._client._count("reads", max(1, len(rows)))
+        for doc_id, data, update_time in rows:
+            ref = DocumentReference(self._client, f"{self._parent_path}/{doc_id}")
+            yield DocumentSnapshot(ref, _project(data, self._fields) if self._fields is not None else copy.deepcopy(data), update_time, read_time)
+
+    def get(self, **kwargs):
+        return list(self.stream())
+
+    def explain_stats(self):
+        """(documentos leídos del almacenamiento, documentos devueltos) sin cobrar lecturas.
+
+        Equivale a `documents_scanned` / `results_returned` del `explain` de Firestore.
+        """
+        scanned = self._client._scan(self._parent_path, self._equalities())
+        return len(scanned), len(self._run())
+
+    def on_snapshot(self, callback):
+        return self._client._listen(self, callback)
+
+
+class CollectionReference(Query):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.path = path
+        self.id = path.rpartition("/")[2]
+
+    def document(self, document_id=None):
+        return DocumentReference(self._client, f"{self.path}/{document_id or self._client._auto_id()}")
+
+    def add(self, document_data, document_id=None):
+        ref = self.document(document_id)
+        return ref.create(document_data), ref
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+
+    def set(self, reference, document_data, merge=False):
+        self._ops.append(("set", reference, document_data, merge))
+        return self
+
+    def create(self, reference, document_data):
+        self._ops.append(("create", reference, document_data, False))
+        return self
+
+    def update(self, reference, field_updates):
+        self._ops.append(("update", reference, field_updates, False))
+        return self
+
+    def delete(self, reference):
+        self._ops.append(("delete", reference, None, False))
+        return self
+
+    def commit(self, **kwargs):
+        ops, self._ops = self._ops, []
+        return self._client._commit(ops)
+
+
+class Transaction(WriteBatch):
+    """Transacción de los backends locales: la función corre con el candado del cliente tomado,
+    así ninguna otra escritura del proceso se mete entre sus lecturas y su commit."""
+    def run(self, fn):
+        with self._client._lock:
+            self._ops = []
+            result = fn(self)
+            self.commit()
+        return result
+
+
+class Watch:
+    """Escucha devuelta por on_snapshot."""
+    def __init__(self, client, query, callback):
+        self._client = client
+        self._query = query
+        self._callback = callback
+        self._docs = None
+        self.is_active = True
+
+    def unsubscribe(self):
+        self.is_active = False
+        self._client._unlisten(self)
+
+
+# --- Clientes ---
+class BaseClient:
+    """Lógica común: consultas, escrituras atómicas y escuchas. Las subclases guardan los datos."""
+    def __init__(self, seed=None):
+        self._lock = threading.RLock()
+        self._ids = random.Random(seed) if seed is not None else random.SystemRandom()
+        self._watches = []
+        self._events = queue.Queue()
+        self._dispatcher = None
+        # Lecturas y escrituras facturables según las reglas de Firestore (benchmarks, métricas)
+        self.stats = {"reads": 0, "writes": 0}
+
+    # Almacenamiento (lo implementa cada backend)
+    def _load(self, path):
+        raise NotImplementedError
+
+    def _store(self, changes):
+        raise NotImplementedError
+
+    def _scan(self, parent_path, equalities):
+        raise NotImplementedError
+
+    # API del cliente de Firestore
+    def collection(self, path):
+        return CollectionReference(self, path)
+
+    def document(self, path):
+        return DocumentReference(self, path)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self):
+        return Transaction(self)
+
+    def get_all(self, references, field_paths=None, **kwargs):
+        for ref in references:
+            yield self._snapshot(ref, field_paths)
+
+    def close(self):
+        pass
+
+    def _auto_id(self):
+        return "".join(self._ids.choice(string.ascii_letters + string.digits) for _ in range(20))
+
+    def _count(self, kind, n=1):
+        with self._lock:
+            self.stats[kind] += n
+
+    def _snapshot(self, ref, field_paths=None):
+        self._count("reads")
+        with self._lock:
+            found = self._load(ref.path)
+        data, update_time = found if found else (None, None)
+        if data is not None and field_paths is not None:
+            data = _project(data, field_paths)
+        return DocumentSnapshot(ref, copy.deepcopy(data), update_time, _now())
+
+    def _commit(self, ops):
+        if len(ops) > MAX_BATCH_WRITES:
+            raise InvalidArgument(f"maximum {MAX_BATCH_WRITES} writes allowed per request")
+        now = _now()
+        with self._lock:
+            staged = {}
+            for action, ref, data, merge in ops:
+                if ref.path not in staged:
+                    found = self._load(ref.path)
+                    staged[ref.path] = copy.deepcopy(found[0]) if found else None
+                current = staged[ref.path]
+                if action == "delete":
+                    staged[ref.path] = None
+                elif action == "create":
+                    if current is not None:
+                        raise InvalidArgument(f"Document already exists: {ref.path}")
+                    staged[ref.path] = _merge_map({}, data, now)
+                elif action == "set":
+                    staged[ref.path] = _merge_map(current if merge and current is not None else {}, data, now)
+                else:
+                    if current is None:
+                        raise NotFound(f"No document to update: {ref.path}")
+                    for field_path, value in data.items():
+                        _update_path(current, field_path, value, now)
+            self._store({path: (data, now) if data is not None else None for path, data in staged.items()})
+            self.stats["writes"] += len(ops)
+            parents = {_split_path(path)[0] for path in staged}
+            for watch in self._watches:
+                if watch._query._parent_path in parents:
+                    self._events.put(watch)
+        return [now for _ in ops]
+
+    # Escuchas: se entregan en un hilo aparte, como en Firestore
+    def _listen(self, query, callback):
+        watch = Watch(self, query, callback)
+        with self._lock:
+            self._watches.append(watch)
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name="storage-watch", daemon=True)
+                self._dispatcher.start()
+        self._events.put(watch)
+        return watch
+
+    def _unlisten(self, watch):
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+    def _dispatch(self):
+        while True:
+            watch = self._events.get()
+            try:
+                if watch.is_active:
+                    self._deliver(watch)
+            except Exception as e:
+                print(f"⚠️ Error en la escucha de {watch._query._parent_path}: {e}")
+            finally:
+                self._events.task_done()
+
+    def _deliver(self, watch):
+        with self._lock:
+            snaps = [DocumentSnapshot(DocumentReference(self, f"{watch._query._parent_path}/{doc_id}"), copy.deepcopy(data), ut, _now())
+                     for doc_id, data, ut in watch._query._run()]
+        current = {s.id: s for s in snaps}
+        previous = watch._docs
+        changes = []
+        for index, snap in enumerate(snaps):
+            old = (previous or {}).get(snap.id)
+            if old is None:
+                changes.append(DocumentChange(ChangeType.ADDED, snap, -1, index))
+            elif old.to_dict() != snap.to_dict():
+                changes.append(DocumentChange(ChangeType.MODIFIED, snap, index, index))
+        for index, (doc_id, snap) in enumerate((previous or {}).items()):
+            if doc_id not in current:
+                changes.append(DocumentChange(ChangeType.REMOVED, snap, index, -1))
+        watch._docs = current
+        self._count("reads", len(changes) or int(previous is None))
+        if changes or previous is None:
+            watch._callback(snaps, changes, _now())
+
+    def flush(self):
+        """Espera a que las escuchas reciban los cambios ya escritos (útil en pruebas y benchmarks)."""
+        self._events.join()
+
+
+class MemoryClient(BaseClient):
+    """Todo en memoria del proceso; se pierde al reiniciar."""
+    def __init__(self, seed=None):
+        super().__init__(seed)
+        self._docs = {}        # ruta -> (datos, update_time)
+        self._children = {}    # ruta de la colección -> {id}
+
+    def _load(self, path):
+        return self._docs.get(path)
+
+    def _store(self, changes):
+        for path, value in changes.items():
+            parent, doc_id = _split_path(path)
+            if value is None:
+                self._docs.pop(path, None)
+                self._children.get(parent, set()).discard(doc_id)
+            else:
+                self._docs[path] = value
+                self._children.setdefault(parent, set()).add(doc_id)
+
+    def _scan(self, parent_path, equalities):
+        with self._lock:
+            return [(doc_id, *self._docs[f"{parent_path}/{doc_id}"]) for doc_id in self._children.get(parent_path, ())]
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"__dt__": value.isoformat()}
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    raise TypeError(f"Tipo no serializable: {type(value).__name__}")
+
+def _decode(obj):
+    if "__dt__" in obj and len(obj) == 1:
+        return datetime.fromisoformat(obj["__dt__"])
+    if "__bytes__" in obj and len(obj) == 1:
+        return base64.b64decode(obj["__bytes__"])
+    return obj
+
+
+class SQLiteClient(BaseClient):
+    """Un archivo SQLite: una fila JSON por documento, indexada por colección y `fleetId`."""
+    INDEXED_FIELDS = ("fleetId",)
+
+    def __init__(self, path, seed=None):
+        super().__init__(seed)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS docs (path TEXT PRIMARY KEY, parent TEXT NOT NULL, doc_id TEXT NOT NULL, data TEXT NOT NULL, update_time TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS docs_parent ON docs (parent, doc_id)")
+        for field in self.INDEXED_FIELDS:
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS docs_{field} ON docs (parent, json_extract(data, '$.{field}'))")
+        self._conn.commit()
+
+    def _load(self, path):
+        row = self._conn.execute("SELECT data, update_time FROM docs WHERE path = ?", (path,)).fetchone()
+        return (json.loads(row[0], object_hook=_decode), datetime.fromisoformat(row[1])) if row else None
+
+    def _store(self, changes):
+        with self._conn:
+            for path, value in changes.items():
+                if value is None:
+                    self._conn.execute("DELETE FROM docs WHERE path = ?", (path,))
+                else:
+                    parent, doc_id = _split_path(path)
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO docs (path, parent, doc_id, data, update_time) VALUES (?, ?, ?, ?, ?)",
+                        (path, parent, doc_id, json.dumps(value[0], default=_encode), value[1].isoformat()))
+
+    def _scan(self, parent_path, equalities):
+        # Las igualdades sobre texto o números se filtran en SQL (usando los índices);
+        # el resto de la consulta se evalúa igual que en memoria.
+        sql, args = "SELECT doc_id, data, update_time FROM docs WHERE parent = ?", [parent_path]
+        for field_path, value in equalities:
+            if isinstance(value, (str, int, float)) and not isinstance(value, bool) and field_path.replace("_", "").isalnum():
+                sql += f" AND json_extract(data, '$.{field_path}') = ?"
+                args.append(value)
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        return [(doc_id, json.loads(data, object_hook=_decode), datetime.fromisoformat(ut)) for doc_id, data, ut in rows]
+
+    def close(self):
+        self._conn.close()
+
+
+def open_client(kind, path=None, seed=None):
+    """Cliente local según APP_CONFIG["STORAGE"]."""
+    if kind == "memory":
+        return MemoryClient(seed)
+    if kind == "sqlite":
+        return SQLiteClient(path or "itero.sqlite3", seed)
+    raise ValueError(f"Backend de almacenamiento desconocido: {kind}")